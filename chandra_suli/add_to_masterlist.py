@@ -9,11 +9,10 @@ import argparse
 import os
 import sys
 
-import numpy as np
-import pandas as pd
-
 from chandra_suli import logging_system
+from chandra_suli.candidate_table import read_candidates
 from chandra_suli.data_package import DataPackage
+from chandra_suli.master_list import MasterList
 from chandra_suli.run_command import CommandRunner
 from chandra_suli.sanitize_filename import sanitize_filename
 
@@ -25,6 +24,9 @@ if __name__ == "__main__":
                         required=True, type=str)
     parser.add_argument("--masterfile", help="Path to file containing list of transients in this set",
                         required=True, type=str)
+    parser.add_argument("--db", help="SQLite database containing the master list (default: same name as the "
+                                     "masterfile, with extension .db). The masterfile is exported from it",
+                        required=False, type=str, default=None)
     # parser.add_argument("--evtfile", help="Main event file for observation, used to get total exposure time",
     #                    required=True, type=str)
 
@@ -41,121 +43,78 @@ if __name__ == "__main__":
 
     data_package = DataPackage(sanitize_filename(args.package))
 
-    for bbfile_tag in data_package.find_all("ccd_?_check_var"):
-
-        logger.info("Processing %s..." % bbfile_tag)
-
-        bbfile = data_package.get(bbfile_tag).filename
-
-        logger.info("(reading from file %s)" % bbfile)
-
-        # get directory path and file name from input file arguments
-
-        bb_file_path = sanitize_filename(bbfile)
-
-        masterfile = sanitize_filename(args.masterfile)
-
-        # evtfile = sanitize_filename(args.evtfile)
-
-        # read BB data into array
-        bb_data = np.array(np.recfromtxt(bb_file_path, names=True), ndmin=1)
-
-        # number of rows of data
-        bb_n = len(bb_data)
-
-        if bb_n == 0:
-            continue
+    masterfile = sanitize_filename(args.masterfile)
 
-        # column names
-        existing_column_names = " ".join(bb_data.dtype.names)
+    if args.db is not None:
 
-        # with pyfits.open(evtfile) as evt:
+        db_file = sanitize_filename(args.db)
 
-        #    exposure = evt['EVENTS'].header['EXPOSURE']
+    else:
 
-        # If fresh list is to be started
+        db_file = "%s.db" % os.path.splitext(masterfile)[0]
 
-        if not os.path.exists(masterfile):
+    db_exists = os.path.exists(db_file)
 
-            # new array of appropriate size
-            master_data = np.empty([0, len(bb_data[0]) + 1])
+    master_list = MasterList(db_file)
 
-        else:
+    if not db_exists and os.path.exists(masterfile):
 
-            master_data = np.array(np.recfromtxt(masterfile, names=True), ndmin=1)
+        # Master list created before the database was introduced. Import it
 
-        with open('__temp.txt', "w") as temp:
+        n_imported = master_list.import_text(masterfile)
 
-            temp.write("# %s\n" % existing_column_names)
+        logger.info("Imported %s candidates from %s" % (n_imported, masterfile))
 
-            i = 0
+    # The list of all the candidates of the obsid is always in the package (the lists for each CCD are there only
+    # if step 2 ran with --debug_files, or for packages made by older versions)
 
-            while i < len(master_data):
+    if data_package.has("candidates"):
 
-                temp_list = []
+        bbfile_tags = ["candidates"]
 
-                for j in xrange(1, len(bb_data.dtype.names) + 1):
-                    temp_list.append(str(master_data[i][j]))
+    else:
 
-                line = " ".join(temp_list)
+        bbfile_tags = data_package.find_all("ccd_?_check_var")
 
-                temp.write("%s\n" % line)
+    for bbfile_tag in bbfile_tags:
 
-                i += 1
-
-            i = 0
-
-            while i < len(bb_data):
-
-                temp_list = []
-
-                for j in xrange(len(bb_data.dtype.names)):
-                    temp_list.append(str(bb_data[i][j]))
-
-                line = " ".join(temp_list)
-
-                temp.write("%s\n" % line)
-
-                i += 1
-
-        data_raw = np.array(np.recfromtxt("__temp.txt", names=True), ndmin=1)
-
-        data_all = pd.DataFrame.from_records(data_raw)
-        # Drop all duplicates
+        logger.info("Processing %s..." % bbfile_tag)
 
-        data_unique = data_all.drop_duplicates(subset=['Candidate', 'Obsid', 'CCD'])
+        bbfile = data_package.get(bbfile_tag).filename
 
-        # Keep only data satisfying the following conditions (empty at the moment)
+        logger.info("(reading from file %s)" % bbfile)
 
-        #idx = (data_unique['PSFfrac'] > 0)
+        # get directory path and file name from input file arguments
 
-        # Sort according to PSFfrac
+        bb_file_path = sanitize_filename(bbfile)
 
-        data_filtered = data_unique#[idx]
+        if bbfile_tag == "candidates":
 
-        master_data_sorted = sorted(data_filtered.values.tolist(), key=lambda data_row: data_row[-1], reverse=True)
+            # Same format as the master list (with the Rank column, which is dropped)
 
-        # Write data to text file
+            master_list.import_text(bb_file_path)
 
-        with open(args.masterfile, "w") as f:
+            continue
 
-            f.write("# Rank %s\n" % existing_column_names)
+        # read BB data into array (the format is given by the extension of the file)
+        bb_data = read_candidates(bb_file_path)
 
-            i = 0
+        # number of rows of data
+        bb_n = len(bb_data)
 
-            while i < len(master_data_sorted):
+        if bb_n == 0:
+            continue
 
-                temp_list = []
+        # Add or replace the candidates (the key is Obsid, CCD and Candidate, so duplicates are not possible)
 
-                temp_list.append(str(i + 1))
+        master_list.upsert(bb_data.dtype.names, bb_data)
 
-                for j in xrange(len(bb_data.dtype.names)):
-                    temp_list.append(str(master_data_sorted[i][j]))
+    # Write the master list to the text file, sorted according to the last column (PSFfrac)
 
-                line = " ".join(temp_list)
+    if len(master_list.columns) > 0:
 
-                f.write("%s\n" % line)
+        n_written = master_list.export(masterfile)
 
-                i += 1
+        logger.info("Master list %s contains %s candidates" % (masterfile, n_written))
 
-        os.remove('__temp.txt')
+    master_list.close()
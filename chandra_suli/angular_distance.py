@@ -1,5 +1,7 @@
-import astropy.units as u
-from astropy.coordinates import SkyCoord
+from chandra_suli.lazy_import import lazy_import
+
+u = lazy_import("astropy.units")
+coordinates = lazy_import("astropy.coordinates")
 
 
 def angular_distance(ra1, dec1, ra2, dec2, unit='degree'):
@@ -13,9 +15,9 @@ def angular_distance(ra1, dec1, ra2, dec2, unit='degree'):
     :param unit: the unit of the output (default: degree)
     :return: angular distance
     """
-    point_1 = SkyCoord(ra=ra1 * u.degree, dec=dec1 * u.degree, frame='icrs')
+    point_1 = coordinates.SkyCoord(ra=ra1 * u.degree, dec=dec1 * u.degree, frame='icrs')
 
-    point_2 = SkyCoord(ra=ra2 * u.degree, dec=dec2 * u.degree, frame='icrs')
+    point_2 = coordinates.SkyCoord(ra=ra2 * u.degree, dec=dec2 * u.degree, frame='icrs')
 
     angular_distance = point_1.separation(point_2).to(unit)
 
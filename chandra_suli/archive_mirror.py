@@ -0,0 +1,349 @@
+"""
+Local mirror of the Chandra archive, so reprocessing the same obsids does not need the network.
+
+The files are stored by content (objects/<md5[:2]>/<md5>, so files shared by more than one obsid, like the
+ancillary files, are stored only once), and a SQLite database maps each (obsid, file type, file name) to its
+checksum. Every file served by the mirror is verified against its checksum while it is copied out: if a file is
+corrupted the obsid is dropped from the mirror and downloaded again. The event files updated by r4_header_update are
+stored as well (file type evt3_r4), so the header update is not repeated either. When the mirror grows beyond its
+maximum size, the obsids used least recently are evicted.
+"""
+
+import collections
+import os
+import sqlite3
+import tempfile
+import time
+
+from chandra_suli.data_package import _stream_copy
+from chandra_suli.logging_system import get_logger
+from chandra_suli.sanitize_filename import sanitize_filename
+
+logger = get_logger("archive_mirror")
+
+# File types needed to serve an obsid, as returned by download_manager.find_downloaded_files. asol is a list
+raw_file_types = ['evt3', 'tsv', 'exp3', 'fov3', 'asol', 'pbk']
+
+# File type of the event file after r4_header_update
+updated_event_file_type = 'evt3_r4'
+
+
+class ArchiveMirror(object):
+    def __init__(self, directory, max_size=None):
+        """
+        A local mirror of the archive
+
+        :param directory: directory of the mirror (created if it does not exist)
+        :param max_size: maximum size of the stored files (bytes). If None, the mirror is never evicted
+        """
+
+        self._directory = sanitize_filename(directory)
+
+        self._max_size = max_size
+
+        if not os.path.exists(self._directory):
+
+            os.makedirs(self._directory)
+
+        self._db_file = os.path.join(self._directory, "mirror.db")
+
+        with self._connect() as connection:
+
+            connection.execute("CREATE TABLE IF NOT EXISTS files (obsid INTEGER, file_type TEXT, name TEXT, md5 TEXT, "
+                               "PRIMARY KEY (obsid, file_type, name))")
+
+            connection.execute("CREATE TABLE IF NOT EXISTS objects (md5 TEXT PRIMARY KEY, size INTEGER)")
+
+            connection.execute("CREATE TABLE IF NOT EXISTS obsids (obsid INTEGER PRIMARY KEY, complete INTEGER, "
+                               "last_used REAL)")
+
+    @property
+    def directory(self):
+
+        return self._directory
+
+    @property
+    def size(self):
+        """
+        Total size of the files in the mirror (bytes)
+        """
+
+        with self._connect() as connection:
+
+            return connection.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def _connect(self):
+
+        # A new connection each time, so the mirror can be used by more than one thread (and process) at once
+
+        return _Connection(self._db_file)
+
+    def _object_path(self, md5):
+
+        return os.path.join(self._directory, "objects", md5[:2], md5)
+
+    def has(self, obsid):
+        """
+        Returns whether the mirror can serve all the files of the obsid
+        """
+
+        with self._connect() as connection:
+
+            row = connection.execute("SELECT complete FROM obsids WHERE obsid = ?", (int(obsid),)).fetchone()
+
+        return row is not None and bool(row[0])
+
+    def _add_file(self, obsid, file_type, filename):
+
+        # Store the content of the file (if not already there) and map it to the obsid
+
+        file_descriptor, temp_file = tempfile.mkstemp(prefix="__incoming_", dir=self._directory)
+
+        os.close(file_descriptor)
+
+        _, md5 = _stream_copy(filename, temp_file)
+
+        object_path = self._object_path(md5)
+
+        if os.path.exists(object_path):
+
+            os.remove(temp_file)
+
+        else:
+
+            if not os.path.exists(os.path.dirname(object_path)):
+
+                os.makedirs(os.path.dirname(object_path))
+
+            os.rename(temp_file, object_path)
+
+        with self._connect() as connection:
+
+            connection.execute("INSERT OR REPLACE INTO objects (md5, size) VALUES (?, ?)",
+                               (md5, os.path.getsize(object_path)))
+
+            connection.execute("INSERT OR REPLACE INTO files (obsid, file_type, name, md5) VALUES (?, ?, ?, ?)",
+                               (int(obsid), file_type, os.path.basename(filename), md5))
+
+            connection.execute("INSERT OR IGNORE INTO obsids (obsid, complete, last_used) VALUES (?, 0, ?)",
+                               (int(obsid), time.time()))
+
+    def add(self, obsid, files):
+        """
+        Add the files downloaded for an obsid
+
+        :param obsid: the obsid
+        :param files: dictionary file type -> path (or list of paths), like the output of
+        download_manager.find_downloaded_files
+        :return: None
+        """
+
+        for file_type in raw_file_types:
+
+            paths = files[file_type] if isinstance(files[file_type], list) else [files[file_type]]
+
+            for path in paths:
+
+                self._add_file(obsid, file_type, path)
+
+        with self._connect() as connection:
+
+            connection.execute("UPDATE obsids SET complete = 1, last_used = ? WHERE obsid = ?",
+                               (time.time(), int(obsid)))
+
+        self.evict(keep=[obsid])
+
+    def add_updated_event_file(self, obsid, filename):
+        """
+        Add the event file of an obsid updated by r4_header_update
+
+        :param obsid: the obsid
+        :param filename: path of the updated event file
+        :return: None
+        """
+
+        self._add_file(obsid, updated_event_file_type, filename)
+
+        self.evict(keep=[obsid])
+
+    def retrieve(self, obsid, directory):
+        """
+        Copy the files of the obsid in the directory, verifying their checksums. If the event file updated by
+        r4_header_update is available, it is served instead of the original one (and the ancillary files are not
+        copied, as they are not needed anymore)
+
+        :param obsid: the obsid
+        :param directory: destination directory
+        :return: dictionary file type -> path, like the output of download_manager.find_downloaded_files (with
+        header_updated = True if the event file has been updated), or None if the obsid is not in the mirror or some
+        of its files are corrupted
+        """
+
+        if not self.has(obsid):
+
+            return None
+
+        with self._connect() as connection:
+
+            rows = connection.execute("SELECT file_type, name, md5 FROM files WHERE obsid = ? ORDER BY name",
+                                      (int(obsid),)).fetchall()
+
+            connection.execute("UPDATE obsids SET last_used = ? WHERE obsid = ?", (time.time(), int(obsid)))
+
+        by_type = collections.defaultdict(list)
+
+        for file_type, name, md5 in rows:
+
+            by_type[file_type].append((name, md5))
+
+        header_updated = updated_event_file_type in by_type
+
+        if header_updated:
+
+            wanted = {'evt3': updated_event_file_type, 'tsv': 'tsv', 'exp3': 'exp3', 'fov3': 'fov3'}
+
+        else:
+
+            wanted = dict([(file_type, file_type) for file_type in raw_file_types])
+
+        files = {'header_updated': header_updated}
+
+        # Files copied so far (removed if one of the files turns out to be corrupted)
+
+        copied = []
+
+        for key, file_type in wanted.items():
+
+            paths = []
+
+            for name, md5 in by_type[file_type]:
+
+                destination = os.path.join(directory, name)
+
+                copied.append(destination)
+
+                try:
+
+                    source_md5, _ = _stream_copy(self._object_path(md5), destination)
+
+                except (IOError, OSError):
+
+                    source_md5 = None
+
+                if source_md5 != md5:
+
+                    logger.warning("File %s of obsid %s is corrupted in the mirror. Removing the obsid from the "
+                                   "mirror" % (name, obsid))
+
+                    self.remove(obsid)
+
+                    for path in copied:
+
+                        if os.path.exists(path):
+
+                            os.remove(path)
+
+                    return None
+
+                paths.append(destination)
+
+            files[key] = paths if key == 'asol' else paths[0]
+
+        return files
+
+    def remove(self, obsid):
+        """
+        Remove an obsid from the mirror (the files which are not used by other obsids are deleted)
+
+        :param obsid: the obsid
+        :return: None
+        """
+
+        with self._connect() as connection:
+
+            connection.execute("DELETE FROM files WHERE obsid = ?", (int(obsid),))
+
+            connection.execute("DELETE FROM obsids WHERE obsid = ?", (int(obsid),))
+
+        self._purge_objects()
+
+    def _purge_objects(self):
+
+        # Delete the stored files which do not belong to any obsid anymore
+
+        with self._connect() as connection:
+
+            orphans = connection.execute("SELECT md5 FROM objects WHERE md5 NOT IN (SELECT md5 FROM files)").fetchall()
+
+            for (md5,) in orphans:
+
+                if os.path.exists(self._object_path(md5)):
+
+                    os.remove(self._object_path(md5))
+
+                connection.execute("DELETE FROM objects WHERE md5 = ?", (md5,))
+
+    def evict(self, keep=()):
+        """
+        Remove the obsids used least recently until the mirror is smaller than its maximum size
+
+        :param keep: obsids which must not be removed
+        :return: list of the obsids removed
+        """
+
+        if self._max_size is None:
+
+            return []
+
+        removed = []
+
+        keep = set([int(obsid) for obsid in keep])
+
+        while self.size > self._max_size:
+
+            with self._connect() as connection:
+
+                candidates = [row[0] for row in
+                              connection.execute("SELECT obsid FROM obsids ORDER BY last_used").fetchall()
+                              if row[0] not in keep]
+
+            if len(candidates) == 0:
+
+                break
+
+            logger.info("Evicting obsid %s from the mirror" % candidates[0])
+
+            self.remove(candidates[0])
+
+            removed.append(candidates[0])
+
+        return removed
+
+
+class _Connection(object):
+
+    # A SQLite connection used as a context manager: commits (or rolls back) and closes at the end
+
+    def __init__(self, db_file):
+
+        self._connection = sqlite3.connect(db_file, timeout=600)
+
+    def __enter__(self):
+
+        return self._connection
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        try:
+
+            if exc_type is None:
+
+                self._connection.commit()
+
+            else:
+
+                self._connection.rollback()
+
+        finally:
+
+            self._connection.close()
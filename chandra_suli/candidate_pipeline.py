@@ -0,0 +1,367 @@
+"""
+Streaming pipeline for the candidates found by xtdac: hot pixel check, cross match with the known variable sources
+and addition to the master list. Each stage is a generator taking and yielding candidate records (ordered
+dictionaries column name -> value), so the stages can be chained and run in one process, without writing
+intermediate files:
+
+    records = read_records("ccd_3_1234_filtered_nohot_res.txt")
+    records = flag_hot_pixels(records, 1234, "ccd_3_1234_filtered_nohot.fits", runner)
+    records = flag_variable_sources(records, "ccd_3_1234_filtered_nohot.fits")
+
+    add_to_master_list(records, master_list)
+
+When the records are written to a file, the names of the columns are needed in case there are no records left: they
+are given by hot_pixel_columns and variable_source_columns
+"""
+
+import collections
+import glob
+import os
+
+import numpy as np
+
+from chandra_suli import chandra_psf
+from chandra_suli import offaxis_angle
+from chandra_suli.candidate_table import make_table, read_candidates, write_candidates
+from chandra_suli.chandra_catalog import get_catalog
+from chandra_suli.event_reader import EventFileReader, default_chunk_size
+from chandra_suli.event_slicer import get_slicer
+from chandra_suli.lazy_import import lazy_import
+from chandra_suli.logging_system import get_logger
+
+# sklearn is needed only for the candidates with few events, and astropy.units only when there are variable sources
+cluster = lazy_import("sklearn.cluster")
+pairwise = lazy_import("sklearn.metrics.pairwise")
+u = lazy_import("astropy.units")
+
+logger = get_logger("candidate_pipeline")
+
+
+def read_records(filename):
+    """
+    Yield the candidates contained in a file (in any format supported by candidate_table)
+
+    :param filename: the file
+    :return: generator of records
+    """
+
+    return iter_records(read_candidates(filename))
+
+
+def iter_records(data):
+    """
+    Yield the candidates contained in a candidate list
+
+    :param data: the candidate list (structured array, see candidate_table)
+    :return: generator of records
+    """
+
+    for row in data:
+
+        yield collections.OrderedDict(zip(data.dtype.names, row.tolist()))
+
+
+def _add_columns(column_names, new_column_names):
+
+    # Same order as the keys of a record with column_names to which new_column_names are assigned
+
+    return list(collections.OrderedDict.fromkeys(list(column_names) + list(new_column_names)).keys())
+
+
+def hot_pixel_columns(input_column_names):
+    """
+    Returns the names of the columns of the records yielded by flag_hot_pixels
+
+    :param input_column_names: names of the columns of the input records
+    :return: list of names
+    """
+
+    return _add_columns(_add_columns(['Candidate', 'Obsid', 'CCD'], input_column_names),
+                        ['Duration', 'N_events', 'Hot_Pixel_Flag'])
+
+
+def variable_source_columns(input_column_names):
+    """
+    Returns the names of the columns of the records yielded by flag_variable_sources
+
+    :param input_column_names: names of the columns of the input records
+    :return: list of names
+    """
+
+    return _add_columns(input_column_names, ['Closest_Variable_Source', 'Separationarcsec', 'Var_msid', 'Theta',
+                                             'PSF_sizearcsec', 'PSFfrac'])
+
+
+def to_table(records, column_names=None):
+    """
+    Collect the records in a candidate list (structured array)
+
+    :param records: iterable of records
+    :param column_names: names of the columns, used when there are no records (so that the list still has its
+    columns). If None, an empty list has no columns
+    :return: structured array
+    """
+
+    records = list(records)
+
+    if len(records) == 0:
+
+        return make_table(list(column_names) if column_names is not None else [], [])
+
+    return make_table(list(records[0].keys()), [list(record.values()) for record in records])
+
+
+def write_records(filename, records, column_names=None):
+    """
+    Write the records to a file (in the format given by its extension), and yield them again, so this can be used
+    as a stage to save the intermediate results (for debugging)
+
+    :param filename: output file
+    :param records: iterable of records
+    :param column_names: names of the columns, written also when there are no records (see to_table)
+    :return: generator of records
+    """
+
+    records = list(records)
+
+    write_candidates(filename, to_table(records, column_names))
+
+    for record in records:
+
+        yield record
+
+
+def _neighbor_pixel_check(cluster_coords, max_distance=2):
+
+    # True if all the events in the cluster are closer than max_distance to each other
+
+    return bool(np.all(pairwise.euclidean_distances(cluster_coords, cluster_coords) < max_distance))
+
+
+def is_hot_pixel(coords):
+    """
+    Decide whether the events of a candidate come from a hot pixel, i.e., if all the clusters of events found by
+    DBSCAN are contained within neighboring pixels
+
+    :param coords: array of (chipx, chipy) of the events (less than 15)
+    :return: True or False
+    """
+
+    labels = cluster.DBSCAN(eps=2, min_samples=2).fit(coords).labels_
+
+    labels_unique = np.unique(labels)
+
+    if len(labels_unique) > 1:
+
+        # More than one cluster found (or one cluster plus noise). Noise is not considered
+
+        labels_unique = labels_unique[labels_unique != -1]
+
+        return all([_neighbor_pixel_check(coords[labels == label]) for label in labels_unique])
+
+    else:
+
+        return _neighbor_pixel_check(coords)
+
+
+def _get_region_files(evtfile, region_dir):
+
+    # Region files for each candidate produced by xtdac, sorted by candidate number
+
+    evt_file_name = os.path.splitext(os.path.basename(evtfile))[0]
+
+    reg_files = glob.glob(os.path.join(region_dir, '%s_candidate*reg' % evt_file_name))
+
+    return sorted(reg_files, key=lambda s: int(os.path.splitext(s)[0].split("_")[-1]))
+
+
+def _get_ccd_number(evtfile):
+
+    # Find CCD number based on file name
+
+    names = os.path.splitext(os.path.basename(evtfile))[0].split("_")
+
+    return int(names[names.index("ccd") + 1])
+
+
+def flag_hot_pixels(records, obsid, evtfile, runner, region_dir='.', debug=False, chunk_size=default_chunk_size):
+    """
+    Check whether the candidates are hot pixels. The output records start with the columns Candidate, Obsid and
+    CCD, followed by the input columns and by Duration, N_events and Hot_Pixel_Flag
+
+    :param records: records from the xtdac list of candidates for one CCD (in the same order as the list)
+    :param obsid: the obsid
+    :param evtfile: the event file for the CCD
+    :param runner: a CommandRunner instance
+    :param region_dir: directory containing the region files of the candidates
+    :param debug: if True, keep the temporary files
+    :param chunk_size: number of rows of the event files read at once
+    :return: generator of records
+    """
+
+    reg_files_sorted = _get_region_files(evtfile, region_dir)
+
+    ccd_num = _get_ccd_number(evtfile)
+
+    slicer = get_slicer(evtfile, chunk_size=chunk_size)
+
+    # The region files are matched to the candidates by position (the n-th region file is for the n-th candidate),
+    # so their number must be the same as the number of candidates
+
+    n_records = 0
+
+    for n, record in enumerate(records):
+
+        n_records = n + 1
+
+        if n >= len(reg_files_sorted):
+
+            raise RuntimeError("Found only %s region files for the candidates of %s in %s, but there are more "
+                               "candidates than that" % (len(reg_files_sorted), evtfile, os.path.abspath(region_dir)))
+
+        reg_file = reg_files_sorted[n]
+
+        tstart = record['Tstart']
+        tstop = record['Tstop']
+
+        temp_reg_file = "temp_reg_%s.fits" % (n + 1)
+
+        # Make temporary fits region file with region determined by xtdac. The time interval is selected
+        # with a binary search on TIME, so regfilter runs only on the events in the interval
+
+        time_slice = slicer.get_file(tstart, tstop)
+
+        cmd_line = 'ftcopy \"%s[EVENTS][regfilter(\'%s\')]\" %s clobber=yes ' % (time_slice, reg_file, temp_reg_file)
+
+        runner.run(cmd_line)
+
+        slicer.release_file(time_slice)
+
+        reg_reader = EventFileReader(temp_reg_file, chunk_size=chunk_size)
+
+        coords = np.vstack([reg_reader.read_column('chipx'), reg_reader.read_column('chipy')]).T
+
+        if not debug:
+
+            os.remove(temp_reg_file)
+
+        # Count number of events in the region in this time interval
+
+        n_events = coords.shape[0]
+
+        if n_events == 0:
+
+            logger.warning("%s had no events between %s and %s!" % (reg_file, tstart, tstop))
+
+            hot_pix_flag = False
+
+        elif n_events < 15:
+
+            hot_pix_flag = is_hot_pixel(coords)
+
+        else:
+
+            hot_pix_flag = False
+
+        out_record = collections.OrderedDict([('Candidate', n + 1), ('Obsid', obsid), ('CCD', ccd_num)])
+
+        out_record.update(record)
+
+        out_record['Duration'] = round(tstop - tstart, 1)
+        out_record['N_events'] = int(n_events)
+        out_record['Hot_Pixel_Flag'] = bool(hot_pix_flag)
+
+        yield out_record
+
+    if n_records != len(reg_files_sorted):
+
+        raise RuntimeError("Found %s region files for the candidates of %s in %s, but there are %s candidates"
+                           % (len(reg_files_sorted), evtfile, os.path.abspath(region_dir), n_records))
+
+
+def flag_variable_sources(records, eventfile, csc=None, psf=None):
+    """
+    Cross match the candidates with the variable sources in the Chandra Source Catalog. The columns
+    Closest_Variable_Source, Separationarcsec, Var_msid, Theta, PSF_sizearcsec and PSFfrac are added
+
+    :param records: records with the hot pixel flag (output of flag_hot_pixels)
+    :param eventfile: event file (needed to gather the pointing of Chandra)
+    :param csc: a ChandraSourceCatalog instance (if None, the one shared by this process is used)
+    :param psf: a ChandraPSF instance (if None, the one shared by this process is used)
+    :return: generator of records
+    """
+
+    if csc is None:
+
+        csc = get_catalog()
+
+    if psf is None:
+
+        psf = chandra_psf.get_psf()
+
+    for record in records:
+
+        ra = record['RA']
+        dec = record['Dec']
+
+        # Compute the radius of the PSF at the off-axis angle of this source
+
+        theta = offaxis_angle.get_offaxis_angle(ra, dec, eventfile)  # arcmin
+
+        psf_size = psf.get_psf_size(theta, percent_level=0.95)
+
+        # Default values, used when there is no variable source nearby (or for hot pixels)
+
+        src_name, src_sepn, src_msid, psf_frac = "None", -1.0, 0, 1.0
+
+        if record['Hot_Pixel_Flag'] != True:
+
+            # search_csc has a max search radius of 60, so put upper bound on input
+
+            radius = 5.0
+
+            variable_sources = csc.find_variable_sources(ra, dec, radius, unit='arcmin', column='var_flag')
+
+            if variable_sources.shape[0] > 0:
+
+                closest_variable_source = csc.find_closest_variable_source(ra, dec)
+
+                # Get the name/separation/msid of the closest variable source
+
+                src_name = closest_variable_source['name']
+                src_sepn = float((closest_variable_source['distance'] * u.arcmin).to(u.arcsec).value)
+                src_msid = closest_variable_source['msid']
+
+                # Replace any space in the name with an underscore
+                src_name = src_name.replace(" ", "_")
+
+                psf_frac = float(psf.get_psf_fraction(theta, src_sepn))
+
+        out_record = collections.OrderedDict(record)
+
+        out_record['Closest_Variable_Source'] = src_name
+        out_record['Separationarcsec'] = src_sepn
+        out_record['Var_msid'] = src_msid
+        out_record['Theta'] = theta
+        out_record['PSF_sizearcsec'] = psf_size
+        out_record['PSFfrac'] = psf_frac
+
+        yield out_record
+
+
+def add_to_master_list(records, master_list):
+    """
+    Add (or replace) the candidates in the master list
+
+    :param records: records with all the columns of the master list (output of flag_variable_sources)
+    :param master_list: a MasterList instance
+    :return: number of candidates added
+    """
+
+    data = to_table(records)
+
+    if len(data) == 0:
+
+        return 0
+
+    return master_list.upsert(data.dtype.names, data)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""
+Read and write lists of candidates (the output of xtdac and of the following filtering stages, the master list...).
+
+The lists are numpy structured arrays. They are stored in a typed binary format, chosen according to the extension of
+the file: .npy (numpy structured array) or .fits/.fit (FITS binary table). Any other extension is the legacy text
+format (a commented header with the column names, then one row per line), which is still read and written for
+compatibility and for inspection. Floating point numbers are written in the text format with all their digits, so
+times do not lose precision.
+
+When run as a script, this module benchmarks the formats against the text format read with np.recfromtxt
+"""
+
+import os
+import time
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+# Characters removed from the column names by np.recfromtxt. The same are removed here, so the names are the same
+# whatever the format
+_deletechars = set("""~!@#$%^&*()-=+~\\|]}[{';: /?.>,<""")
+
+_npy_extensions = ['.npy']
+_fits_extensions = ['.fits', '.fit']
+
+
+def sanitize_column_name(name):
+    """
+    Returns the name of the column as np.recfromtxt would read it from the text format (for example
+    Separation(arcsec) becomes Separationarcsec)
+    """
+
+    name = name.strip().replace(" ", "_")
+
+    return "".join([c for c in name if c not in _deletechars])
+
+
+def _get_format(filename):
+
+    extension = os.path.splitext(filename)[1].lower()
+
+    if extension in _npy_extensions:
+
+        return 'npy'
+
+    elif extension in _fits_extensions:
+
+        return 'fits'
+
+    else:
+
+        return 'text'
+
+
+def _to_python(value):
+
+    if hasattr(value, 'item'):
+
+        value = value.item()
+
+    if isinstance(value, bytes) and bytes is not str:
+
+        value = value.decode()
+
+    return value
+
+
+def format_value(value):
+    """
+    Returns the representation of a value in the text format
+    """
+
+    value = _to_python(value)
+
+    if isinstance(value, float):
+
+        # repr gives the shortest representation which reads back to the same number
+
+        return repr(value)
+
+    else:
+
+        return str(value)
+
+
+def make_table(column_names, rows, dtypes=None):
+    """
+    Make a candidate list from a list of rows
+
+    :param column_names: names of the columns
+    :param rows: list of rows (tuples or lists of values, one for each column)
+    :param dtypes: types of the columns. If None, they are inferred from the values (and they are float if there
+    are no rows)
+    :return: a structured array
+    """
+
+    column_names = [sanitize_column_name(name) for name in column_names]
+
+    if dtypes is not None:
+
+        dtype = list(zip(column_names, dtypes))
+
+        return np.array([tuple(row) for row in rows], dtype=dtype)
+
+    if len(rows) == 0:
+
+        return np.zeros(0, dtype=[(name, float) for name in column_names])
+
+    columns = []
+
+    for i in range(len(column_names)):
+
+        columns.append(np.array([_to_python(row[i]) for row in rows]))
+
+    return _from_columns(column_names, columns)
+
+
+def _from_columns(column_names, columns):
+
+    data = np.zeros(len(columns[0]), dtype=[(name, column.dtype) for name, column in zip(column_names, columns)])
+
+    for name, column in zip(column_names, columns):
+
+        data[name] = column
+
+    return data
+
+
+def add_columns(data, column_names, columns):
+    """
+    Returns a new candidate list with the columns appended
+
+    :param data: the candidate list
+    :param column_names: names of the new columns
+    :param columns: the values for the new columns (one sequence for each column, with the same length as data)
+    :return: a new structured array
+    """
+
+    arrays = [data[name] for name in data.dtype.names] + [np.asarray(column) for column in columns]
+
+    return make_table(list(data.dtype.names) + list(column_names), list(zip(*arrays)) if len(data) > 0 else [],
+                      dtypes=[array.dtype for array in arrays])
+
+
+def export_text(filename, data, comments=None, header_prefix=""):
+    """
+    Write the candidate list in the legacy text format
+
+    :param filename: output file
+    :param data: the candidate list
+    :param comments: lines to write as comments at the end of the file (optional)
+    :param header_prefix: text written in the header before the column names (for example "Rank ")
+    :return: None
+    """
+
+    with open(filename, "w") as f:
+
+        f.write("# %s%s\n" % (header_prefix, " ".join(data.dtype.names)))
+
+        for row in data:
+
+            f.write("%s\n" % " ".join([format_value(value) for value in row]))
+
+        if comments is not None:
+
+            f.write("\n")
+
+            for comment in comments:
+
+                f.write("# %s\n" % comment)
+
+
+def write_candidates(filename, data, comments=None):
+    """
+    Write the candidate list, in the format corresponding to the extension of the file
+
+    :param filename: output file
+    :param data: the candidate list (structured array)
+    :param comments: comments (only for the text format)
+    :return: None
+    """
+
+    file_format = _get_format(filename)
+
+    if file_format == 'npy':
+
+        with open(filename, "wb") as f:
+
+            np.save(f, np.asarray(data))
+
+    elif file_format == 'fits':
+
+        pyfits.BinTableHDU(data=np.asarray(data), name='CANDIDATES').writeto(filename, overwrite=True)
+
+    else:
+
+        export_text(filename, data, comments)
+
+
+def read_candidates(filename):
+    """
+    Read a candidate list, in the format corresponding to the extension of the file
+
+    :param filename: input file
+    :return: structured array (always one-dimensional, also when there is only one candidate)
+    """
+
+    file_format = _get_format(filename)
+
+    if file_format == 'npy':
+
+        data = np.load(filename)
+
+    elif file_format == 'fits':
+
+        with pyfits.open(filename, memmap=False) as f:
+
+            table = f['CANDIDATES'].data
+
+            # Going through the columns converts the FITS logical values to booleans
+
+            data = _from_columns(table.names, [np.array(table.field(name)) for name in table.names])
+
+    else:
+
+        if _has_no_rows(filename):
+
+            # np.recfromtxt cannot read a file with no rows
+
+            with open(filename) as f:
+
+                column_names = _header_columns(f.readline())
+
+            return np.zeros(0, dtype=[(name, float) for name in column_names])
+
+        # Same as np.recfromtxt(filename, names=True)
+
+        data = np.genfromtxt(filename, dtype=None, names=True)
+
+    return np.array(data, ndmin=1).view(np.ndarray)
+
+
+def _header_columns(header):
+
+    # Column names in the header of the text format
+
+    return [sanitize_column_name(name) for name in header.lstrip("#").split()]
+
+
+def _has_no_rows(filename):
+
+    with open(filename) as f:
+
+        for line in f:
+
+            line = line.strip()
+
+            if len(line) > 0 and not line.startswith("#"):
+
+                return False
+
+    return True
+
+
+def _benchmark(n_rows=100000, directory="."):
+
+    # Typical candidate list
+    rows = [(i, 1234, 3, 1, 123.456789123 + i * 1e-6, -45.123456789, 4.5e8 + i * 0.123456789,
+             4.5e8 + i * 0.123456789 + 12.3456789, 1e-5, i % 2 == 0) for i in range(n_rows)]
+
+    names = ['Candidate', 'Obsid', 'CCD', 'Region', 'RA', 'Dec', 'Tstart', 'Tstop', 'Probability', 'Hot_Pixel_Flag']
+
+    data = make_table(names, rows)
+
+    print("Benchmark with %s candidates" % n_rows)
+
+    # The text format is read like np.recfromtxt does
+
+    for extension in ['.txt', '.npy', '.fits']:
+
+        filename = os.path.join(directory, "__candidate_benchmark%s" % extension)
+
+        start = time.time()
+        write_candidates(filename, data)
+        write_time = time.time() - start
+
+        start = time.time()
+        read_back = read_candidates(filename)
+        read_time = time.time() - start
+
+        assert np.array_equal(read_back['Tstart'], data['Tstart'])
+
+        print("%5s: write %8.0f rows/s, read %8.0f rows/s, %6.1f MB" % (extension, n_rows / write_time,
+                                                                         n_rows / read_time,
+                                                                         os.path.getsize(filename) / 1024.0 ** 2))
+
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+
+    _benchmark()
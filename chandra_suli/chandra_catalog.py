@@ -2,8 +2,11 @@ import cPickle
 import gzip
 import os
 
-import astropy.units as u
-from astropy.coordinates import SkyCoord
+from chandra_suli.lazy_import import lazy_import
+
+# The catalog (and with it pandas and astropy.coordinates) is loaded only when a ChandraSourceCatalog is created
+u = lazy_import("astropy.units")
+coordinates = lazy_import("astropy.coordinates")
 
 
 class ChandraSourceCatalog(object):
@@ -43,7 +46,7 @@ class ChandraSourceCatalog(object):
 
         # Instance the SkyCoord instance
 
-        cone_center = SkyCoord(ra=ra, dec=dec, unit='deg')
+        cone_center = coordinates.SkyCoord(ra=ra, dec=dec, unit='deg')
 
         # Find all sources within the requested cone
 
@@ -142,3 +145,23 @@ class ChandraSourceCatalog(object):
         src_id = variable_sources['distance'].argmin()
 
         return variable_sources.loc[src_id, :]
+
+
+# The catalog shared by all the users in this process (see get_catalog)
+_catalog = None
+
+
+def get_catalog():
+    """
+    Returns the ChandraSourceCatalog instance of this process, loading the catalog only the first time
+
+    :return: a ChandraSourceCatalog instance
+    """
+
+    global _catalog
+
+    if _catalog is None:
+
+        _catalog = ChandraSourceCatalog()
+
+    return _catalog
@@ -1,5 +1,8 @@
-import caldb4
-import psf
+from chandra_suli.lazy_import import lazy_import
+
+# CIAO modules, loaded when the first ChandraPSF is created
+caldb4 = lazy_import("caldb4")
+psf = lazy_import("psf")
 
 
 class ChandraPSF(object):
@@ -25,3 +28,23 @@ class ChandraPSF(object):
 
     def get_psf_fraction(self, angle_in_arcmin, distance_in_arcsec, energy_in_kev=1.5, phi=0.0):
         return psf.psfFrac(self._pdata, energy_in_kev, angle_in_arcmin, phi, distance_in_arcsec)
+
+
+# The PSF shared by all the users in this process (see get_psf)
+_psf = None
+
+
+def get_psf():
+    """
+    Returns the ChandraPSF instance of this process, initializing the PSF library only the first time
+
+    :return: a ChandraPSF instance
+    """
+
+    global _psf
+
+    if _psf is None:
+
+        _psf = ChandraPSF()
+
+    return _psf
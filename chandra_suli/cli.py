@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+Single entry point for all the steps of the pipeline:
+
+    chandra-suli farm_step2 -d data --obsid 1234 ...
+
+is equivalent to farm_step2.py -d data --obsid 1234 ... Each step can also be run from Python with
+run_step("farm_step2", ["-d", "data", "--obsid", "1234", ...]).
+
+The steps run in the calling process. When a step runs another one of our steps through a CommandRunner (like
+farm_step2.py running filter_event_file.py, prefilter_hot_pixels.py and separate_CCD.py) the call is also executed
+in-process instead of in a new interpreter, so imports, loggers, the source catalog and the PSF are loaded once per
+run. Any other command (CIAO tools, ftools, xtdac...) is still executed in a shell.
+"""
+
+import argparse
+import os
+import runpy
+import shlex
+import subprocess
+import sys
+
+# Steps which can be run with the chandra-suli command (name of the script without .py)
+
+steps = ('add_to_masterlist',
+         'chandra_pipeline',
+         'check_hot_pixel_revised',
+         'check_variable_revised',
+         'create_regions_db',
+         'download_by_obsid',
+         'farm_step1',
+         'farm_step2',
+         'farm_step3',
+         'farm_step3_wrapper',
+         'farm_wrapper',
+         'filter_event_file',
+         'gif_generator',
+         'make_lightcurve',
+         'prefilter_hot_pixels',
+         'run_celldetect',
+         'run_vtpdetect',
+         'separate_CCD',
+         'startup_benchmark',
+         'submit_to_farm')
+
+# If a command line contains any of these characters it needs a shell (pipes, redirections, variables, wildcards...)
+_shell_characters = set("|&;<>()$`*?[]{}~\\\n")
+
+
+def run_step(name, arguments=()):
+    """
+    Run a step of the pipeline in this process, as if its script was executed with the given arguments. The current
+    working directory and sys.argv are restored afterwards
+
+    :param name: name of the step (with or without .py)
+    :param arguments: list of command line arguments for the step
+    :return: None. A subprocess.CalledProcessError is raised if the step exits with a non-zero exit code, like
+    subprocess.check_call would do
+    """
+
+    if name.endswith(".py"):
+
+        name = name[:-3]
+
+    if name not in steps:
+
+        raise ValueError("Unknown step %s. Known steps are: %s" % (name, ", ".join(steps)))
+
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+
+    sys.argv = ["%s.py" % name] + list(arguments)
+
+    try:
+
+        runpy.run_module("chandra_suli.%s" % name, run_name="__main__", alter_sys=True)
+
+    except SystemExit as exit_request:
+
+        # argparse and the scripts themselves exit with sys.exit
+
+        exit_code = exit_request.code
+
+        if exit_code is not None and exit_code != 0:
+
+            raise subprocess.CalledProcessError(exit_code if isinstance(exit_code, int) else 1,
+                                                " ".join(sys.argv))
+
+    finally:
+
+        sys.argv = saved_argv
+
+        os.chdir(saved_cwd)
+
+
+def split_command_line(cmd_line):
+    """
+    If the command line runs one of our steps, returns the name of the step and the arguments
+
+    :param cmd_line: a command line
+    :return: (name, list of arguments), or None if the command is not one of our steps or if it needs a shell
+    """
+
+    if len(_shell_characters.intersection(cmd_line)) > 0:
+
+        return None
+
+    tokens = shlex.split(cmd_line)
+
+    if len(tokens) == 0:
+
+        return None
+
+    name = os.path.basename(tokens[0])
+
+    if not name.endswith(".py") or name[:-3] not in steps:
+
+        return None
+
+    return name[:-3], tokens[1:]
+
+
+def run_command(cmd_line):
+    """
+    Execute a command line, in this process if it runs one of our steps, otherwise in a shell
+
+    :param cmd_line: the command line
+    :return: None. A subprocess.CalledProcessError is raised if the command fails
+    """
+
+    step = split_command_line(cmd_line)
+
+    if step is None:
+
+        subprocess.check_call(cmd_line, shell=True)
+
+    else:
+
+        run_step(*step)
+
+
+def main(argv=None):
+    """
+    Entry point of the chandra-suli command
+
+    :param argv: command line arguments (default: sys.argv[1:])
+    :return: the exit code
+    """
+
+    parser = argparse.ArgumentParser(prog="chandra-suli",
+                                     description="Run a step of the pipeline. Use chandra-suli [step] --help to get "
+                                                 "the options of a step. Steps: %s" % ", ".join(steps))
+
+    parser.add_argument("step", help="Step to run", choices=steps, metavar="step")
+    parser.add_argument("arguments", help="Arguments for the step", nargs=argparse.REMAINDER)
+
+    args = parser.parse_args(argv)
+
+    try:
+
+        run_step(args.step, args.arguments)
+
+    except subprocess.CalledProcessError as error:
+
+        return error.returncode
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
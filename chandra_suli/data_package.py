@@ -1,6 +1,8 @@
 import fnmatch
+import hashlib
 import os
 import shutil
+import zlib
 
 import yaml
 
@@ -12,6 +14,9 @@ logger = get_logger("DataPackage")
 
 _index_file = "index.yml"
 
+# Size of the blocks used when copying files (bytes)
+_chunk_size = 16 * 1024 * 1024
+
 
 def _check_directory(directory):
     sanitized_directory = sanitize_filename(directory)
@@ -23,6 +28,89 @@ def _check_directory(directory):
     return sanitized_directory
 
 
+def _stream_copy(source, destination, decompress=False):
+    """
+    Copy a file block by block, computing the checksums of the source and of the destination on the fly and
+    optionally decompressing a gzip file while copying
+
+    :param source: path of the file to copy
+    :param destination: path of the new file
+    :param decompress: if True, the source is a gzip file and the destination will be decompressed
+    :return: (md5 of the source, md5 of the destination)
+    """
+
+    source_md5 = hashlib.md5()
+    destination_md5 = hashlib.md5()
+
+    # 16 + MAX_WBITS tells zlib to expect a gzip header
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if decompress else None
+
+    with open(source, 'rb') as f_in, open(destination, 'wb') as f_out:
+
+        while True:
+
+            block = f_in.read(_chunk_size)
+
+            if not block:
+                break
+
+            source_md5.update(block)
+
+            if decompressor is not None:
+
+                block = decompressor.decompress(block)
+
+                # A gzip file can be made of more than one member
+
+                while decompressor.unused_data:
+
+                    leftover = decompressor.unused_data
+
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+                    block += decompressor.decompress(leftover)
+
+            destination_md5.update(block)
+
+            f_out.write(block)
+
+        if decompressor is not None:
+
+            block = decompressor.flush()
+
+            destination_md5.update(block)
+
+            f_out.write(block)
+
+    shutil.copymode(source, destination)
+
+    return source_md5.hexdigest(), destination_md5.hexdigest()
+
+
+def md5sum(filename):
+    """
+    Compute the md5 checksum of a file, reading it block by block
+
+    :param filename:
+    :return: md5 checksum (hex digest)
+    """
+
+    md5 = hashlib.md5()
+
+    with open(filename, 'rb') as f:
+
+        while True:
+
+            block = f.read(_chunk_size)
+
+            if not block:
+                break
+
+            md5.update(block)
+
+    return md5.hexdigest()
+
+
 class File(object):
     def __init__(self, filename, description):
         self._filename = sanitize_filename(filename)
@@ -238,26 +326,86 @@ class DataPackage(object):
 
         orig_file = File(filename, description)
 
-        # Move the file inside the package
+        # Move the file inside the package, computing its checksum
 
         if move:
 
             new_file = orig_file.move_to(self._directory)
 
+            checksum = md5sum(new_file.filename)
+
         else:
 
-            new_file = orig_file.copy_to(self._directory)
+            new_path = os.path.join(self._directory, os.path.basename(orig_file.filename))
+
+            _, checksum = _stream_copy(orig_file.filename, new_path)
+
+            new_file = File(new_path, orig_file.description)
 
-        # Register it in the dictionary (using a relative path)
+        self._register(tag, new_file.filename, orig_file.description, checksum)
 
-        relative_path = os.path.relpath(new_file.filename, self._directory)
+    def _register(self, tag, filename, description, checksum):
 
-        self._status['index'][tag] = {'path': relative_path, 'description': orig_file.description}
+        # Register a file which is already in the package directory (using a relative path)
+
+        relative_path = os.path.relpath(filename, self._directory)
+
+        self._status['index'][tag] = {'path': relative_path, 'description': description, 'md5': checksum}
 
         # Save to the index file
 
         self._save_status()
 
+    def remove(self, tag):
+        """
+        Remove the file corresponding to the tag from the package
+
+        :param tag:
+        :return: None
+        """
+
+        self._load_status()
+
+        if self.read_only:
+            raise RuntimeError("Trying to modifying a read-only package")
+
+        assert tag in self._status['index'], "Tag %s does not exists in data package: \n%s" % (tag, self)
+
+        path = self._get_abs_path(tag)
+
+        self._status['index'].pop(tag)
+
+        os.remove(path)
+
+        self._save_status()
+
+    def transfer(self, tag, other_package):
+        """
+        Move the file corresponding to the tag from this package to another one (replacing the file with the same
+        tag in the other package, if any)
+
+        :param tag:
+        :param other_package: a DataPackage instance
+        :return: None
+        """
+
+        self._load_status()
+
+        if self.read_only:
+            raise RuntimeError("Trying to modifying a read-only package")
+
+        assert tag in self._status['index'], "Tag %s does not exists in data package: \n%s" % (tag, self)
+
+        if other_package.has(tag):
+
+            other_package.remove(tag)
+
+        other_package.store(tag, self._get_abs_path(tag), self._status['index'][tag]['description'], move=True)
+
+        self._status['index'].pop(tag)
+
+        self._save_status()
+
     def update(self, tag, filename):
         """
         Update a file which is already in the package
@@ -312,15 +460,24 @@ class DataPackage(object):
             # If we are here the store has worked out fine, remove the temp file
             os.remove(temp_backup)
 
-    def get(self, tag, dest_dir=None):
+    def get(self, tag, dest_dir=None, decompress=False):
         """
-        Retrieve a file by tag from the data package
+        Retrieve a file by tag from the data package. The copy is verified against the checksum stored in the index
+        (packages created before checksums were introduced are not verified)
 
         :param tag:
         :param dest_dir: if None, use current workdir, otherwise use the one provided, as destination dir. for the file
+        :param decompress: if True and the file is gzip-compressed, decompress it while copying (the .gz extension
+        is removed from the name)
         :return: a File instance
         """
 
+        out_file, _ = self._get(tag, dest_dir, decompress)
+
+        return out_file
+
+    def _get(self, tag, dest_dir, decompress):
+
         self._load_status()
 
         assert tag in self._status['index'], "Tag %s does not exists in data package: \n%s" % (tag, self)
@@ -329,19 +486,82 @@ class DataPackage(object):
 
         abs_path = self._get_abs_path(tag)
 
-        this_file = File(abs_path, item['description'])
-
         if dest_dir is not None:
 
-            dest = sanitize_filename(dest_dir)
+            dest = _check_directory(dest_dir)
 
         else:
 
             dest = os.getcwd()
 
-        out_file = this_file.copy_to(dest)
+        name = os.path.basename(abs_path)
 
-        return out_file
+        if decompress and name.endswith(".gz"):
+
+            name = name[:-3]
+
+        else:
+
+            decompress = False
+
+        new_path = os.path.join(dest, name)
+
+        if new_path == abs_path:
+
+            # Nothing to copy
+
+            return File(abs_path, item['description']), item.get('md5')
+
+        source_md5, destination_md5 = _stream_copy(abs_path, new_path, decompress=decompress)
+
+        if 'md5' in item and source_md5 != item['md5']:
+
+            os.remove(new_path)
+
+            raise IOError("Checksum mismatch for %s (tag %s): the file is corrupted" % (abs_path, tag))
+
+        return File(new_path, item['description']), destination_md5
+
+    def get_path(self, tag):
+        """
+        Returns the absolute path of the file corresponding to the tag, without copying it. Use this only to read
+        the file (for example its header), never to modify it
+
+        :param tag:
+        :return: absolute path of the file inside the package
+        """
+
+        self._load_status()
+
+        assert tag in self._status['index'], "Tag %s does not exists in data package: \n%s" % (tag, self)
+
+        return self._get_abs_path(tag)
+
+    def stage(self, new_directory, tags, decompress=False):
+        """
+        Copy only some of the files of the data package to another directory, creating a new package with the same
+        name which contains only those files
+
+        :param new_directory: destination path. The new package will be created, with the name of this package,
+        inside this directory, which must already exist
+        :param tags: list of tags to copy
+        :param decompress: if True, decompress gzip-compressed files while copying
+        :return: the instance of the new package
+        """
+
+        directory = _check_directory(new_directory)
+
+        package_name = os.path.split(self._directory)[-1]
+
+        new_package = DataPackage(os.path.join(directory, package_name), create=True)
+
+        for tag in tags:
+
+            new_file, checksum = self._get(tag, new_package.location, decompress)
+
+            new_package._register(tag, new_file.filename, new_file.description, checksum)
+
+        return new_package
 
     def copy_to(self, new_directory):
         """
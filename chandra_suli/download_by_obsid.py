@@ -14,22 +14,22 @@ import argparse
 import os
 import shutil
 import sys
+import time
 import warnings
 
-import work_within_directory
-from chandra_suli import find_files
 from chandra_suli import logging_system
+from chandra_suli.archive_mirror import ArchiveMirror
+from chandra_suli.download_manager import apply_compression_policy, disk_use, fetch_from_archive, get_files, \
+    update_header
 from chandra_suli.run_command import CommandRunner
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Download event files and exposure map from the Chandra catalog')
     parser.add_argument("--obsid", help="Observation ID Numbers", type=int, required=True)
-
-    # Some of the commands need a temporary directory to write files, defined in ASCDS_WORK_PATH.
-    # Enforce that such a variable is defined in the current environment
-    if os.environ.get("ASCDS_WORK_PATH") is None:
-        raise RuntimeError("You need to set the env. variable ASCDS_WORK_PATH to a writeable temporary directory")
+    parser.add_argument("--mirror", help="Directory of a local mirror of the archive. If the obsid is in the mirror "
+                                         "it is not downloaded again, otherwise it is added to it", type=str,
+                        default=None, required=False)
 
     # Get logger for this command
 
@@ -53,68 +53,43 @@ if __name__ == "__main__":
 
         warnings.warn("The directory %s already exists" % temp_dir)
 
-    with work_within_directory.work_within_directory(temp_dir):
-
-        work_dir = os.path.abspath(os.getcwd())
-
-        # Download exposure map
+    mirror = ArchiveMirror(args.mirror) if args.mirror is not None else None
 
-        cmd_line = ("obsid_search_csc obsid=%d download=all outfile=%d.tsv filetype=exp,evt,fov "
-                    "mode=h clobber=yes verbose=0 "
-                    "columns=m.ra,m.dec,o.theta,m.extent_flag,m.var_flag"
-                    % (args.obsid, args.obsid))
+    # Download event file, exposure map, FOV file, list of sources and the ancillary files needed by the
+    # r4_header_update script (or get them from the mirror)
 
-        runner.run(cmd_line)
+    def fetch(obsid, directory):
 
-        # Download ancillary files needed by the r4_header_update script
-        cmd_line = "download_chandra_obsid %d asol,pbk -q" % (args.obsid)
+        fetch_from_archive(obsid, directory, runner)
 
-        runner.run(cmd_line)
+    start = time.time()
 
-    # get paths of files
-    evt3_files = find_files.find_files(work_dir, '*%s*evt3.fits.gz' % args.obsid)
-    tsv_files = find_files.find_files(work_dir, "%d.tsv" % args.obsid)
-    exp_files = find_files.find_files(work_dir, "*%s*exp3.fits.gz" % args.obsid)
-    asol_files = find_files.find_files(work_dir, '*asol*.fits.gz')
-    pbk_files = find_files.find_files(work_dir, '*pbk*.fits.gz')
-    fov_files = find_files.find_files(work_dir, "*%s*fov3.fits.gz" % args.obsid)
+    files = get_files(args.obsid, os.path.abspath(temp_dir), fetch, mirror)
 
-    if len(evt3_files) > 1 or len(tsv_files) > 1 or len(exp_files) > 1 or len(pbk_files) > 1 or len(fov_files) > 1:
+    downloaded = time.time()
 
-        raise RuntimeError("More than one event file in this tree. Did you clean up the directory before running "
+    downloaded_size = disk_use([temp_dir])
 
-                           "this script?")
+    # Decompress the event file, the exposure map and the FOV file once here, instead of at every later read (see
+    # download_manager.compression_policy)
 
-    elif len(evt3_files) == 0 or len(tsv_files) == 0 or len(exp_files) == 0 or len(asol_files) == 0 \
-            or len(pbk_files) == 0 or len(fov_files) == 0:
-
-        raise RuntimeError("Could not find some of the downloaded files. Maybe download failed?")
-
-    else:
+    apply_compression_policy(files)
 
-        evt3 = evt3_files[0]
-        tsv = tsv_files[0]
-        exp = exp_files[0]
-        asol = ",".join(asol_files)
-        pbk = pbk_files[0]
-        fov = fov_files[0]
+    decompressed = time.time()
 
-    # The r4_header_update script cannot run on a compressed fits file, so decompress the eventfile
+    # Run reprocessing (unless the mirror has the updated file already)
 
-    cmd_line = "gunzip %s" % evt3
-
-    runner.run(cmd_line)
-
-    evt3 = evt3.replace("fits.gz", "fits")
-
-    # Run reprocessing
-    cmd_line = "r4_header_update infile=%s pbkfile=%s asolfile=%s" % (evt3, pbk, asol)
-
-    runner.run(cmd_line)
+    update_header(files, runner, args.obsid, mirror)
 
     # move evt3 file and delete empty directories
 
-    for this_file in [evt3, tsv, exp, fov]:
-        os.rename(this_file, os.path.basename(this_file))
+    for tag in ['evt3', 'tsv', 'exp3', 'fov3']:
+        os.rename(files[tag], os.path.basename(files[tag]))
 
     shutil.rmtree(temp_dir)
+
+    logger.info("Obsid %s done in %.1f s (download %.1f s, decompression %.1f s, header update %.1f s). "
+                "Downloaded %.1f MB, stored %.1f MB"
+                % (args.obsid, time.time() - start, downloaded - start, decompressed - downloaded,
+                   time.time() - decompressed, downloaded_size / 1024.0 ** 2,
+                   disk_use([os.path.basename(files[tag]) for tag in ['evt3', 'tsv', 'exp3', 'fov3']]) / 1024.0 ** 2))
@@ -0,0 +1,774 @@
+"""
+Download the data of many obsids from the Chandra archive.
+
+The DownloadManager fetches the files of several obsids at the same time (a bounded pool of threads, the work is
+done by the archive tools or by the network) and processes them in order in the calling thread (decompression,
+r4_header_update and storage in a DataPackage). The downloads run ahead of the processing by a bounded number of
+obsids (the prefetch queue), so the header update of one obsid overlaps with the downloads of the following ones
+without filling the disk. Failed downloads are retried with an exponential backoff, and the obsids whose data
+package is already complete are skipped.
+
+Each type of file is stored compressed or not according to how it is used later (see compression_policy). The
+files that the following steps read many times (the event file, which r4_header_update cannot even read compressed,
+and the exposure map and FOV file, read by several tools for each CCD) are decompressed once here instead of at every
+read. The decompression is a streaming stage: with a UrlArchive the files are decompressed block by block while they
+are downloaded, otherwise they are decompressed by the download threads as soon as the download of the obsid is
+over, at the same time as the downloads of the other obsids. The time spent in each stage and the disk used by each
+obsid are logged and available in DownloadManager.statistics.
+
+The archive is accessed through a fetch function, fetch(obsid, directory), which downloads the files of the obsid
+in the (empty) directory. fetch_from_archive uses the CIAO tools. A UrlArchive (for example on a file:// or on a
+local http:// mirror) can be used instead, for testing or to download from a mirror. If an ArchiveMirror is
+provided, the obsids (and their updated event files) are served from it when present, and added to it after the
+download.
+"""
+
+import collections
+import fnmatch
+import glob
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+try:
+
+    from urllib.request import urlopen
+    from urllib.parse import urljoin
+
+except ImportError:
+
+    from urllib2 import urlopen
+    from urlparse import urljoin
+
+from chandra_suli import find_files
+from chandra_suli.data_package import DataPackage, _stream_copy
+from chandra_suli.lazy_import import lazy_import
+from chandra_suli.logging_system import get_logger
+from chandra_suli.run_command import CommandRunner
+
+# Needed only for the tile compression
+pyfits = lazy_import("astropy.io.fits")
+
+logger = get_logger("download_manager")
+
+# Tags and descriptions of the files stored in the data package of each obsid
+package_content = collections.OrderedDict([('evt3', "Event file (Level 3) from the CSC"),
+                                           ('tsv', "TSV file from the CSC"),
+                                           ('exp3', "Exposure map (Level 3) from the CSC"),
+                                           ('fov3', "FOV file (Level 3) from the CSC")])
+
+# How each type of file is stored:
+#   keep: as it comes from the archive
+#   uncompress: decompressed (files read many times, or which must be read uncompressed)
+#   compress: gzip-compressed (files read rarely and sequentially)
+#   tile: FITS tile compression (images: smaller, but parts of them can still be read without decompressing it all.
+#         Note that a primary image becomes the first extension)
+compression_policy = {'evt3': 'uncompress',
+                      'exp3': 'uncompress',
+                      'fov3': 'uncompress',
+                      'tsv': 'keep',
+                      'asol': 'keep',
+                      'pbk': 'keep'}
+
+# Patterns used to recognize the type of a file from its name
+_file_type_patterns = collections.OrderedDict([('evt3', '*evt3.fits*'),
+                                               ('exp3', '*exp3.fits*'),
+                                               ('fov3', '*fov3.fits*'),
+                                               ('tsv', '*.tsv'),
+                                               ('asol', '*asol*.fits*'),
+                                               ('pbk', '*pbk*.fits*')])
+
+# Size of the blocks used when downloading from a URL (bytes)
+_chunk_size = 16 * 1024 * 1024
+
+
+def fetch_from_archive(obsid, directory, runner=None):
+    """
+    Download the files of an obsid from the Chandra archive with the CIAO tools (obsid_search_csc and
+    download_chandra_obsid). Make sure CIAO is running before using this
+
+    :param obsid: the obsid
+    :param directory: the directory where to download the files
+    :param runner: a CommandRunner instance (optional)
+    :return: None
+    """
+
+    # Some of the commands need a temporary directory to write files, defined in ASCDS_WORK_PATH.
+    # Enforce that such a variable is defined in the current environment
+    if os.environ.get("ASCDS_WORK_PATH") is None:
+
+        raise RuntimeError("You need to set the env. variable ASCDS_WORK_PATH to a writeable temporary directory")
+
+    if runner is None:
+
+        runner = CommandRunner(logger)
+
+    directory = os.path.abspath(directory)
+
+    # Several downloads can run at the same time, so each one uses its own copy of the parameter files (PFILES is
+    # "user dir;system dir", and the tools write their parameters in the user dir)
+
+    for par_file in glob.glob(os.path.join(os.path.expanduser('~/pfiles'), '*.par')):
+
+        shutil.copy(par_file, directory)
+
+    pfiles = "%s;%s" % (directory, os.environ.get("PFILES", "").split(";")[-1])
+
+    # Download event file, exposure map, FOV file and list of sources
+
+    cmd_line = ("cd %s && PFILES='%s' obsid_search_csc obsid=%d download=all outfile=%d.tsv filetype=exp,evt,fov "
+                "mode=h clobber=yes verbose=0 "
+                "columns=m.ra,m.dec,o.theta,m.extent_flag,m.var_flag"
+                % (directory, pfiles, obsid, obsid))
+
+    runner.run(cmd_line)
+
+    # Download ancillary files needed by the r4_header_update script
+    cmd_line = "cd %s && PFILES='%s' download_chandra_obsid %d asol,pbk -q" % (directory, pfiles, obsid)
+
+    runner.run(cmd_line)
+
+
+def get_file_type(filename):
+    """
+    Returns the type of a downloaded file (evt3, exp3, fov3, tsv, asol or pbk) from its name
+
+    :param filename: name or path of the file
+    :return: the type, or None if the file is not one of the known types
+    """
+
+    name = os.path.basename(filename)
+
+    for file_type, pattern in _file_type_patterns.items():
+
+        if fnmatch.fnmatch(name, pattern):
+
+            return file_type
+
+    return None
+
+
+def _decompress_blocks(blocks):
+
+    # Decompress a stream of gzip data block by block (a gzip file can be made of more than one member)
+
+    # 16 + MAX_WBITS tells zlib to expect a gzip header
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    for block in blocks:
+
+        block = decompressor.decompress(block)
+
+        while decompressor.unused_data:
+
+            leftover = decompressor.unused_data
+
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            block += decompressor.decompress(leftover)
+
+        yield block
+
+    yield decompressor.flush()
+
+
+def decompress_file(filename):
+    """
+    Decompress a gzip file block by block (without loading it in memory, and without an external gunzip). The
+    compressed file is removed
+
+    :param filename: path of the file (ending in .gz)
+    :return: path of the decompressed file
+    """
+
+    assert filename.endswith(".gz"), "%s is not a gzip file" % filename
+
+    decompressed = filename[:-3]
+
+    _stream_copy(filename, decompressed, decompress=True)
+
+    os.remove(filename)
+
+    return decompressed
+
+
+def compress_file(filename):
+    """
+    Compress a file with gzip, block by block. The uncompressed file is removed
+
+    :param filename: path of the file
+    :return: path of the compressed file (filename + .gz)
+    """
+
+    compressed = filename + ".gz"
+
+    with open(filename, 'rb') as f_in:
+
+        f_out = gzip.open(compressed, 'wb', 6)
+
+        try:
+
+            while True:
+
+                block = f_in.read(_chunk_size)
+
+                if not block:
+
+                    break
+
+                f_out.write(block)
+
+        finally:
+
+            f_out.close()
+
+    os.remove(filename)
+
+    return compressed
+
+
+def tile_compress_file(filename):
+    """
+    Apply the FITS tile compression (Rice) to the images in a FITS file. The other HDUs are copied unchanged
+
+    :param filename: path of the file. If it is gzip-compressed, it is decompressed first
+    :return: path of the tile-compressed file (same name, without .gz)
+    """
+
+    if filename.endswith(".gz"):
+
+        filename = decompress_file(filename)
+
+    file_descriptor, temp_file = tempfile.mkstemp(prefix="__tile_", suffix=".fits", dir=os.path.dirname(filename))
+
+    os.close(file_descriptor)
+
+    try:
+
+        with pyfits.open(filename) as hdulist:
+
+            new_hdus = [pyfits.PrimaryHDU(header=hdulist[0].header if hdulist[0].data is None else None)]
+
+            for hdu in hdulist:
+
+                if hdu.is_image and hdu.data is not None and not isinstance(hdu, pyfits.CompImageHDU):
+
+                    # A compressed image cannot be the primary HDU, so a primary image becomes an extension
+
+                    header = hdu.header.copy()
+
+                    for keyword in ('SIMPLE', 'EXTEND'):
+
+                        header.remove(keyword, ignore_missing=True)
+
+                    new_hdus.append(pyfits.CompImageHDU(data=hdu.data, header=header, compression_type='RICE_1'))
+
+                elif hdu is not hdulist[0]:
+
+                    new_hdus.append(hdu.copy())
+
+            pyfits.HDUList(new_hdus).writeto(temp_file, overwrite=True)
+
+        os.rename(temp_file, filename)
+
+    finally:
+
+        # If something failed, do not leave the temporary file in the data package
+
+        if os.path.exists(temp_file):
+
+            os.remove(temp_file)
+
+    return filename
+
+
+def apply_compression_policy(files, policy=None):
+    """
+    Compress or decompress the downloaded files according to the policy for their type
+
+    :param files: dictionary of files (output of find_downloaded_files or get_files). The paths are updated
+    :param policy: dictionary file type -> keep, uncompress, compress or tile (default: compression_policy)
+    :return: None
+    """
+
+    if policy is None:
+
+        policy = compression_policy
+
+    for file_type in _file_type_patterns:
+
+        if file_type not in files:
+
+            continue
+
+        action = policy.get(file_type, 'keep')
+
+        paths = files[file_type] if isinstance(files[file_type], list) else [files[file_type]]
+
+        new_paths = []
+
+        for path in paths:
+
+            if action == 'uncompress' and path.endswith(".gz"):
+
+                path = decompress_file(path)
+
+            elif action == 'compress' and not path.endswith(".gz"):
+
+                path = compress_file(path)
+
+            elif action == 'tile':
+
+                path = tile_compress_file(path)
+
+            elif action not in ('keep', 'uncompress', 'compress'):
+
+                raise ValueError("Unknown compression policy %s for %s" % (action, file_type))
+
+            new_paths.append(path)
+
+        files[file_type] = new_paths if isinstance(files[file_type], list) else new_paths[0]
+
+
+def disk_use(paths):
+    """
+    Returns the space used by files and directories
+
+    :param paths: list of paths (files or directories, which are scanned recursively)
+    :return: size in bytes
+    """
+
+    total = 0
+
+    for path in paths:
+
+        if os.path.isdir(path):
+
+            for root, _, names in os.walk(path):
+
+                total += sum([os.path.getsize(os.path.join(root, name)) for name in names])
+
+        elif os.path.exists(path):
+
+            total += os.path.getsize(path)
+
+    return total
+
+
+class UrlArchive(object):
+    def __init__(self, base_url, policy=None):
+        """
+        An archive (or a mirror of it) where the files of each obsid are in <base_url>/<obsid>/, listed in the file
+        <base_url>/<obsid>/index.txt (one file name per line). file:// and http:// URLs can be used
+
+        :param base_url: the URL of the archive
+        :param policy: dictionary file type -> compression policy (see compression_policy). The gzip files of the
+        types to uncompress are decompressed while they are downloaded. If None, the files are saved as they are
+        """
+
+        self._base_url = base_url.rstrip("/") + "/"
+
+        self._policy = policy if policy is not None else {}
+
+    @property
+    def base_url(self):
+
+        return self._base_url
+
+    def fetch(self, obsid, directory):
+        """
+        Download the files of an obsid
+
+        :param obsid: the obsid
+        :param directory: the directory where to download the files
+        :return: None
+        """
+
+        obsid_url = urljoin(self._base_url, "%s/" % obsid)
+
+        index = urlopen(urljoin(obsid_url, "index.txt")).read().decode()
+
+        for name in index.split():
+
+            destination = os.path.join(directory, os.path.basename(name))
+
+            remote_file = urlopen(urljoin(obsid_url, name))
+
+            blocks = iter(lambda: remote_file.read(_chunk_size), b"")
+
+            if destination.endswith(".gz") and self._policy.get(get_file_type(name)) == 'uncompress':
+
+                # Decompress while downloading, so the compressed file never hits the disk
+
+                destination = destination[:-3]
+
+                blocks = _decompress_blocks(blocks)
+
+            try:
+
+                with open(destination, "wb") as f:
+
+                    for block in blocks:
+
+                        f.write(block)
+
+            finally:
+
+                remote_file.close()
+
+    def __call__(self, obsid, directory):
+
+        return self.fetch(obsid, directory)
+
+
+def find_downloaded_files(directory, obsid):
+    """
+    Find the files downloaded for an obsid
+
+    :param directory: the directory containing the downloaded files
+    :param obsid: the obsid
+    :return: a dictionary with keys evt3, tsv, exp3, fov3, asol (a list) and pbk
+    """
+
+    evt3_files = find_files.find_files(directory, '*%s*evt3.fits*' % obsid)
+    tsv_files = find_files.find_files(directory, "%d.tsv" % obsid)
+    exp_files = find_files.find_files(directory, "*%s*exp3.fits*" % obsid)
+    asol_files = find_files.find_files(directory, '*asol*.fits*')
+    pbk_files = find_files.find_files(directory, '*pbk*.fits*')
+    fov_files = find_files.find_files(directory, "*%s*fov3.fits*" % obsid)
+
+    if len(evt3_files) > 1 or len(tsv_files) > 1 or len(exp_files) > 1 or len(pbk_files) > 1 or len(fov_files) > 1:
+
+        raise RuntimeError("More than one event file in this tree. Did you clean up the directory before running "
+                           "this script?")
+
+    elif len(evt3_files) == 0 or len(tsv_files) == 0 or len(exp_files) == 0 or len(asol_files) == 0 \
+            or len(pbk_files) == 0 or len(fov_files) == 0:
+
+        raise RuntimeError("Could not find some of the downloaded files. Maybe download failed?")
+
+    return {'evt3': evt3_files[0], 'tsv': tsv_files[0], 'exp3': exp_files[0], 'fov3': fov_files[0],
+            'asol': asol_files, 'pbk': pbk_files[0]}
+
+
+def get_files(obsid, directory, fetch=fetch_from_archive, mirror=None):
+    """
+    Get the files of an obsid in the directory, from the mirror if it has them, otherwise from the archive (adding
+    them to the mirror)
+
+    :param obsid: the obsid
+    :param directory: the directory where to put the files
+    :param fetch: function fetch(obsid, directory) downloading the files of an obsid in the directory
+    :param mirror: an ArchiveMirror instance (optional)
+    :return: dictionary of files, like the output of find_downloaded_files
+    """
+
+    if mirror is not None:
+
+        files = mirror.retrieve(obsid, directory)
+
+        if files is not None:
+
+            logger.info("Obsid %s served by the local mirror" % obsid)
+
+            return files
+
+    fetch(obsid, directory)
+
+    files = find_downloaded_files(directory, obsid)
+
+    if mirror is not None:
+
+        mirror.add(obsid, files)
+
+    return files
+
+
+def update_header(files, runner, obsid=None, mirror=None):
+    """
+    Decompress the event file and apply the r4_header_update script to it, so that it is updated to the
+    Reprocessing 4 version of data. Nothing is done if the event file has been updated already (if it comes from
+    the mirror)
+
+    :param files: the downloaded files (output of find_downloaded_files or get_files). The path of the event file
+    is updated
+    :param runner: a CommandRunner instance
+    :param obsid: the obsid (needed only with a mirror)
+    :param mirror: an ArchiveMirror instance, where the updated event file is stored (optional)
+    :return: None
+    """
+
+    if files.get('header_updated', False):
+
+        return
+
+    # The r4_header_update script cannot run on a compressed fits file, so decompress the eventfile (if the
+    # compression policy did not already)
+
+    if files['evt3'].endswith(".gz"):
+
+        files['evt3'] = decompress_file(files['evt3'])
+
+    # Run reprocessing
+    cmd_line = "r4_header_update infile=%s pbkfile=%s asolfile=%s" % (files['evt3'], files['pbk'],
+                                                                       ",".join(files['asol']))
+
+    runner.run(cmd_line)
+
+    files['header_updated'] = True
+
+    if mirror is not None:
+
+        mirror.add_updated_event_file(obsid, files['evt3'])
+
+
+def is_complete(package_dir):
+    """
+    Returns whether the data package of an obsid has been completely downloaded (it exists, it contains all the
+    files and it has been made read-only, which is the last step)
+
+    :param package_dir: directory of the data package
+    :return: True or False
+    """
+
+    if not os.path.isdir(package_dir):
+
+        return False
+
+    try:
+
+        data_package = DataPackage(package_dir)
+
+    except (IOError, AssertionError):
+
+        return False
+
+    return data_package.read_only and all([data_package.has(tag) for tag in package_content])
+
+
+def store_package(package_dir, files):
+    """
+    Move the downloaded files in a new data package, and make it read-only
+
+    :param package_dir: directory of the data package
+    :param files: the downloaded files (output of find_downloaded_files)
+    :return: the DataPackage instance
+    """
+
+    data_package = DataPackage(package_dir, create=True)
+
+    # Remove what is left of a previous, incomplete download
+    data_package.clear()
+
+    for tag, description in package_content.items():
+
+        data_package.store(tag, files[tag], description, move=True)
+
+    # Make the data package read-only so we cannot change files by accident
+
+    data_package.read_only = True
+
+    return data_package
+
+
+class DownloadManager(object):
+    def __init__(self, fetch=fetch_from_archive, runner=None, max_concurrent=2, prefetch=2, max_retries=3,
+                 backoff=30.0, header_update=True, mirror=None, policy=None):
+        """
+        Download and process the data of many obsids
+
+        :param fetch: function fetch(obsid, directory) downloading the files of an obsid in the directory (default:
+        fetch_from_archive, or use a UrlArchive instance)
+        :param runner: a CommandRunner instance (used for the header update)
+        :param max_concurrent: maximum number of downloads running at the same time
+        :param prefetch: maximum number of obsids downloaded in advance (waiting to be processed), in addition to
+        the ones being downloaded
+        :param max_retries: number of times a failed download is retried
+        :param backoff: waiting time (s) before the first retry. It doubles at each following retry
+        :param header_update: whether to run the r4_header_update script on the event files (it needs CIAO)
+        :param mirror: an ArchiveMirror instance. The obsids it contains are not downloaded again (optional)
+        :param policy: dictionary file type -> compression policy (default: compression_policy)
+        """
+
+        self._fetch = fetch
+        self._runner = runner if runner is not None else CommandRunner(logger)
+
+        self._max_concurrent = max(1, int(max_concurrent))
+        self._prefetch = max(0, int(prefetch))
+        self._max_retries = max(0, int(max_retries))
+        self._backoff = float(backoff)
+
+        self._header_update = bool(header_update)
+
+        self._mirror = mirror
+
+        self._policy = policy if policy is not None else compression_policy
+
+        self._statistics = collections.OrderedDict()
+
+    @property
+    def statistics(self):
+        """
+        Statistics of the obsids downloaded so far: dictionary obsid -> dictionary with the time spent downloading
+        (download_time), applying the compression policy (compression_time) and updating the header
+        (header_update_time), the time from the start of the download to the storage of the data package
+        (total_time), all in seconds, the size of the files as downloaded (downloaded_size) and the size of the data
+        package (package_size), in bytes
+        """
+
+        return self._statistics
+
+    def _download(self, obsid, directory):
+
+        # Download the files of the obsid, retrying with an exponential backoff, then apply the compression policy
+        # (here, so the decompression runs at the same time as the other downloads)
+
+        for attempt in range(self._max_retries + 1):
+
+            if os.path.exists(directory):
+
+                shutil.rmtree(directory)
+
+            os.makedirs(directory)
+
+            try:
+
+                start = time.time()
+
+                files = get_files(obsid, directory, self._fetch, self._mirror)
+
+                downloaded = time.time()
+
+                statistics = {'download_time': downloaded - start, 'downloaded_size': disk_use([directory])}
+
+                apply_compression_policy(files, self._policy)
+
+                statistics['compression_time'] = time.time() - downloaded
+
+                return files, statistics
+
+            except Exception as error:
+
+                if attempt == self._max_retries:
+
+                    raise
+
+                wait = self._backoff * 2 ** attempt
+
+                logger.warning("Download of obsid %s failed (%s). Retrying in %.1f s (%s of %s)"
+                               % (obsid, error, wait, attempt + 1, self._max_retries))
+
+                time.sleep(wait)
+
+    def download(self, obsids, directory='.'):
+        """
+        Download the obsids, storing each one in the data package <directory>/<obsid>
+
+        :param obsids: list of obsids
+        :param directory: the directory containing the data packages
+        :return: (list of obsids downloaded, list of obsids skipped because already complete, dictionary of
+        obsids which failed -> error)
+        """
+
+        directory = os.path.abspath(directory)
+
+        downloaded = []
+        skipped = []
+        failed = collections.OrderedDict()
+
+        to_download = []
+
+        for obsid in obsids:
+
+            if is_complete(os.path.join(directory, str(obsid))):
+
+                logger.info("Data package for obsid %s is complete, skipping it" % obsid)
+
+                skipped.append(obsid)
+
+            else:
+
+                to_download.append(obsid)
+
+        pool = ThreadPool(self._max_concurrent)
+
+        # Downloads submitted to the pool, in the order in which they are processed
+
+        pending = collections.deque()
+
+        next_to_submit = 0
+
+        try:
+
+            while next_to_submit < len(to_download) or len(pending) > 0:
+
+                # Keep the pool busy, but do not download too far ahead of the processing
+
+                while next_to_submit < len(to_download) and len(pending) < self._max_concurrent + self._prefetch:
+
+                    obsid = to_download[next_to_submit]
+
+                    download_dir = os.path.join(directory, "__download_%s" % obsid)
+
+                    pending.append((obsid, download_dir, time.time(),
+                                    pool.apply_async(self._download, (obsid, download_dir))))
+
+                    next_to_submit += 1
+
+                obsid, download_dir, submitted, result = pending.popleft()
+
+                try:
+
+                    files, statistics = result.get()
+
+                    start = time.time()
+
+                    if self._header_update:
+
+                        update_header(files, self._runner, obsid, self._mirror)
+
+                    statistics['header_update_time'] = time.time() - start
+
+                    package_dir = os.path.join(directory, str(obsid))
+
+                    store_package(package_dir, files)
+
+                    statistics['total_time'] = time.time() - submitted
+
+                    statistics['package_size'] = disk_use([package_dir])
+
+                except Exception as error:
+
+                    logger.error("Could not download obsid %s: %s" % (obsid, error))
+
+                    failed[obsid] = error
+
+                else:
+
+                    logger.info("Obsid %s downloaded in %.1f s (download %.1f s, compression policy %.1f s, header "
+                                "update %.1f s). Downloaded %.1f MB, stored %.1f MB"
+                                % (obsid, statistics['total_time'], statistics['download_time'],
+                                   statistics['compression_time'], statistics['header_update_time'],
+                                   statistics['downloaded_size'] / 1024.0 ** 2,
+                                   statistics['package_size'] / 1024.0 ** 2))
+
+                    self._statistics[obsid] = statistics
+
+                    downloaded.append(obsid)
+
+                finally:
+
+                    if os.path.exists(download_dir):
+
+                        shutil.rmtree(download_dir)
+
+        finally:
+
+            pool.close()
+            pool.join()
+
+        return downloaded, skipped, failed
@@ -0,0 +1,480 @@
+"""
+Index of an event table, so that time windows (and time windows within one CCD) are resolved with a binary search
+instead of a scan of the whole table. The event files produced by filter_event_file.py are sorted by TIME, so a time
+window is a contiguous range of rows. The index also contains the offsets of the rows of each frame and, for files
+with more than one CCD, the rows of each CCD in time order. It can be saved in a sidecar file, in a directory of
+temporary files (like the cache of the EventSlicer), so that the data packages are never modified
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+from chandra_suli.logging_system import get_logger
+
+logger = get_logger("event_index")
+
+# Increase this when the content of the sidecar file changes
+_index_version = 1
+
+
+def sidecar_file(event_file, sidecar_dir):
+    """
+    Returns the name of the sidecar file containing the index for the event file
+
+    :param event_file: the event file
+    :param sidecar_dir: the directory containing the sidecar files
+    :return: path of the sidecar file
+    """
+
+    # Event files with the same name in different directories get different sidecar files
+
+    key = hashlib.md5(os.path.abspath(event_file).encode()).hexdigest()
+
+    evt_name = os.path.splitext(os.path.basename(event_file))[0]
+
+    return os.path.join(sidecar_dir, "%s_%s.index.npz" % (evt_name, key[:16]))
+
+
+def _file_signature(event_file):
+
+    stat = os.stat(event_file)
+
+    return np.array([stat.st_size, stat.st_mtime])
+
+
+def _row_type(n_rows):
+
+    return np.int32 if n_rows < 2 ** 31 else np.int64
+
+
+def _indirect_searchsorted(time, order, lo, hi, value, side):
+
+    # Binary search of value in time[order[lo:hi]] (which is sorted), without gathering the times
+
+    while lo < hi:
+
+        mid = (lo + hi) // 2
+
+        t = time[order[mid]]
+
+        if t < value or (side == 'right' and t == value):
+
+            lo = mid + 1
+
+        else:
+
+            hi = mid
+
+    return lo
+
+
+class EventIndex(object):
+    def __init__(self, time, ccd_id=None, frame_start=None, frame_time=None, arrays=None):
+        """
+        :param time: the TIME column (can be memory-mapped, it is not copied if it is sorted)
+        :param ccd_id: the CCD_ID column, or None if the table contains only one CCD
+        :param frame_start: start time of the first frame (usually the TSTART keyword)
+        :param frame_time: duration of a frame (usually the TIMEDEL keyword). If None, frame offsets are not computed
+        :param arrays: the arrays of an index previously computed (used when loading a sidecar file)
+        """
+
+        self._time = time
+
+        if arrays is None:
+
+            arrays = self._build(time, ccd_id, frame_start, frame_time)
+
+        self._arrays = arrays
+
+        if arrays['time_order'].shape[0] == 0:
+
+            self._time_order = None
+
+            self._sorted_time = time
+
+        else:
+
+            self._time_order = arrays['time_order']
+
+            self._sorted_time = time[self._time_order]
+
+        self._ccds = arrays['ccds']
+        self._ccd_offsets = arrays['ccd_offsets']
+        self._ccd_order = arrays['ccd_order'] if arrays['ccd_order'].shape[0] > 0 else None
+
+        self._frame_start = float(arrays['frame_start'])
+        self._frame_time = float(arrays['frame_time'])
+        self._frame_offsets = arrays['frame_offsets']
+
+    @staticmethod
+    def _build(time, ccd_id, frame_start, frame_time):
+
+        n_rows = time.shape[0]
+
+        row_type = _row_type(n_rows)
+
+        arrays = {}
+
+        if np.all(time[1:] >= time[:-1]):
+
+            time_order = None
+
+            arrays['time_order'] = np.zeros(0, row_type)
+
+            sorted_time = time
+
+        else:
+
+            logger.warning("Event table is not sorted by time. The index will be built on a sorted copy.")
+
+            time_order = np.argsort(time, kind='mergesort').astype(row_type)
+
+            arrays['time_order'] = time_order
+
+            sorted_time = time[time_order]
+
+        # Rows of each CCD, in time order
+
+        if ccd_id is None:
+
+            arrays['ccds'] = np.zeros(0, np.int16)
+            arrays['ccd_offsets'] = np.zeros(0, row_type)
+            arrays['ccd_order'] = np.zeros(0, row_type)
+
+        else:
+
+            ccd_id = np.asarray(ccd_id)
+
+            if time_order is not None:
+
+                ccd_id = ccd_id[time_order]
+
+            # A stable sort keeps the time order within each CCD
+
+            ccd_order = np.argsort(ccd_id, kind='mergesort').astype(row_type)
+
+            sorted_ccds = ccd_id[ccd_order]
+
+            ccds, first_rows = np.unique(sorted_ccds, return_index=True)
+
+            arrays['ccds'] = ccds.astype(np.int16)
+            arrays['ccd_offsets'] = np.append(first_rows, n_rows).astype(row_type)
+            arrays['ccd_order'] = time_order[ccd_order] if time_order is not None else ccd_order
+
+        # First row of each frame
+
+        if frame_time is None or frame_time <= 0 or n_rows == 0:
+
+            arrays['frame_start'] = 0.0
+            arrays['frame_time'] = 0.0
+            arrays['frame_offsets'] = np.zeros(0, row_type)
+
+        else:
+
+            if frame_start is None:
+
+                frame_start = sorted_time[0]
+
+            frame_start = min(float(frame_start), float(sorted_time[0]))
+
+            n_frames = int(np.floor((sorted_time[-1] - frame_start) / frame_time)) + 1
+
+            edges = frame_start + np.arange(n_frames + 1) * float(frame_time)
+
+            arrays['frame_start'] = frame_start
+            arrays['frame_time'] = float(frame_time)
+            arrays['frame_offsets'] = np.searchsorted(sorted_time, edges, side='left').astype(row_type)
+
+        return arrays
+
+    @classmethod
+    def from_hdu(cls, events_hdu, event_file=None, sidecar_dir=None):
+        """
+        Returns the index for an EVENTS extension. If event_file and sidecar_dir are provided, the index is read from
+        the sidecar file when it is up to date, otherwise it is computed and saved in the sidecar file
+
+        :param events_hdu: the EVENTS extension (opened with memmap=True to avoid reading the whole table)
+        :param event_file: the file containing the extension, or None to never use the sidecar file
+        :param sidecar_dir: directory for the sidecar file (see sidecar_file), or None to never use the sidecar file
+        :return: an EventIndex instance
+        """
+
+        data = events_hdu.data
+
+        time = data.field("TIME")
+
+        if event_file is not None and sidecar_dir is not None:
+
+            index = cls._load(sidecar_file(event_file, sidecar_dir), time, _file_signature(event_file))
+
+            if index is not None:
+
+                return index
+
+        column_names = [name.upper() for name in data.columns.names]
+
+        ccd_id = data.field("CCD_ID") if "CCD_ID" in column_names else None
+
+        if ccd_id is not None and ccd_id.shape[0] > 0 and np.all(ccd_id == ccd_id[0]):
+
+            # Only one CCD, no need for the CCD index
+
+            ccd_id = None
+
+        header = events_hdu.header
+
+        index = cls(time, ccd_id, header.get("TSTART"), header.get("TIMEDEL"))
+
+        if event_file is not None and sidecar_dir is not None:
+
+            index._save(sidecar_file(event_file, sidecar_dir), _file_signature(event_file))
+
+        return index
+
+    @classmethod
+    def from_reader(cls, reader, sidecar_dir=None):
+        """
+        Returns the index for the event file read by an EventFileReader. The TIME and CCD_ID columns are read one
+        block of rows at a time, so the rest of the table is never in memory. If sidecar_dir is provided, the sidecar
+        file is used like in from_hdu
+
+        :param reader: an EventFileReader instance
+        :param sidecar_dir: directory for the sidecar file (see sidecar_file), or None to never use the sidecar file
+        :return: an EventIndex instance
+        """
+
+        event_file = reader.event_file
+
+        time = reader.read_column("TIME")
+
+        if event_file is not None and sidecar_dir is not None:
+
+            index = cls._load(sidecar_file(event_file, sidecar_dir), time, _file_signature(event_file))
+
+            if index is not None:
+
+                return index
+
+        column_names = [name.upper() for name in reader.columns]
+
+        ccd_id = reader.read_column("CCD_ID") if "CCD_ID" in column_names else None
+
+        if ccd_id is not None and ccd_id.shape[0] > 0 and np.all(ccd_id == ccd_id[0]):
+
+            # Only one CCD, no need for the CCD index
+
+            ccd_id = None
+
+        header = reader.header
+
+        index = cls(time, ccd_id, header.get("TSTART"), header.get("TIMEDEL"))
+
+        if event_file is not None and sidecar_dir is not None:
+
+            index._save(sidecar_file(event_file, sidecar_dir), _file_signature(event_file))
+
+        return index
+
+    @classmethod
+    def _load(cls, filename, time, signature):
+
+        if not os.path.exists(filename):
+
+            return None
+
+        try:
+
+            with np.load(filename) as f:
+
+                arrays = dict((key, f[key]) for key in f.files)
+
+        except (IOError, ValueError):
+
+            logger.warning("Could not read the index in %s" % filename)
+
+            return None
+
+        if (int(arrays['version']) != _index_version or int(arrays['n_rows']) != time.shape[0] or
+                not np.array_equal(arrays['signature'], signature)):
+
+            # Out of date
+
+            return None
+
+        return cls(time, arrays=arrays)
+
+    def _save(self, filename, signature):
+
+        try:
+
+            np.savez(filename, version=_index_version, n_rows=self.n_rows, signature=signature, **self._arrays)
+
+        except (IOError, OSError):
+
+            # Missing or read-only directory. The index will be recomputed next time
+
+            logger.warning("Could not save the index in %s" % filename)
+
+    @property
+    def n_rows(self):
+
+        return self._time.shape[0]
+
+    @property
+    def time_sorted(self):
+        """
+        Whether the table is sorted by time (if it is, time windows are contiguous slices)
+        """
+
+        return self._time_order is None
+
+    @property
+    def ccds(self):
+        """
+        CCDs contained in the table (empty if the index was built without the CCD column)
+        """
+
+        return self._ccds
+
+    @property
+    def n_frames(self):
+
+        return max(0, self._frame_offsets.shape[0] - 1)
+
+    def _to_rows(self, first, last):
+
+        # Convert a range in the time-sorted order to rows of the table
+
+        last = max(first, last)
+
+        if self._time_order is None:
+
+            return slice(first, last)
+
+        else:
+
+            return np.sort(self._time_order[first:last])
+
+    def _search_range(self, tstart, tstop):
+
+        # Use the frame offsets to restrict the binary search to the frames containing tstart and tstop
+
+        if self._frame_offsets.shape[0] == 0:
+
+            return 0, self.n_rows, 0, self.n_rows
+
+        return self._frames_range(tstart) + self._frames_range(tstop)
+
+    def _frames_range(self, t):
+
+        # Range of rows of the frame containing t and of the frames before and after it. The frame computed from t
+        # can be off by one with respect to the edges used for the frame offsets (because of rounding, when t is
+        # on an edge), so the neighbouring frames are included
+
+        last_frame = self._frame_offsets.shape[0] - 2
+
+        frame = np.floor((t - self._frame_start) / self._frame_time)
+
+        first = int(np.clip(frame - 1, 0, last_frame))
+        last = int(np.clip(frame + 1, 0, last_frame))
+
+        # Times before the first frame or after the last one
+
+        lo = 0 if first == 0 else self._frame_offsets[first]
+        hi = self.n_rows if last == last_frame else self._frame_offsets[last + 1]
+
+        return lo, hi
+
+    def time_range(self, tstart, tstop):
+        """
+        Returns the range (first, last) of positions in time order of the events with tstart <= TIME <= tstop
+        """
+
+        lo1, hi1, lo2, hi2 = self._search_range(tstart, tstop)
+
+        first = lo1 + np.searchsorted(self._sorted_time[lo1:hi1], tstart, side='left')
+        last = lo2 + np.searchsorted(self._sorted_time[lo2:hi2], tstop, side='right')
+
+        return int(first), int(max(first, last))
+
+    def time_window(self, tstart, tstop):
+        """
+        Returns the rows with tstart <= TIME <= tstop
+
+        :return: a slice (or an array of row indices, if the table is not sorted by time)
+        """
+
+        return self._to_rows(*self.time_range(tstart, tstop))
+
+    def count(self, tstart, tstop):
+        """
+        Returns the number of events with tstart <= TIME <= tstop
+        """
+
+        first, last = self.time_range(tstart, tstop)
+
+        return last - first
+
+    def frame_window(self, frame):
+        """
+        Returns the rows of the events in the given frame (counted from the start of the table)
+        """
+
+        return self._to_rows(self._frame_offsets[frame], self._frame_offsets[frame + 1])
+
+    def _ccd_bounds(self, ccd):
+
+        position = np.searchsorted(self._ccds, ccd)
+
+        if position == self._ccds.shape[0] or self._ccds[position] != ccd:
+
+            return None
+
+        return self._ccd_offsets[position], self._ccd_offsets[position + 1]
+
+    def ccd_rows(self, ccd):
+        """
+        Returns the rows of the events of one CCD, in time order
+
+        :return: an array of row indices
+        """
+
+        if self._ccd_order is None:
+
+            if self._time_order is None:
+
+                return np.arange(self.n_rows, dtype=_row_type(self.n_rows))
+
+            return self._time_order
+
+        bounds = self._ccd_bounds(ccd)
+
+        if bounds is None:
+
+            return np.zeros(0, self._ccd_order.dtype)
+
+        return self._ccd_order[bounds[0]:bounds[1]]
+
+    def ccd_time_window(self, ccd, tstart, tstop):
+        """
+        Returns the rows of the events of one CCD with tstart <= TIME <= tstop, in time order
+
+        :return: an array of row indices (or a slice, if the table contains only one CCD)
+        """
+
+        if self._ccd_order is None:
+
+            return self.time_window(tstart, tstop)
+
+        bounds = self._ccd_bounds(ccd)
+
+        if bounds is None:
+
+            return np.zeros(0, self._ccd_order.dtype)
+
+        first = _indirect_searchsorted(self._time, self._ccd_order, bounds[0], bounds[1], tstart, 'left')
+        last = _indirect_searchsorted(self._time, self._ccd_order, first, bounds[1], tstop, 'right')
+
+        return self._ccd_order[first:last]
@@ -0,0 +1,394 @@
+"""
+Read the EVENTS table of an event file in blocks of rows, without loading (or memory-mapping) the whole table. Each
+block is read from the file with a plain read of the rows, and only the requested columns are kept, so the memory
+used is bounded by the size of the block, whatever the size of the file.
+
+    reader = EventFileReader("evt3.fits", chunk_size=500000)
+
+    for first_row, chunk in reader.iter_chunks(['time', 'ccd_id']):
+
+        ... chunk['time'], chunk['ccd_id'] are numpy arrays for rows first_row, first_row + 1, ...
+
+The values are the same as those returned by astropy for the same columns (scaled columns included).
+"""
+
+import os
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+from chandra_suli.sanitize_filename import sanitize_filename
+
+# Number of rows read at once (by default)
+default_chunk_size = 1000000
+
+
+class EventFileReader(object):
+    def __init__(self, event_file, extension='EVENTS', chunk_size=default_chunk_size):
+        """
+        :param event_file: the event file
+        :param extension: name of the binary table to read
+        :param chunk_size: number of rows in each block
+        """
+
+        self._event_file = sanitize_filename(event_file)
+
+        self._chunk_size = max(1, int(chunk_size))
+
+        # Only the headers are read here (the data are never loaded by astropy)
+
+        with pyfits.open(self._event_file, memmap=False) as hdulist:
+
+            hdu_number = hdulist.index_of(extension)
+
+            hdu = hdulist[hdu_number]
+
+            self._header = hdu.header.copy()
+
+            self._hdu_number = hdu_number
+
+            self._header_offset = hdulist.fileinfo(hdu_number)['hdrLoc']
+
+            self._data_offset = hdulist.fileinfo(hdu_number)['datLoc']
+
+            # Size of the data including the padding to the FITS block size
+            self._data_span = hdulist.fileinfo(hdu_number)['datSpan']
+
+            columns = hdu.columns
+
+            # Rows are stored big-endian in the file
+
+            self._row_dtype = columns.dtype.newbyteorder('>')
+
+            self._scaling = {}
+
+            for column in columns:
+
+                if column.bscale not in (None, 1) or column.bzero not in (None, 0):
+
+                    self._scaling[column.name] = (column.bscale if column.bscale is not None else 1,
+                                                  column.bzero if column.bzero is not None else 0)
+
+            self._names = dict([(name.lower(), name) for name in columns.names])
+
+        self._n_rows = int(self._header['NAXIS2'])
+
+        assert self._row_dtype.itemsize == self._header['NAXIS1'], "Unsupported row format in %s" % self._event_file
+
+    @property
+    def event_file(self):
+
+        return self._event_file
+
+    @property
+    def header(self):
+
+        return self._header
+
+    @property
+    def n_rows(self):
+
+        return self._n_rows
+
+    @property
+    def hdu_number(self):
+        """
+        Number of the extension in the file
+        """
+
+        return self._hdu_number
+
+    @property
+    def header_offset(self):
+        """
+        Position in the file (bytes) of the header of the extension
+        """
+
+        return self._header_offset
+
+    @property
+    def data_offset(self):
+        """
+        Position in the file (bytes) of the first row
+        """
+
+        return self._data_offset
+
+    @property
+    def data_span(self):
+        """
+        Size (bytes) of the data of the extension in the file, including the padding
+        """
+
+        return self._data_span
+
+    @property
+    def row_dtype(self):
+        """
+        Data type of the rows as stored in the file (big-endian)
+        """
+
+        return self._row_dtype
+
+    @property
+    def chunk_size(self):
+
+        return self._chunk_size
+
+    @property
+    def columns(self):
+
+        return [self._names[name] for name in sorted(self._names)]
+
+    def _column_name(self, name):
+
+        try:
+
+            return self._names[name.lower()]
+
+        except KeyError:
+
+            raise ValueError("Column %s is not in %s" % (name, self._event_file))
+
+    def _convert(self, name, raw):
+
+        # Native byte order, and scaling (TSCAL/TZERO) like astropy does
+
+        values = raw.astype(raw.dtype.newbyteorder('='))
+
+        if name not in self._scaling:
+
+            return values
+
+        bscale, bzero = self._scaling[name]
+
+        if bscale == 1 and values.dtype.kind == 'i' and bzero == 2 ** (8 * values.dtype.itemsize - 1):
+
+            # Unsigned integers (e.g., TZERO = 32768 for 16-bit columns)
+
+            unsigned = np.dtype('u%s' % values.dtype.itemsize)
+
+            return values.astype(unsigned) + unsigned.type(bzero)
+
+        return values * bscale + bzero
+
+    def iter_raw_chunks(self, start=0, stop=None):
+        """
+        Iterate over the rows in blocks, as they are stored in the file (all the columns, big-endian, not scaled)
+
+        :param start: first row
+        :param stop: stop before this row (default: the end of the table)
+        :return: a generator of (index of the first row of the block, structured numpy array)
+        """
+
+        stop = self._n_rows if stop is None else min(int(stop), self._n_rows)
+
+        with open(self._event_file, 'rb') as f:
+
+            f.seek(self._data_offset + int(start) * self._row_dtype.itemsize, os.SEEK_SET)
+
+            for first_row in range(int(start), stop, self._chunk_size):
+
+                n = min(self._chunk_size, stop - first_row)
+
+                raw = np.fromfile(f, dtype=self._row_dtype, count=n)
+
+                if raw.shape[0] != n:
+
+                    raise IOError("File %s is truncated" % self._event_file)
+
+                yield first_row, raw
+
+    def iter_chunks(self, columns=None, start=0, stop=None):
+        """
+        Iterate over the rows in blocks
+
+        :param columns: list of columns to read (case insensitive). If None, all the columns are read
+        :param start: first row
+        :param stop: stop before this row (default: the end of the table)
+        :return: a generator of (index of the first row of the block, structured numpy array with the columns)
+        """
+
+        names = [self._column_name(name) for name in columns] if columns is not None else self.columns
+
+        for first_row, raw in self.iter_raw_chunks(start, stop):
+
+            converted = [(name.lower(), self._convert(name, raw[name])) for name in names]
+
+            # Vector columns (like PHAS) keep their shape
+
+            chunk = np.empty(raw.shape[0], dtype=[(name, values.dtype, values.shape[1:]) for name, values in converted])
+
+            for name, values in converted:
+
+                chunk[name] = values
+
+            yield first_row, chunk
+
+    def read_column(self, name):
+        """
+        Read a whole column (one block at a time, so only the column is ever fully in memory)
+
+        :param name: name of the column
+        :return: numpy array
+        """
+
+        parts = [chunk[name.lower()] for _, chunk in self.iter_chunks([name])]
+
+        if len(parts) == 0:
+
+            return np.zeros(0, self._row_dtype[self._column_name(name)].newbyteorder('='))
+
+        return np.concatenate(parts)
+
+    def min_max(self, columns):
+        """
+        Minimum and maximum of some columns, computed one block of rows at a time
+
+        :param columns: list of column names
+        :return: dictionary name -> (minimum, maximum). Both are None if the table is empty
+        """
+
+        result = dict([(name, (None, None)) for name in columns])
+
+        for _, chunk in self.iter_chunks(columns):
+
+            for name in columns:
+
+                values = chunk[name.lower()]
+
+                low, high = result[name]
+
+                result[name] = (values.min() if low is None else min(low, values.min()),
+                                values.max() if high is None else max(high, values.max()))
+
+        return result
+
+
+# Size of a FITS block (bytes). Each HDU is padded to a multiple of this
+_fits_block = 2880
+
+
+def _copy_bytes(f_in, f_out, start, stop):
+
+    f_in.seek(start, os.SEEK_SET)
+
+    remaining = stop - start
+
+    while remaining > 0:
+
+        block = f_in.read(min(remaining, 16 * 1024 * 1024))
+
+        if not block:
+
+            raise IOError("Unexpected end of file")
+
+        f_out.write(block)
+
+        remaining -= len(block)
+
+
+class EventFileWriter(object):
+    def __init__(self, reader, outfile, n_rows, header=None):
+        """
+        Write a new event file like the one read by an EventFileReader, with other rows in the EVENTS extension (in
+        the same format). The other HDUs are copied as they are. The rows are written in blocks with write, and the
+        file is completed by close:
+
+            with EventFileWriter(reader, "new_evt3.fits", n_rows) as writer:
+
+                for _, raw in reader.iter_raw_chunks():
+
+                    writer.write(raw[...])
+
+        :param reader: the EventFileReader of the original file
+        :param outfile: the new file (overwritten if it exists)
+        :param n_rows: number of rows which will be written
+        :param header: header of the EVENTS extension (default: the original one). NAXIS2 is set to n_rows and the
+        checksums (not valid anymore) are removed
+        """
+
+        assert reader.header.get('PCOUNT', 0) == 0, "Event files with a heap are not supported"
+
+        self._reader = reader
+
+        self._n_rows = int(n_rows)
+
+        self._n_written = 0
+
+        header = (reader.header if header is None else header).copy()
+
+        header['NAXIS2'] = self._n_rows
+
+        for keyword in ('CHECKSUM', 'DATASUM'):
+
+            if keyword in header:
+
+                del header[keyword]
+
+        self._f_in = open(reader.event_file, 'rb')
+
+        self._f_out = open(sanitize_filename(outfile), 'wb')
+
+        _copy_bytes(self._f_in, self._f_out, 0, reader.header_offset)
+
+        self._f_out.write(header.tostring().encode('ascii'))
+
+    def write(self, rows):
+        """
+        Write some rows
+
+        :param rows: structured array with the format of the rows of the original file (for example, a block of
+        rows, or part of it, from EventFileReader.iter_raw_chunks)
+        :return: None
+        """
+
+        # (np.concatenate, for example, can return the rows in the native byte order)
+
+        self._f_out.write(rows.astype(self._reader.row_dtype).tobytes())
+
+        self._n_written += rows.shape[0]
+
+    def close(self):
+        """
+        Complete the file: pad the table to a multiple of the FITS block and copy the HDUs after the EVENTS extension
+        """
+
+        try:
+
+            assert self._n_written == self._n_rows, "Wrote %s rows instead of %s" % (self._n_written, self._n_rows)
+
+            data_size = self._n_written * self._reader.row_dtype.itemsize
+
+            self._f_out.write(b"\0" * ((_fits_block - data_size % _fits_block) % _fits_block))
+
+            self._f_in.seek(0, os.SEEK_END)
+
+            _copy_bytes(self._f_in, self._f_out, self._reader.data_offset + self._reader.data_span, self._f_in.tell())
+
+        finally:
+
+            self._f_in.close()
+            self._f_out.close()
+
+    def abort(self):
+        """
+        Close the files without completing the new file (which is not a valid FITS file)
+        """
+
+        self._f_in.close()
+        self._f_out.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        if exc_type is None:
+
+            self.close()
+
+        else:
+
+            self.abort()
@@ -0,0 +1,430 @@
+"""
+Time-interval slices of a CCD event file. The event file is memory-mapped once, and the rows in a time interval are
+found with a binary search on the TIME column (which filter_event_file.py sorts) using the EventIndex. A FITS file
+with the slice is written only when an external tool needs a path, and it is kept in a small on-disk LRU cache shared
+by all the scripts, so the same (Tstart, Tstop) window is extracted only once. The sidecar files of the indexes are
+kept in the same directory
+"""
+
+import errno
+import hashlib
+import os
+import tempfile
+
+import astropy.io.fits as pyfits
+
+from chandra_suli.event_index import EventIndex
+from chandra_suli.event_reader import EventFileReader, default_chunk_size
+from chandra_suli.logging_system import get_logger
+from chandra_suli.sanitize_filename import sanitize_filename
+
+logger = get_logger("event_slicer")
+
+# Environment variable with the directory of the cache. Jobs set it to a directory inside their work directory, so
+# the cache is removed with it (see farm_wrapper.py)
+cache_dir_variable = "CHANDRA_SULI_SLICE_CACHE"
+
+# Maximum size of the cache (bytes)
+_default_cache_size = 2 * 1024 ** 3
+
+# Slicers already opened by this process (see get_slicer)
+_slicers = {}
+
+
+def default_cache_dir():
+    """
+    Returns the directory of the cache of slices: the one in the environment variable CHANDRA_SULI_SLICE_CACHE if
+    set, otherwise chandra_suli_slices in the temporary directory
+    """
+
+    if os.environ.get(cache_dir_variable):
+
+        return sanitize_filename(os.environ[cache_dir_variable])
+
+    return os.path.join(tempfile.gettempdir(), "chandra_suli_slices")
+
+
+def _make_cache_dir(cache_dir):
+
+    if not os.path.exists(cache_dir):
+
+        try:
+
+            os.makedirs(cache_dir)
+
+        except OSError:
+
+            # Created in the meantime by another process
+
+            if not os.path.exists(cache_dir):
+
+                raise
+
+
+def _cache_usage(cache_dir):
+
+    # Returns a list of (last use, size, path) for the slices in the cache
+
+    entries = []
+
+    for name in os.listdir(cache_dir):
+
+        if not name.endswith(".fits"):
+
+            continue
+
+        path = os.path.join(cache_dir, name)
+
+        try:
+
+            stat = os.stat(path)
+
+        except OSError:
+
+            # Removed in the meantime by another process
+
+            continue
+
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    return entries
+
+
+def _lock_file(cache_file, pid=None):
+
+    # Marks the slice as in use by a process (see EventSlicer.get_file and EventSlicer.release_file)
+
+    return "%s.%s.lock" % (cache_file, os.getpid() if pid is None else pid)
+
+
+def _process_exists(pid):
+
+    try:
+
+        os.kill(pid, 0)
+
+    except OSError as e:
+
+        # EPERM means that the process exists, but belongs to another user
+
+        return e.errno == errno.EPERM
+
+    return True
+
+
+def _in_use(cache_file):
+
+    # Returns True if a running process is using the slice. Lock files left behind by processes which do not exist
+    # anymore are removed
+
+    in_use = False
+
+    prefix = "%s." % os.path.basename(cache_file)
+
+    for name in os.listdir(os.path.dirname(cache_file)):
+
+        if not (name.startswith(prefix) and name.endswith(".lock")):
+
+            continue
+
+        try:
+
+            pid = int(name[len(prefix):-len(".lock")])
+
+        except ValueError:
+
+            continue
+
+        if _process_exists(pid):
+
+            in_use = True
+
+        else:
+
+            try:
+
+                os.remove(os.path.join(os.path.dirname(cache_file), name))
+
+            except OSError:
+
+                pass
+
+    return in_use
+
+
+def evict_cache(cache_dir=None, max_size=_default_cache_size, keep=()):
+    """
+    Remove the least recently used slices from the cache until its size is below max_size. The slices in use by a
+    running process (see EventSlicer.get_file) are never removed
+
+    :param cache_dir: the cache directory (default: see default_cache_dir)
+    :param max_size: maximum size of the cache (bytes)
+    :param keep: paths which must not be removed
+    :return: number of bytes removed
+    """
+
+    if cache_dir is None:
+
+        cache_dir = default_cache_dir()
+
+    entries = sorted(_cache_usage(cache_dir))
+
+    total = sum([size for _, size, _ in entries])
+
+    removed = 0
+
+    for _, size, path in entries:
+
+        if total <= max_size:
+
+            break
+
+        if path in keep or _in_use(path):
+
+            continue
+
+        try:
+
+            os.remove(path)
+
+        except OSError:
+
+            continue
+
+        total -= size
+        removed += size
+
+    return removed
+
+
+class EventSlicer(object):
+    def __init__(self, event_file, cache_dir=None, max_cache_size=_default_cache_size, chunk_size=default_chunk_size):
+        """
+        :param event_file: the event file (with an EVENTS extension)
+        :param cache_dir: directory for the cached slices (default: see default_cache_dir)
+        :param max_cache_size: maximum size of the cache (bytes)
+        :param chunk_size: number of rows read at once when building the index
+        """
+
+        self._event_file = sanitize_filename(event_file)
+
+        self._cache_dir = sanitize_filename(cache_dir) if cache_dir is not None else default_cache_dir()
+
+        self._max_cache_size = int(max_cache_size)
+
+        # Slices marked as in use by this process (see get_file)
+
+        self._locks = set()
+
+        self._hdulist = pyfits.open(self._event_file, memmap=True)
+
+        self._events = self._hdulist['EVENTS']
+
+        # Read from the sidecar file in the cache if possible, otherwise build it. The columns needed by the index are
+        # read in blocks of rows, so the whole table is never loaded (only the slices are read from the memory map)
+
+        _make_cache_dir(self._cache_dir)
+
+        self._index = EventIndex.from_reader(EventFileReader(self._event_file, chunk_size=chunk_size), self._cache_dir)
+
+        # Identify the version of the event file, so that slices of an older version are not used
+
+        stat = os.stat(self._event_file)
+
+        self._file_id = "%s|%s|%s" % (self._event_file, stat.st_size, stat.st_mtime)
+
+    @property
+    def event_file(self):
+
+        return self._event_file
+
+    @property
+    def header(self):
+        """
+        Header of the EVENTS extension
+        """
+
+        return self._events.header
+
+    @property
+    def index(self):
+        """
+        The EventIndex of the event file
+        """
+
+        return self._index
+
+    @property
+    def n_events(self):
+
+        return self._index.n_rows
+
+    def get_rows(self, tstart, tstop):
+        """
+        Returns the rows with tstart <= TIME <= tstop
+
+        :param tstart: start of the interval
+        :param tstop: end of the interval
+        :return: a slice (or an array of row indices, if the file is not sorted by time)
+        """
+
+        return self._index.time_window(tstart, tstop)
+
+    def count(self, tstart, tstop):
+        """
+        Returns the number of events with tstart <= TIME <= tstop
+        """
+
+        return self._index.count(tstart, tstop)
+
+    def get_data(self, tstart, tstop):
+        """
+        Returns the events with tstart <= TIME <= tstop. For a sorted file this is a view on the memory-mapped
+        file, so no data is copied
+
+        :return: a FITS_rec
+        """
+
+        return self._events.data[self.get_rows(tstart, tstop)]
+
+    def _get_cache_file(self, tstart, tstop):
+
+        key = hashlib.md5(("%s|%r|%r" % (self._file_id, float(tstart), float(tstop))).encode()).hexdigest()
+
+        evt_name = os.path.splitext(os.path.basename(self._event_file))[0]
+
+        return os.path.join(self._cache_dir, "%s_TI_%s.fits" % (evt_name, key[:16]))
+
+    def get_file(self, tstart, tstop):
+        """
+        Returns the path of a FITS file containing the events with tstart <= TIME <= tstop, equivalent to
+        ftcopy "event_file[(TIME >= tstart) && (TIME <= tstop)]". The file is in the cache: do not modify it or
+        remove it. It is marked as in use by this process, so other processes do not evict it, until release_file is
+        called (or the slicer is closed)
+
+        :return: path to the file
+        """
+
+        cache_file = self._get_cache_file(tstart, tstop)
+
+        # (the directory could have been removed since the slicer was opened)
+
+        _make_cache_dir(self._cache_dir)
+
+        # Mark the slice as in use before looking for it, so it cannot be evicted in between
+
+        open(_lock_file(cache_file), 'a').close()
+
+        self._locks.add(cache_file)
+
+        if os.path.exists(cache_file):
+
+            # Mark it as recently used
+
+            os.utime(cache_file, None)
+
+            return cache_file
+
+        # Same content as the original file, with only the selected events
+
+        hdus = []
+
+        for hdu in self._hdulist:
+
+            if hdu is self._events:
+
+                hdus.append(pyfits.BinTableHDU(data=self.get_data(tstart, tstop), header=hdu.header))
+
+            else:
+
+                hdus.append(hdu)
+
+        # Write to a temporary file and then rename, so other processes never see a partial file
+
+        temp_file = "%s.%s.tmp" % (cache_file, os.getpid())
+
+        pyfits.HDUList(hdus).writeto(temp_file, overwrite=True)
+
+        os.rename(temp_file, cache_file)
+
+        evict_cache(self._cache_dir, self._max_cache_size, keep=(cache_file,))
+
+        return cache_file
+
+    def release_file(self, cache_file):
+        """
+        Mark a slice returned by get_file as not in use by this process anymore, so it can be evicted from the cache
+
+        :param cache_file: the path returned by get_file
+        :return: None
+        """
+
+        if cache_file in self._locks:
+
+            self._locks.discard(cache_file)
+
+            try:
+
+                os.remove(_lock_file(cache_file))
+
+            except OSError:
+
+                pass
+
+    def close(self):
+
+        for cache_file in list(self._locks):
+
+            self.release_file(cache_file)
+
+        self._hdulist.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        self.close()
+
+
+def get_slicer(event_file, chunk_size=default_chunk_size):
+    """
+    Returns the EventSlicer for the event file, opening it only the first time it is requested by this process
+
+    :param event_file: the event file
+    :param chunk_size: number of rows read at once when building the index (used only the first time)
+    :return: an EventSlicer instance
+    """
+
+    event_file = sanitize_filename(event_file)
+
+    stat = os.stat(event_file)
+
+    key = (event_file, stat.st_size, stat.st_mtime)
+
+    if key not in _slicers:
+
+        _slicers[key] = EventSlicer(event_file, chunk_size=chunk_size)
+
+    return _slicers[key]
+
+
+def release(event_file):
+    """
+    Close the slicer of the event file opened by this process (if any) and forget it, so the file is not kept open
+    and memory-mapped anymore. Call this before removing the file
+
+    :param event_file: the event file
+    :return: None
+    """
+
+    event_file = sanitize_filename(event_file)
+
+    # There can be more than one slicer for the same path, if the file changed
+
+    for key in list(_slicers.keys()):
+
+        if key[0] == event_file:
+
+            _slicers.pop(key).close()
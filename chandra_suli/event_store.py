@@ -0,0 +1,608 @@
+"""
+Columnar store of the events of one obsid. Instead of passing full copies of the event file between the stages
+(energy-filtered file, file without hot pixels, one file per CCD...), the events are written once, column by column,
+and the derived products are recorded as selections: arrays with the indices of the selected rows. A selection costs
+4 bytes per selected event, instead of a copy of all the columns.
+
+Only the columns used by the analysis are kept (see default_columns), each one with a compact data type and in its
+own .npy file, so it can be memory-mapped and a stage reads only the columns it needs. The store is a directory:
+
+    store.yml          number of rows, columns and selections
+    events_header.txt  header of the original EVENTS extension (keywords, WCS of the columns...)
+    hdus.fits          the other extensions of the original file (primary header, GTIs...)
+    columns/<name>.npy
+    selections/<name>.npy
+
+External tools (xtdac, CIAO...) still need FITS files: write_fits writes a selection as an event file with all the
+columns of the original file, copying the selected rows from it (the store remembers where it is). Several selections
+are written in one pass over the original file with write_fits_files.
+"""
+
+import collections
+import os
+import re
+import shutil
+
+import astropy.io.fits as pyfits
+import numpy as np
+import yaml
+
+from chandra_suli.event_reader import EventFileReader, EventFileWriter
+from chandra_suli.logging_system import get_logger
+from chandra_suli.sanitize_filename import sanitize_filename
+
+logger = get_logger("event_store")
+
+# Columns kept in the store, with the data type used to store them (the types in the event files are larger: for
+# example CCD_ID is a 16-bit integer and PHA a 32-bit integer). TIME must stay in double precision
+default_columns = collections.OrderedDict([('time', np.float64),
+                                           ('ccd_id', np.uint8),
+                                           ('chipx', np.int16),
+                                           ('chipy', np.int16),
+                                           ('x', np.float32),
+                                           ('y', np.float32),
+                                           ('energy', np.float32),
+                                           ('pha', np.int32)])
+
+# Number of rows read at once when creating the store
+_default_chunk_size = 1000000
+
+_meta_file = "store.yml"
+_header_file = "events_header.txt"
+_hdus_file = "hdus.fits"
+
+# Keywords describing a column of a binary table (followed by the number of the column)
+_column_keywords = ('TTYPE', 'TFORM', 'TUNIT', 'TNULL', 'TSCAL', 'TZERO', 'TDISP', 'TDIM', 'TLMIN', 'TLMAX', 'TDMIN',
+                    'TDMAX', 'TCTYP', 'TCRVL', 'TCDLT', 'TCRPX', 'TCUNI', 'TCROT')
+
+# Keywords describing the structure of the table, which are recomputed when writing a new file
+_structural_keywords = ('XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'PCOUNT', 'GCOUNT', 'TFIELDS')
+
+_column_keyword_pattern = re.compile(r"^(%s)(\d+)$" % "|".join(_column_keywords))
+
+
+def _file_signature(filename):
+
+    stat = os.stat(filename)
+
+    return {'path': filename, 'size': int(stat.st_size), 'mtime': float(stat.st_mtime)}
+
+
+def _row_type(n_rows):
+
+    return np.int32 if n_rows < 2 ** 31 else np.int64
+
+
+def save_rows(filename, rows, n_rows):
+    """
+    Save a list of rows of an event file (for example the events in hot pixels) in a sidecar file, so they can be
+    excluded when the events are read, without rewriting the event file
+
+    :param filename: the sidecar file (.npz)
+    :param rows: array of row indices
+    :param n_rows: number of rows of the event file (used to check that the sidecar is applied to the right file)
+    :return: None
+    """
+
+    rows = np.unique(np.asarray(rows)).astype(_row_type(n_rows))
+
+    with open(filename, "wb") as f:
+
+        np.savez(f, rows=rows, n_rows=n_rows)
+
+
+def load_rows(filename, n_rows=None):
+    """
+    Read a list of rows saved with save_rows
+
+    :param filename: the sidecar file
+    :param n_rows: if provided, check that the sidecar was made for an event file with this number of rows
+    :return: array of row indices (sorted)
+    """
+
+    with np.load(filename) as f:
+
+        rows = f['rows']
+
+        saved_n_rows = int(f['n_rows'])
+
+    if n_rows is not None and saved_n_rows != n_rows:
+
+        raise ValueError("The rows in %s refer to a file with %s rows, not %s" % (filename, saved_n_rows, n_rows))
+
+    return rows
+
+
+class EventStore(object):
+    def __init__(self, directory):
+        """
+        Open an existing event store (use EventStore.create to make a new one)
+
+        :param directory: directory of the store
+        """
+
+        self._directory = sanitize_filename(directory)
+
+        if not os.path.exists(os.path.join(self._directory, _meta_file)):
+
+            raise IOError("%s is not an event store" % self._directory)
+
+        self._load_meta()
+
+    @classmethod
+    def create(cls, directory, event_file, columns=None, chunk_size=_default_chunk_size):
+        """
+        Create an event store from the EVENTS extension of an event file. The file is read in blocks of rows, so
+        memory usage does not depend on the size of the file
+
+        :param directory: directory of the new store (if it exists, it is overwritten)
+        :param event_file: the event file
+        :param columns: dictionary column name -> data type of the columns to keep (default: default_columns)
+        :param chunk_size: number of rows read at once
+        :return: an EventStore instance
+        """
+
+        directory = sanitize_filename(directory)
+
+        if columns is None:
+
+            columns = default_columns
+
+        if os.path.exists(directory):
+
+            shutil.rmtree(directory)
+
+        os.makedirs(os.path.join(directory, "columns"))
+        os.makedirs(os.path.join(directory, "selections"))
+
+        event_file = sanitize_filename(event_file)
+
+        with pyfits.open(event_file, memmap=True) as hdulist:
+
+            events = hdulist['EVENTS']
+
+            data = events.data
+
+            n_rows = data.shape[0]
+
+            available = dict([(name.lower(), name) for name in data.columns.names])
+
+            # The original file is needed to write the FITS files with all the columns (see write_fits)
+
+            meta = {'n_rows': int(n_rows), 'columns': [], 'selections': {}, 'source': _file_signature(event_file)}
+
+            for name, dtype in columns.items():
+
+                if name.lower() not in available:
+
+                    raise ValueError("Column %s is not in %s" % (name, event_file))
+
+                field = data.field(available[name.lower()])
+
+                stored = np.lib.format.open_memmap(os.path.join(directory, "columns", "%s.npy" % name.lower()),
+                                                   mode='w+', dtype=dtype, shape=(n_rows,))
+
+                for start in range(0, n_rows, chunk_size):
+
+                    stored[start:start + chunk_size] = field[start:start + chunk_size]
+
+                stored.flush()
+
+                del stored
+
+                # Remember the type in the event file, to write FITS files like the original one
+
+                meta['columns'].append({'name': name.lower(), 'original_name': available[name.lower()],
+                                        'original_dtype': field.dtype.newbyteorder('=').str})
+
+            with open(os.path.join(directory, _header_file), "w+") as f:
+
+                f.write(events.header.tostring())
+
+            other_hdus = [hdu for hdu in hdulist[1:] if hdu is not events]
+
+            pyfits.HDUList([hdulist[0]] + other_hdus).writeto(os.path.join(directory, _hdus_file), overwrite=True)
+
+        with open(os.path.join(directory, _meta_file), "w+") as f:
+
+            yaml.dump(meta, f)
+
+        logger.info("Created event store in %s with %s events" % (directory, n_rows))
+
+        return cls(directory)
+
+    def _load_meta(self):
+
+        with open(os.path.join(self._directory, _meta_file)) as f:
+
+            self._meta = yaml.safe_load(f)
+
+    def _save_meta(self):
+
+        with open(os.path.join(self._directory, _meta_file), "w+") as f:
+
+            yaml.dump(self._meta, f)
+
+    @property
+    def directory(self):
+
+        return self._directory
+
+    @property
+    def n_rows(self):
+
+        return self._meta['n_rows']
+
+    @property
+    def columns(self):
+        """
+        Names of the columns in the store
+        """
+
+        return [column['name'] for column in self._meta['columns']]
+
+    @property
+    def selections(self):
+        """
+        Dictionary name -> description of the selections in the store
+        """
+
+        self._load_meta()
+
+        return dict(self._meta['selections'])
+
+    @property
+    def header(self):
+        """
+        Header of the EVENTS extension of the original file
+        """
+
+        with open(os.path.join(self._directory, _header_file)) as f:
+
+            return pyfits.Header.fromstring(f.read())
+
+    def column(self, name, rows=None):
+        """
+        Returns a column
+
+        :param name: name of the column (case insensitive)
+        :param rows: rows to return (an array of indices, a boolean mask, a slice or the name of a selection). If
+        None, the whole column is returned memory-mapped
+        :return: a numpy array
+        """
+
+        if name.lower() not in self.columns:
+
+            raise ValueError("Column %s is not in the store %s" % (name, self._directory))
+
+        values = np.load(os.path.join(self._directory, "columns", "%s.npy" % name.lower()), mmap_mode='r')
+
+        if rows is None:
+
+            return values
+
+        if isinstance(rows, str):
+
+            rows = self.get_selection(rows)
+
+        return values[rows]
+
+    def has_selection(self, name):
+
+        return name in self.selections
+
+    def add_selection(self, name, rows, description=''):
+        """
+        Record a selection of rows
+
+        :param name: name of the selection (an existing selection with the same name is replaced)
+        :param rows: a boolean mask over all the rows, or an array of row indices
+        :param description: description of the selection
+        :return: the array of row indices (sorted)
+        """
+
+        rows = np.asarray(rows)
+
+        if rows.dtype == bool:
+
+            if rows.shape[0] != self.n_rows:
+
+                raise ValueError("The mask has %s elements, but the store has %s rows" % (rows.shape[0],
+                                                                                          self.n_rows))
+
+            rows = np.flatnonzero(rows)
+
+        else:
+
+            rows = np.unique(rows)
+
+        rows = rows.astype(_row_type(self.n_rows))
+
+        np.save(os.path.join(self._directory, "selections", "%s.npy" % name), rows)
+
+        self._load_meta()
+
+        self._meta['selections'][name] = description
+
+        self._save_meta()
+
+        return rows
+
+    def get_selection(self, name):
+        """
+        Returns the rows of a selection
+
+        :param name: name of the selection
+        :return: array of row indices (memory-mapped), in increasing order (i.e., in time order for a file sorted
+        by time)
+        """
+
+        if not self.has_selection(name):
+
+            raise ValueError("Selection %s is not in the store %s" % (name, self._directory))
+
+        return np.load(os.path.join(self._directory, "selections", "%s.npy" % name), mmap_mode='r')
+
+    def select(self, name, mask, parent=None, description=''):
+        """
+        Record a selection derived from another one (or from all the events)
+
+        :param name: name of the new selection
+        :param mask: boolean mask over the rows of the parent selection
+        :param parent: name of the parent selection (None for all the events)
+        :param description: description of the selection
+        :return: the array of row indices
+        """
+
+        mask = np.asarray(mask, bool)
+
+        if parent is None:
+
+            return self.add_selection(name, mask, description)
+
+        parent_rows = self.get_selection(parent)
+
+        if mask.shape[0] != parent_rows.shape[0]:
+
+            raise ValueError("The mask has %s elements, but the selection %s has %s rows" % (mask.shape[0], parent,
+                                                                                             parent_rows.shape[0]))
+
+        return self.add_selection(name, parent_rows[mask], description)
+
+    def exclude(self, name, rows, parent=None, description=''):
+        """
+        Record a selection containing all the events except some rows (for example the events in hot pixels)
+
+        :param name: name of the new selection
+        :param rows: array of row indices (of the whole store) to exclude, or the name of a sidecar file written by
+        save_rows
+        :param parent: name of the selection to start from (None for all the events)
+        :param description: description of the selection
+        :return: the array of row indices
+        """
+
+        if isinstance(rows, str):
+
+            rows = load_rows(rows, self.n_rows)
+
+        mask = np.ones(self.n_rows, bool)
+
+        mask[np.asarray(rows)] = False
+
+        if parent is not None:
+
+            parent_mask = np.zeros(self.n_rows, bool)
+
+            parent_mask[self.get_selection(parent)] = True
+
+            mask &= parent_mask
+
+        return self.add_selection(name, mask, description)
+
+    def split_by_ccd(self, parent=None, prefix="ccd_"):
+        """
+        Record one selection for each CCD (named <prefix><ccd_id>)
+
+        :param parent: name of the selection to split (None for all the events)
+        :param prefix: prefix for the names of the selections
+        :return: dictionary ccd_id -> name of the selection, for the CCDs with at least one event
+        """
+
+        rows = self.get_selection(parent) if parent is not None else None
+
+        ccd_id = self.column("ccd_id", rows)
+
+        names = collections.OrderedDict()
+
+        for ccd in np.unique(ccd_id):
+
+            name = "%s%s" % (prefix, ccd)
+
+            self.select(name, ccd_id == ccd, parent, "Events of CCD %s" % ccd)
+
+            names[int(ccd)] = name
+
+        return names
+
+    def source_file(self):
+        """
+        Returns the event file the store was made from, or None if it is not available anymore (removed or modified
+        since the store was created)
+        """
+
+        source = self._meta.get('source')
+
+        if source is None or not os.path.exists(source['path']):
+
+            return None
+
+        if _file_signature(source['path']) != source:
+
+            return None
+
+        return source['path']
+
+    def _get_rows(self, rows):
+
+        # Sorted array of row indices (or None for all the rows)
+
+        if rows is None:
+
+            return None
+
+        if isinstance(rows, str):
+
+            return self.get_selection(rows)
+
+        rows = np.asarray(rows)
+
+        if rows.dtype == bool:
+
+            return np.flatnonzero(rows)
+
+        return np.unique(rows)
+
+    def write_fits(self, filename, rows=None):
+        """
+        Write an event file with the selected rows and all the columns of the original file (see write_fits_files)
+
+        :param filename: the new event file (overwritten if it exists)
+        :param rows: the rows to write (an array of indices, a boolean mask or the name of a selection). If None,
+        all the events are written
+        :return: None
+        """
+
+        self.write_fits_files({filename: rows})
+
+    def write_fits_files(self, outputs, chunk_size=_default_chunk_size):
+        """
+        Write event files with some of the rows (in the order of the original file). The rows are copied from the
+        original event file, so the new files have the same HDUs, header and columns as the original file (like a
+        dmcopy with a filter). The original file is read once, in blocks of rows, for all the new files.
+
+        If the original file is not available anymore, only the columns in the store are written (with a warning)
+
+        :param outputs: dictionary new event file -> rows to write (an array of indices, a boolean mask, the name of
+        a selection or None for all the events)
+        :param chunk_size: number of rows read at once
+        :return: None
+        """
+
+        outputs = collections.OrderedDict([(filename, self._get_rows(rows)) for filename, rows in outputs.items()])
+
+        source = self.source_file()
+
+        if source is None:
+
+            logger.warning("The original event file of the store %s is not available. Writing only the columns in the "
+                        "store" % self._directory)
+
+            for filename, rows in outputs.items():
+
+                self._write_stored_columns(filename, rows)
+
+            return
+
+        reader = EventFileReader(source, chunk_size=chunk_size)
+
+        writers = collections.OrderedDict()
+
+        try:
+
+            for filename, rows in outputs.items():
+
+                n_rows = reader.n_rows if rows is None else rows.shape[0]
+
+                writers[filename] = EventFileWriter(reader, filename, n_rows)
+
+            for first_row, raw in reader.iter_raw_chunks():
+
+                for filename, rows in outputs.items():
+
+                    if rows is None:
+
+                        writers[filename].write(raw)
+
+                        continue
+
+                    # Rows of this selection within this block
+
+                    start, stop = np.searchsorted(rows, [first_row, first_row + raw.shape[0]])
+
+                    writers[filename].write(raw[rows[start:stop] - first_row])
+
+        except:
+
+            # Do not leave the files open
+
+            for writer in writers.values():
+
+                writer.abort()
+
+            raise
+
+        for writer in writers.values():
+
+            writer.close()
+
+    def _write_stored_columns(self, filename, rows=None):
+
+        # Write an event file with the selected rows, with the header and the column formats of the original file
+        # (only the columns in the store are written)
+
+        original_header = self.header
+
+        # Number of each column in the original file
+
+        original_numbers = {}
+
+        for key in original_header:
+
+            if key.startswith("TTYPE"):
+
+                original_numbers[original_header[key].lower()] = int(key[5:])
+
+        fits_columns = []
+
+        for column in self._meta['columns']:
+
+            values = self.column(column['name'], rows)
+
+            number = original_numbers[column['original_name'].lower()]
+
+            fits_columns.append(pyfits.Column(name=column['original_name'],
+                                              format=original_header['TFORM%s' % number],
+                                              array=np.asarray(values, dtype=column['original_dtype'])))
+
+        events = pyfits.BinTableHDU.from_columns(fits_columns)
+
+        # Copy the keywords of the original header, renumbering those describing the columns
+
+        new_numbers = dict([(original_numbers[column['original_name'].lower()], i + 1)
+                            for i, column in enumerate(self._meta['columns'])])
+
+        for card in original_header.cards:
+
+            if card.keyword in _structural_keywords:
+
+                continue
+
+            match = _column_keyword_pattern.match(card.keyword)
+
+            if match is None:
+
+                events.header.append((card.keyword, card.value, card.comment))
+
+                continue
+
+            keyword, number = match.groups()
+
+            if keyword in ('TTYPE', 'TFORM') or int(number) not in new_numbers:
+
+                continue
+
+            events.header["%s%s" % (keyword, new_numbers[int(number)])] = (card.value, card.comment)
+
+        with pyfits.open(os.path.join(self._directory, _hdus_file)) as hdulist:
+
+            pyfits.HDUList([hdulist[0], events] + list(hdulist[1:])).writeto(filename, overwrite=True)
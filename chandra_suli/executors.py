@@ -0,0 +1,233 @@
+"""
+Backends used by submit_to_farm.py to execute farm_wrapper.py jobs, either on the batch farm (PBS) or on the
+local machine with a pool of processes
+"""
+
+import multiprocessing
+import os
+import subprocess
+import time
+
+from chandra_suli.job_packing import format_memory, format_walltime
+from chandra_suli.logging_system import get_logger
+
+logger = get_logger("executors")
+
+
+class FarmJob(object):
+    def __init__(self, name, options, memory, cpus=1, walltime=None, array_size=None):
+        """
+        A job running farm_wrapper.py
+
+        :param name: name of the job, used for the log files
+        :param options: command line options for farm_wrapper.py
+        :param memory: memory needed by the job (GB), for example from job_packing.CostModel
+        :param cpus: number of CPUs used by the job
+        :param walltime: expected wall time (s), or None if unknown
+        :param array_size: if not None, this is a job array with this number of elements (PBS only)
+        """
+
+        self.name = name
+        self.options = options
+        self.cpus = int(cpus)
+        self.memory = float(memory)
+        self.walltime = walltime
+        self.array_size = array_size
+
+
+class PBSExecutor(object):
+    def __init__(self, exe_path, log_path, ppn=4, test_run=False):
+
+        self._exe_path = exe_path
+        self._log_path = log_path
+        self._ppn = int(ppn)
+        self._test_run = bool(test_run)
+
+    def submit(self, job):
+
+        resources = "-l vmem=%s" % format_memory(job.memory)
+
+        if job.walltime is not None:
+
+            resources += " -l walltime=%s" % format_walltime(job.walltime)
+
+        resources += " -l nodes=1:ppn=%s" % self._ppn
+
+        if job.array_size is not None:
+
+            # PBS names the log files of each element of the array by itself
+
+            cmd_line = "qsub -t 0-%s %s -o %s -e %s -V " \
+                       "-F '%s' %s " % (job.array_size - 1, resources, self._log_path, self._log_path,
+                                        job.options, self._exe_path)
+
+        else:
+
+            cmd_line = "qsub %s -o %s/%s.out -e %s/%s.err -V " \
+                       "-F '%s' %s " % (resources, self._log_path, job.name, self._log_path, job.name,
+                                        job.options, self._exe_path)
+
+        print(cmd_line)
+
+        if not self._test_run:
+            subprocess.check_call(cmd_line, shell=True)
+
+    def wait(self):
+        """
+        Nothing to do, the jobs are now in the hands of the batch system
+
+        :return: an empty list (no failed jobs known)
+        """
+
+        return []
+
+
+def _get_physical_memory():
+    """
+    Returns the amount of physical memory of this machine in GB
+    """
+
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.0 ** 3
+
+
+class LocalExecutor(object):
+    def __init__(self, exe_path, log_path, max_cpus=None, max_memory=None, scratch_dir=None,
+                 poll_interval=5.0, test_run=False):
+        """
+        Run the jobs on this machine, keeping as many of them running at the same time as allowed by the global
+        CPU and memory budget
+
+        :param exe_path: path to farm_wrapper.py
+        :param log_path: directory for the log files (one .out and one .err file for each job)
+        :param max_cpus: number of CPUs that can be used at the same time (default: all)
+        :param max_memory: memory (GB) that can be used at the same time (default: all the physical memory)
+        :param scratch_dir: directory where farm_wrapper.py will create its work directories (default: let
+        farm_wrapper.py decide according to the free memory)
+        :param poll_interval: how often to check for finished jobs (s)
+        :param test_run: if True, only print the command lines
+        """
+
+        self._exe_path = exe_path
+        self._log_path = log_path
+
+        if max_cpus is None:
+
+            max_cpus = multiprocessing.cpu_count()
+
+        if max_memory is None:
+
+            max_memory = _get_physical_memory()
+
+        self._max_cpus = int(max_cpus)
+        self._max_memory = float(max_memory)
+
+        self._scratch_dir = scratch_dir
+        self._poll_interval = float(poll_interval)
+        self._test_run = bool(test_run)
+
+        self._pending = []
+
+    def submit(self, job):
+
+        if job.array_size is not None:
+            raise RuntimeError("Job arrays are not supported by the local executor")
+
+        if job.cpus > self._max_cpus or job.memory > self._max_memory:
+
+            logger.warning("Job %s needs more resources than the budget (%s CPUs, %.1f GB). It will run alone."
+                        % (job.name, self._max_cpus, self._max_memory))
+
+        self._pending.append(job)
+
+    def _get_cmd_line(self, job):
+
+        cmd_line = "%s %s" % (self._exe_path, job.options)
+
+        if self._scratch_dir is not None:
+
+            cmd_line += " --scratch_dir %s" % self._scratch_dir
+
+        return cmd_line
+
+    def _launch(self, job):
+
+        cmd_line = self._get_cmd_line(job)
+
+        logger.info("Starting job %s: %s" % (job.name, cmd_line))
+
+        out_file = open(os.path.join(self._log_path, "%s.out" % job.name), "w+")
+        err_file = open(os.path.join(self._log_path, "%s.err" % job.name), "w+")
+
+        process = subprocess.Popen(cmd_line, shell=True, stdout=out_file, stderr=err_file)
+
+        return job, process, out_file, err_file
+
+    def wait(self):
+        """
+        Run all the submitted jobs and wait for them to finish
+
+        :return: list of the names of the jobs which failed
+        """
+
+        if self._test_run:
+
+            for job in self._pending:
+
+                print(self._get_cmd_line(job))
+
+            self._pending = []
+
+            return []
+
+        running = []
+
+        failed = []
+
+        while len(self._pending) > 0 or len(running) > 0:
+
+            # Collect finished jobs
+
+            for item in list(running):
+
+                job, process, out_file, err_file = item
+
+                if process.poll() is not None:
+
+                    out_file.close()
+                    err_file.close()
+
+                    running.remove(item)
+
+                    if process.returncode != 0:
+
+                        logger.error("Job %s failed with code %s" % (job.name, process.returncode))
+
+                        failed.append(job.name)
+
+                    else:
+
+                        logger.info("Job %s completed" % job.name)
+
+            # Start as many pending jobs as the budget allows. A job later in the queue can start before
+            # an earlier one which is too big to fit right now
+
+            for job in list(self._pending):
+
+                used_cpus = sum([item[0].cpus for item in running])
+                used_memory = sum([item[0].memory for item in running])
+
+                fits = (used_cpus + job.cpus <= self._max_cpus) and (used_memory + job.memory <= self._max_memory)
+
+                # A job larger than the whole budget is run alone
+
+                if fits or len(running) == 0:
+
+                    self._pending.remove(job)
+
+                    running.append(self._launch(job))
+
+            if len(running) > 0:
+
+                time.sleep(self._poll_interval)
+
+        return failed
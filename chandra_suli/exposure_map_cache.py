@@ -0,0 +1,150 @@
+"""
+Cache of exposure maps filtered for the regions of the sources (cheese-masked), so that xtcheesemask runs at most once
+for each configuration. The filtered maps are stored in the data package of the obsid
+"""
+
+import hashlib
+import os
+
+import astropy.io.fits as pyfits
+
+from chandra_suli.data_package import md5sum
+from chandra_suli.logging_system import get_logger
+
+logger = get_logger("exposure_map_cache")
+
+
+def filter_exposure_map(exposure_map, regions_file, eventfile, new_exposure_map, runner, resample_factor=1):
+    """
+    Remove the regions from the exposure map using xtcheesemask
+
+    :param exposure_map: input exposure map
+    :param regions_file: FITS file with the SRCREG extension, or ds9 region file (.reg)
+    :param eventfile: event file for the CCD, used to get the WCS and the characteristics of the CCD
+    :param new_exposure_map: output exposure map (must not exist)
+    :param runner: a CommandRunner instance
+    :param resample_factor: oversample the exposure map by this factor
+    :return: None
+    """
+
+    if regions_file.find(".reg") < 0:
+
+        # Generate an almost empty event file which will be used by xtcheesemask to extract the WCS and the
+        # characteristics of the hardware unit (i.e., of the ccd)
+
+        with pyfits.open(eventfile) as f:
+
+            small_data = f['EVENTS'].data[:2]
+            header = f['EVENTS'].header
+
+        new_hdu = pyfits.BinTableHDU(data=small_data, header=header)
+
+        # Now append the region table
+
+        with pyfits.open(regions_file) as f:
+
+            region_hdu = f['SRCREG']
+
+            hdu_list = pyfits.HDUList([pyfits.PrimaryHDU(), new_hdu, region_hdu])
+
+            temp_file = '___2_events.fits'
+
+            hdu_list.writeto(temp_file, overwrite=True)
+
+    else:
+
+        temp_file = None
+
+    cmd_line = "xtcheesemask.py -i %s -r %s -o %s -s %s --no-reverse" \
+               % (exposure_map, temp_file if temp_file is not None else regions_file, new_exposure_map,
+                  resample_factor)
+
+    runner.run(cmd_line)
+
+    if temp_file is not None:
+
+        os.remove(temp_file)
+
+
+class ExposureMapCache(object):
+    def __init__(self, data_package, runner):
+        """
+        :param data_package: the (writable) data package of the obsid, where the filtered maps are stored
+        :param runner: a CommandRunner instance
+        """
+
+        self._package = data_package
+
+        self._runner = runner
+
+    @staticmethod
+    def get_key(exposure_map, regions_file, ccd, streak_regions=None, resample_factor=1):
+        """
+        Returns the key identifying a configuration: the content of the exposure map and of the region files,
+        the CCD and the resample factor
+
+        :return: a short string
+        """
+
+        key = hashlib.md5()
+
+        for filename in [exposure_map, regions_file, streak_regions]:
+
+            key.update(md5sum(filename).encode() if filename is not None else b"None")
+
+        key.update(("%s_%s" % (ccd, resample_factor)).encode())
+
+        return key.hexdigest()[:12]
+
+    def get(self, exposure_map, regions_file, event_file, ccd, streak_regions=None, resample_factor=1):
+        """
+        Returns the exposure map filtered for the regions (and for the streaks, if provided), computing it only
+        if it is not already in the cache
+
+        :param exposure_map: input exposure map (exp3)
+        :param regions_file: FITS file with the regions of all sources
+        :param event_file: event file for the CCD
+        :param ccd: CCD number
+        :param streak_regions: ds9 region file with the readout streaks, or None
+        :param resample_factor: oversample the exposure map by this factor
+        :return: path of the filtered exposure map (inside the data package, do not modify it)
+        """
+
+        key = self.get_key(exposure_map, regions_file, ccd, streak_regions, resample_factor)
+
+        tag = "ccd_%s_expomap_%s" % (ccd, key)
+
+        if self._package.has(tag):
+
+            logger.info("Using cached filtered exposure map for CCD %s (%s)" % (ccd, key))
+
+            return self._package.get_path(tag)
+
+        filtered_expomap = "%s.fits" % tag
+
+        # xtcheesemask cannot overwrite files, so delete the file if existing
+
+        if os.path.exists(filtered_expomap):
+
+            os.remove(filtered_expomap)
+
+        filter_exposure_map(exposure_map, regions_file, event_file, filtered_expomap, self._runner,
+                            resample_factor=resample_factor)
+
+        if streak_regions is not None:
+
+            # Filter also for the streaks
+
+            temp_file = '__expomap_temp.fits'
+
+            filter_exposure_map(filtered_expomap, streak_regions, event_file, temp_file, self._runner,
+                                resample_factor=resample_factor)
+
+            os.remove(filtered_expomap)
+            os.rename(temp_file, filtered_expomap)
+
+        self._package.store(tag, filtered_expomap,
+                            "Expomap for CCD %s, filtered for all the regions which have been used for the "
+                            "event file (resample factor %s)" % (ccd, resample_factor), move=True)
+
+        return self._package.get_path(tag)
@@ -7,12 +7,12 @@ Download files by observation ID
 import argparse
 import os
 import sys
+import time
 
-from chandra_suli import find_files
 from chandra_suli import logging_system
-from chandra_suli.data_package import DataPackage
+from chandra_suli.archive_mirror import ArchiveMirror
+from chandra_suli.download_manager import DownloadManager, UrlArchive, compression_policy, fetch_from_archive
 from chandra_suli.run_command import CommandRunner
-from chandra_suli.work_within_directory import work_within_directory
 
 if __name__ == "__main__":
 
@@ -26,6 +26,40 @@ if __name__ == "__main__":
 
     parser.add_argument("-o", "--obsid", help="Observation ID Numbers", type=int, required=True, nargs='+')
 
+    parser.add_argument("-c", "--max_concurrent", help="Maximum number of downloads running at the same time "
+                                                       "(default: 2)", type=int, default=2, required=False)
+
+    parser.add_argument("--prefetch", help="Maximum number of obsids downloaded in advance, while the previous ones "
+                                           "are being processed (default: 2)", type=int, default=2, required=False)
+
+    parser.add_argument("--max_retries", help="Number of times a failed download is retried (default: 3)",
+                        type=int, default=3, required=False)
+
+    parser.add_argument("--backoff", help="Waiting time before the first retry of a failed download. It doubles at "
+                                          "each following retry (default: 30 s)", type=float, default=30.0,
+                        required=False)
+
+    parser.add_argument("--archive_url", help="Download from this mirror of the archive (file:// or http://, "
+                                              "see download_manager.UrlArchive) instead of using the CIAO tools",
+                        type=str, default=None, required=False)
+
+    parser.add_argument("--no_header_update", help="Do not run r4_header_update on the event files",
+                        action="store_true")
+
+    parser.add_argument("--mirror", help="Directory of a local mirror of the archive. The obsids in the mirror are "
+                                         "not downloaded again, the others are added to it", type=str, default=None,
+                        required=False)
+
+    parser.add_argument("--mirror_size", help="Maximum size of the mirror in GB. When it is exceeded, the obsids used "
+                                              "least recently are evicted (default: no limit)", type=float,
+                        default=None, required=False)
+
+    parser.add_argument("--compression", help="Change how a type of file is stored, as type=policy, where policy is "
+                                              "keep, uncompress, compress or tile (for example: exp3=tile). "
+                                              "Default: %s" % ", ".join(["%s=%s" % item for item in
+                                                                         sorted(compression_policy.items())]),
+                        type=str, nargs='*', default=[], required=False)
+
     args = parser.parse_args()
 
     # Get the logger
@@ -38,54 +72,67 @@ if __name__ == "__main__":
     workdir = os.path.abspath(os.path.expandvars(os.path.expanduser(args.workdir)))
     regdir = os.path.abspath(os.path.expandvars(os.path.expanduser(args.region_repo)))
 
-    with work_within_directory(workdir):
+    # Download only the obsids with region files
+
+    obsids = []
+
+    for this_obsid in args.obsid:
+
+        regdir_this_obsid = os.path.join(regdir, str(this_obsid))
+
+        if os.path.exists(regdir_this_obsid):
+
+            obsids.append(this_obsid)
+
+        else:
+
+            print "Region files do not exist for ObsID %s" % this_obsid
+
+    policy = dict(compression_policy)
+
+    for setting in args.compression:
+
+        file_type, _, file_policy = setting.partition("=")
+
+        if file_type not in policy or file_policy not in ('keep', 'uncompress', 'compress', 'tile'):
+
+            raise ValueError("Invalid compression setting %s" % setting)
+
+        policy[file_type] = file_policy
 
-        # Download files
+    if args.archive_url is not None:
 
-        for this_obsid in args.obsid:
+        fetch = UrlArchive(args.archive_url, policy)
 
-            regdir_this_obsid = os.path.join(regdir, str(this_obsid))
+    else:
 
-            if os.path.exists(regdir_this_obsid):
+        fetch = fetch_from_archive
 
-                cmd_line = "download_by_obsid.py --obsid %d" % this_obsid
+    if args.mirror is not None:
 
-                runner.run(cmd_line)
+        max_size = args.mirror_size * 1024 ** 3 if args.mirror_size is not None else None
 
-                try:
+        mirror = ArchiveMirror(args.mirror, max_size)
 
-                    evtfile = os.path.basename(find_files.find_files(os.getcwd(), '*%s*evt3.fits' % this_obsid)[0])
-                    tsvfile = os.path.basename(find_files.find_files(os.getcwd(), "%s.tsv" % this_obsid)[0])
-                    expmap = os.path.basename(find_files.find_files(os.getcwd(), "*%s*exp3.fits*" % this_obsid)[0])
-                    fov = os.path.basename(find_files.find_files(os.getcwd(), "*%s*fov3.fits*" % this_obsid)[0])
+    else:
 
-                except IndexError:
+        mirror = None
 
-                    raise RuntimeError("\n\n\nCould not find one of the downloaded files for obsid %s. Exiting..."
-                                       % this_obsid)
+    manager = DownloadManager(fetch, runner, max_concurrent=args.max_concurrent, prefetch=args.prefetch,
+                              max_retries=args.max_retries, backoff=args.backoff,
+                              header_update=not args.no_header_update, mirror=mirror, policy=policy)
 
-                data_package = DataPackage(str(this_obsid), create=True)
+    # Each obsid is stored in the data package <workdir>/<obsid> (obsids already downloaded are skipped)
 
-                data_package.store("evt3", evtfile, "Event file (Level 3) from the CSC", move=True)
-                data_package.store("tsv", tsvfile, "TSV file from the CSC", move=True)
-                data_package.store("exp3", expmap, "Exposure map (Level 3) from the CSC", move=True)
-                data_package.store("fov3", fov, "FOV file (Level 3) from the CSC", move=True)
+    start = time.time()
 
-                # Make the data package read-only so we cannot change files by accident
+    downloaded, skipped, failed = manager.download(obsids, workdir)
 
-                data_package.read_only = True
+    stored = sum([statistics['package_size'] for statistics in manager.statistics.values()])
 
-                # # Create directory named after obsid
-                # if not os.path.exists(str(this_obsid)):
-                #
-                #     os.mkdir(str(this_obsid))
-                #
-                # # Move files in there
-                #
-                # os.rename(evtfile, os.path.join(str(this_obsid), evtfile))
-                # os.rename(tsvfile, os.path.join(str(this_obsid), tsvfile))
-                # os.rename(expmap, os.path.join(str(this_obsid), expmap))
+    logger.info("Downloaded %s obsids in %.1f s (%.1f GB stored), skipped %s already complete"
+                % (len(downloaded), time.time() - start, stored / 1024.0 ** 3, len(skipped)))
 
-            else:
+    if len(failed) > 0:
 
-                print "Region files do not exist for ObsID %s" % this_obsid
+        raise RuntimeError("\n\n\nCould not download obsids %s. Exiting..." % ", ".join(map(str, failed.keys())))
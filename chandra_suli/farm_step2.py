@@ -1,171 +1,159 @@
 #!/usr/bin/env python
 
 """
-Filter the event file and the exposure map, divide by CCD, then run xtdac on each CCD
+Filter the event file and the exposure map, divide by CCD, then run xtdac on each CCD.
+
+With --batch, the obsids are processed in a pipeline: while xtdac runs on the CCDs of one obsid (CPU bound) in this
+process, the next obsid is filtered and split by CCD (I/O bound) in a helper process. The region database, the
+source catalog and the PSF are loaded only once for all the obsids.
 """
 
 import argparse
 import glob
+import multiprocessing
 import os
+import shutil
 import sys
 
-import astropy.io.fits as pyfits
-
+from chandra_suli import chandra_psf
+from chandra_suli import event_slicer
 from chandra_suli import find_files
 from chandra_suli import logging_system
+from chandra_suli import query_region_db
+from chandra_suli import scratch_manager
+from chandra_suli.candidate_pipeline import add_to_master_list, flag_hot_pixels, flag_variable_sources, \
+    hot_pixel_columns, iter_records, variable_source_columns, write_records
+from chandra_suli.candidate_table import read_candidates
+from chandra_suli.chandra_catalog import get_catalog
 from chandra_suli.data_package import DataPackage
+from chandra_suli.exposure_map_cache import ExposureMapCache
+from chandra_suli.master_list import MasterList
 from chandra_suli.run_command import CommandRunner
+from chandra_suli.sanitize_filename import sanitize_filename
+from chandra_suli.work_within_directory import work_within_directory
 
 
-def filter_exposure_map(exposure_map, regions_file, eventfile, new_exposure_map, resample_factor=1):
-    if regions_file.find(".reg") < 0:
-
-        # Generate an almost empty event file which will be used by xtcheesemask to extract the WCS and the
-        # characteristics of the hardware unit (i.e., of the ccd)
-
-        with pyfits.open(eventfile) as f:
+def prepare_obsid(obsid, args, runner, workdir='.'):
+    """
+    Filter the event file of the obsid, remove the hot pixels and separate the CCDs. The products are registered in
+    the output package (the directory <obsid> in the current directory)
 
-            small_data = f['EVENTS'].data[:2]
-            header = f['EVENTS'].header
+    :param obsid: the obsid
+    :param args: the command line arguments
+    :param runner: a CommandRunner instance
+    :param workdir: directory where the intermediate files and the event files for each CCD are written
+    :return: list of the event files for each CCD
+    """
 
-        new_hdu = pyfits.BinTableHDU(data=small_data, header=header)
+    # Get the data package for the input data
+    data_package = DataPackage(os.path.join(args.datarepository, str(obsid)))
 
-        # Now append the region table
+    # NOTE: the input files are only read, so they are used directly from the input package, without copying
+    # them here
 
-        with pyfits.open(regions_file) as f:
+    # Prepare output package
 
-            region_hdu = f['SRCREG']
+    out_package = DataPackage(os.path.abspath(str(obsid)), create=True)
 
-            hdu_list = pyfits.HDUList([pyfits.PrimaryHDU(), new_hdu, region_hdu])
-
-            temp_file = '___2_events.fits'
-
-            hdu_list.writeto(temp_file, clobber=True)
-
-    else:
-
-        temp_file = regions_file
-
-    cmd_line = "xtcheesemask.py -i %s -r %s -o %s -s %s --no-reverse" \
-               % (exposure_map, temp_file, new_exposure_map, resample_factor)
-
-    runner.run(cmd_line)
-
-    os.remove(temp_file)
-
-
-if __name__ == "__main__":
+    # Make sure it is empty, otherwise emtpy it
+    out_package.clear()
 
-    parser = argparse.ArgumentParser(description='Run Bayesian Block algorithm')
+    with work_within_directory(workdir):
 
-    parser.add_argument("-d", "--datarepository", help="Path to the data repository, where all the packages for all "
-                                                       "observations are", type=str, required=True)
+        #######################################
+        # Filtering
+        #######################################
 
-    parser.add_argument("-o", "--obsid", help="Observation ID Numbers", type=int, required=True, nargs="+")
+        # Figure out the path for the regions files for this obsid
 
-    parser.add_argument('-r', '--region_repo', help="Path to the repository of region files",
-                        type=str, required=True)
+        region_dir = os.path.join(args.region_repo, '%s' % obsid)
 
-    parser.add_argument('-a', "--adj_factor",
-                        help="If region files need to be adjusted, what factor to increase axes of ellipses by",
-                        type=float, required=True)
+        cmd_line = "filter_event_file.py --region_dir %s --in_package %s --out_package %s --emin %d --emax %d " \
+                   "--adj_factor %s --randomize_time" \
+                   % (region_dir, data_package.location, out_package.location,
+                      args.emin, args.emax, args.adj_factor)
 
-    parser.add_argument("-e1", "--emin", help="Minimum energy (eV)", type=int, required=True)
+        runner.run(cmd_line)
 
-    parser.add_argument("-e2", "--emax", help="Maximum energy (eV)", type=int, required=True)
+        # Products are: filtered_evt3, all_regions and (if any) streak_regions_ds9
 
-    parser.add_argument("-c", "--ncpus", help="Number of CPUs to use (default=1)",
-                        type=int, default=1, required=False)
+        scratch_manager.evict()
 
-    parser.add_argument("-p", "--typeIerror",
-                        help="Type I error probability for the Bayesian Blocks algorithm.",
-                        type=float,
-                        default=1e-5,
-                        required=False)
+        ###### Remove hot pixels
 
-    parser.add_argument("-s", "--sigmaThreshold",
-                        help="Threshold for the final significance. All intervals found "
-                             "by the bayesian blocks "
-                             "algorithm which does not surpass this threshold will not be saved in the "
-                             "final file.",
-                        type=float,
-                        default=5.0,
-                        required=False)
+        # The events in hot pixels are not removed from the event file: their rows are saved in a sidecar file,
+        # which is applied when separating the CCDs
 
-    parser.add_argument("-m", "--multiplicity", help="Control the overlap of the regions."
-                                                     " A multiplicity of 2 means the centers of the regions are"
-                                                     " shifted by 1/2 of the region size (they overlap by 50 percent),"
-                                                     " a multiplicity of 4 means they are shifted by 1/4 of "
-                                                     " their size (they overlap by 75 percent), and so on.",
-                        required=False, default=2.0, type=float)
+        hot_pixels_file = '%s_hot_pixels.npz' % obsid
 
-    parser.add_argument("-v", "--verbosity", help="Info or debug", type=str, required=False, default='info',
-                        choices=['info', 'debug'])
+        cmd_line = "prefilter_hot_pixels.py --evtfile %s --outfile %s" % (out_package.get_path('filtered_evt3'),
+                                                                             hot_pixels_file)
 
-    # Get the logger
-    logger = logging_system.get_logger(os.path.basename(sys.argv[0]))
+        runner.run(cmd_line)
 
-    # Get the command runner
-    runner = CommandRunner(logger)
+        out_package.store('hot_pixels', hot_pixels_file, "Rows of the filtered event file (evt3) containing events "
+                                                         "in hot pixels", move=True)
 
-    args = parser.parse_args()
+        #######################################
+        # Separate CCDs
+        #######################################
 
-    for this_obsid in args.obsid:
+        # The events are loaded in a columnar event store (one per obsid), where each CCD is a selection of rows,
+        # and the event files for the CCDs are written from there (without the events in hot pixels)
 
-        # Get the data package for the input data
-        data_package = DataPackage(os.path.join(args.datarepository, str(this_obsid)))
+        cmd_line = "separate_CCD.py --evtfile %s --store %s_events.store --exclude %s --name %s_filtered_nohot.fits" \
+                   % (out_package.get_path('filtered_evt3'), obsid, out_package.get_path('hot_pixels'), obsid)
 
-        # NOTE: .get() will copy the file here
+        runner.run(cmd_line)
 
-        evtfile = data_package.get('evt3')
-        tsvfile = data_package.get('tsv')
-        expfile = data_package.get('exp3')
+        # The event store is not needed anymore, once the files for the CCDs are written
 
-        # Prepare output package
+        scratch_manager.evict()
 
-        out_package = DataPackage(str(this_obsid), create=True)
+        return find_files.find_files('.', 'ccd*%s*fits' % obsid)
 
-        # Make sure it is empty, otherwise emtpy it
-        out_package.clear()
 
-        #######################################
-        # Filtering
-        #######################################
+def search_obsid(obsid, ccd_files, args, runner, csc, psf, workdir='.'):
+    """
+    Run xtdac on each CCD of the obsid (prepared by prepare_obsid), filter the candidates and make the list of all
+    candidates
 
-        # Figure out the path for the regions files for this obsid
+    :param obsid: the obsid
+    :param ccd_files: the event files for each CCD
+    :param args: the command line arguments
+    :param runner: a CommandRunner instance
+    :param csc: a ChandraSourceCatalog instance
+    :param psf: a ChandraPSF instance
+    :param workdir: directory where the products are written before being registered in the output package
+    :return: None
+    """
 
-        region_dir = os.path.join(os.path.expandvars(os.path.expanduser(args.region_repo)), '%s' % this_obsid)
+    # Get the data package for the input data
+    data_package = DataPackage(os.path.join(args.datarepository, str(obsid)))
 
-        cmd_line = "filter_event_file.py --region_dir %s --in_package %s --out_package %s --emin %d --emax %d " \
-                   "--adj_factor %s --randomize_time" \
-                   % (region_dir, data_package.location, out_package.location,
-                      args.emin, args.emax, args.adj_factor)
+    out_package = DataPackage(os.path.abspath(str(obsid)))
 
-        runner.run(cmd_line)
+    # Prepare the package where the products are streamed to, if needed
 
-        # Products are: filtered_evt3, all_regions and (if any) streak_regions_ds9
+    if args.stream_to is not None:
 
-        ###### Remove hot pixels
+        final_package = DataPackage(os.path.join(sanitize_filename(args.stream_to), str(obsid)), create=True)
 
-        events_no_hot_pixels = '%s_filtered_nohot.fits' % this_obsid
+        final_package.clear()
 
-        cmd_line = "prefilter_hot_pixels.py --evtfile %s --outfile %s" % (out_package.get('filtered_evt3').filename,
-                                                                             events_no_hot_pixels)
+    else:
 
-        runner.run(cmd_line)
+        final_package = out_package
 
-        out_package.store('filtered_nohot', events_no_hot_pixels,
-                          "Filtered event file (evt3) with events in hot pixels removed")
+    # The filtered exposure maps are cached in the output package
 
-        #######################################
-        # Separate CCDs
-        #######################################
+    expomap_cache = ExposureMapCache(out_package, runner)
 
-        cmd_line = "separate_CCD.py --evtfile %s" % out_package.get('filtered_nohot').filename
+    with work_within_directory(workdir):
 
-        runner.run(cmd_line)
+        # Candidates of all CCDs, after filtering
 
-        ccd_files = find_files.find_files('.', 'ccd*%s*fits' % this_obsid)
+        obsid_records = []
 
         #######################################
         # Run Bayesian Block on each CCD
@@ -183,42 +171,22 @@ if __name__ == "__main__":
             logger.info("Processing CCD %s..." % ccd_number)
             logger.info("########################################")
 
-            # First filter the exposure map
-
-            filtered_expomap = 'ccd_%s_filtered_expomap.fits' % ccd_number
-
-            # xtcheesemask, used by filter_exposure_map, cannot overwrite files, so delete the file
-            # if existing
-
-            try:
-
-                os.remove(filtered_expomap)
-
-            except:
-
-                pass
-
-            # NOTE: use only a resample factor of 1, or the destreaking will fail
-
-            filter_exposure_map(data_package.get('exp3').filename, out_package.get('all_regions').filename,
-                                ccd_file, filtered_expomap, resample_factor=1)
+            # First filter the exposure map (for the streaks as well, if any). The result is registered in
+            # the output package
 
             if out_package.has('streak_regions_ds9'):
-                # Filter also for the streaks
 
-                temp_file = '__expomap_temp.fits'
+                streak_regions = out_package.get_path('streak_regions_ds9')
 
-                filter_exposure_map(filtered_expomap, out_package.get('streak_regions_ds9').filename,
-                                    ccd_file, temp_file, resample_factor=1)
+            else:
 
-                os.remove(filtered_expomap)
-                os.rename(temp_file, filtered_expomap)
+                streak_regions = None
 
-            # Register the filtered expomap
+            # NOTE: use only a resample factor of 1, or the destreaking will fail
 
-            out_package.store('ccd_%s_filtered_expomap' % ccd_number, filtered_expomap,
-                              "Expomap for CCD %s, filtered for all the regions which have been "
-                              "used for the event file" % ccd_number)
+            filtered_expomap = expomap_cache.get(data_package.get_path('exp3'), out_package.get_path('all_regions'),
+                                                 ccd_file, ccd_number, streak_regions=streak_regions,
+                                                 resample_factor=1)
 
             ###### XTDAC #########
 
@@ -233,17 +201,17 @@ if __name__ == "__main__":
 
             # Now register the output in the output data package
 
-            raw_candidate_list_file = "ccd_%s_%s_filtered_nohot_res.txt" % (ccd_number, this_obsid)
+            raw_candidate_list_file = "ccd_%s_%s_filtered_nohot_res.txt" % (ccd_number, obsid)
 
             out_package.store("ccd_%s_raw_list" % ccd_number, raw_candidate_list_file,
                               "Unfiltered list of candidates for CCD %s (output of xtdac)" % ccd_number)
 
             out_package.store("ccd_%s_xtdac_html" % ccd_number, "ccd_%s_%s_filtered_nohot_res.html" % (ccd_number,
-                                                                                                       this_obsid),
+                                                                                                       obsid),
                               "HTML file produced by xtdac, containing the unfiltered list of candidates "
                               "for ccd %s" % ccd_number)
 
-            output_files = glob.glob("ccd_%s_%s_*candidate*.reg" % (ccd_number, this_obsid))
+            output_files = glob.glob("ccd_%s_%s_*candidate*.reg" % (ccd_number, obsid))
 
             for i, output in enumerate(output_files):
                 reg_id = output.split("_")[-1].split(".reg")[0]
@@ -255,41 +223,88 @@ if __name__ == "__main__":
             # Filter candidate list
             #######################################
 
-            # Hot pixels
+            # The candidates go through the hot pixel check and the cross match with the variable sources in this
+            # process, without intermediate files (unless requested)
 
-            check_hp_file = "check_hp_%s_%s.txt" % (ccd_number, this_obsid)
+            candidates = read_candidates(raw_candidate_list_file)
 
-            cmd_line = "check_hot_pixel_revised.py --obsid %s --evtfile %s --bbfile %s --outfile %s --debug no" \
-                       % (this_obsid, ccd_file, raw_candidate_list_file, check_hp_file)
+            records = flag_hot_pixels(iter_records(candidates), obsid, ccd_file, runner)
 
-            runner.run(cmd_line)
+            # (the names of the columns are needed to write the lists also when there are no candidates left)
 
-            # Register output
+            check_hp_columns = hot_pixel_columns(candidates.dtype.names)
 
-            out_package.store("ccd_%s_check_hp" % ccd_number, check_hp_file,
-                              "List of candidates for CCD %s with hot pixels flagged" % ccd_number)
+            if args.debug_files:
 
-            # Variable sources
+                check_hp_file = "check_hp_%s_%s.txt" % (ccd_number, obsid)
 
-            check_var_file = "check_var_%s_%s.txt" % (ccd_number, this_obsid)
+                records = write_records(check_hp_file, records, check_hp_columns)
 
-            cmd_line = "check_variable_revised.py --bbfile %s --outfile %s --eventfile %s" \
-                       % (check_hp_file, check_var_file, ccd_file)
+            records = flag_variable_sources(records, ccd_file, csc, psf)
 
-            runner.run(cmd_line)
+            if args.debug_files:
+
+                check_var_file = "check_var_%s_%s.txt" % (ccd_number, obsid)
+
+                records = write_records(check_var_file, records, variable_source_columns(check_hp_columns))
+
+            obsid_records.extend(records)
+
+            # Close the event file of this CCD, which the hot pixel check keeps open and memory-mapped (otherwise
+            # the files of all the CCDs, and of all the obsids in batch mode, stay open until the end)
+
+            event_slicer.release(ccd_file)
+
+            scratch_manager.evict()
 
-            # Register output
+            if args.debug_files:
 
-            out_package.store("ccd_%s_check_var" % ccd_number, check_var_file,
-                              "List of candidates for CCD %s with hot pixels and variable sources flagged" % ccd_number)
+                out_package.store("ccd_%s_check_hp" % ccd_number, check_hp_file,
+                                  "List of candidates for CCD %s with hot pixels flagged" % ccd_number)
+
+                out_package.store("ccd_%s_check_var" % ccd_number, check_var_file,
+                                  "List of candidates for CCD %s with hot pixels and variable sources flagged"
+                                  % ccd_number)
+
+            #######################################
+            # Stream out the products for this CCD
+            #######################################
+
+            if args.stream_to is not None:
+
+                for tag in out_package.find_all("ccd_%s_*" % ccd_number):
+
+                    # Remove also the copy in the current directory (the package has its own copy)
+
+                    local_copy = os.path.basename(out_package.get_path(tag))
+
+                    out_package.transfer(tag, final_package)
+
+                    if os.path.exists(local_copy):
+
+                        os.remove(local_copy)
+
+                # The event file for this CCD is not needed anymore (it was released above)
+
+                os.remove(ccd_file)
 
         # Now add candidates to master list (one list for this obsid)
 
-        candidate_file = "%s_all_candidates.txt" % this_obsid
+        candidate_file = "%s_all_candidates.txt" % obsid
 
-        cmd_line = "add_to_masterlist.py --package %s --masterfile %s" % (out_package.location, candidate_file)
+        # The master list of this obsid is used only to write the list, so it is kept in memory
 
-        runner.run(cmd_line)
+        master_list = MasterList(":memory:")
+
+        n_added = add_to_master_list(obsid_records, master_list)
+
+        # Write the list sorted according to the last column (PSFfrac)
+
+        if n_added > 0:
+
+            master_list.export(candidate_file)
+
+        master_list.close()
 
         # Reopen the file and write the command line which generated this analysis as a comment
         with open(candidate_file, "a") as f:
@@ -297,3 +312,185 @@ if __name__ == "__main__":
             f.write("\n# command line:\n# %s\n" % " ".join(sys.argv))
 
         out_package.store("candidates", candidate_file, "List of all candidates found in all CCDs")
+
+        # Stream out whatever is left
+
+        if args.stream_to is not None:
+
+            for tag in out_package.find_all("*"):
+
+                out_package.transfer(tag, final_package)
+
+
+# Command runner of the helper process which prepares the obsids in batch mode (see _init_preparation_worker)
+_worker_runner = None
+
+
+def _init_preparation_worker(pfiles_dir):
+
+    global _worker_runner
+
+    # Use a private copy of the parameter files, so the ftools run by the helper process do not interfere with those
+    # run at the same time by the main process. PFILES is "user dir;system dir", and the tools write their
+    # parameters in the user dir
+
+    if not os.path.exists(pfiles_dir):
+
+        os.makedirs(pfiles_dir)
+
+    for par_file in glob.glob(os.path.join(os.path.expanduser('~/pfiles'), '*.par')):
+
+        shutil.copy(par_file, pfiles_dir)
+
+    system_pfiles = os.environ.get("PFILES", "").split(";")[-1]
+
+    os.environ["PFILES"] = "%s;%s" % (pfiles_dir, system_pfiles)
+
+    _worker_runner = CommandRunner(logging_system.get_logger("farm_step2_prepare"))
+
+
+def _prepare_in_worker(obsid, args, workdir):
+
+    return prepare_obsid(obsid, args, _worker_runner, workdir)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run Bayesian Block algorithm')
+
+    parser.add_argument("-d", "--datarepository", help="Path to the data repository, where all the packages for all "
+                                                       "observations are", type=str, required=True)
+
+    parser.add_argument("-o", "--obsid", help="Observation ID Numbers", type=int, required=True, nargs="+")
+
+    parser.add_argument('-r', '--region_repo', help="Path to the repository of region files",
+                        type=str, required=True)
+
+    parser.add_argument('-a', "--adj_factor",
+                        help="If region files need to be adjusted, what factor to increase axes of ellipses by",
+                        type=float, required=True)
+
+    parser.add_argument("-e1", "--emin", help="Minimum energy (eV)", type=int, required=True)
+
+    parser.add_argument("-e2", "--emax", help="Maximum energy (eV)", type=int, required=True)
+
+    parser.add_argument("-c", "--ncpus", help="Number of CPUs to use (default=1)",
+                        type=int, default=1, required=False)
+
+    parser.add_argument("-p", "--typeIerror",
+                        help="Type I error probability for the Bayesian Blocks algorithm.",
+                        type=float,
+                        default=1e-5,
+                        required=False)
+
+    parser.add_argument("-s", "--sigmaThreshold",
+                        help="Threshold for the final significance. All intervals found "
+                             "by the bayesian blocks "
+                             "algorithm which does not surpass this threshold will not be saved in the "
+                             "final file.",
+                        type=float,
+                        default=5.0,
+                        required=False)
+
+    parser.add_argument("-m", "--multiplicity", help="Control the overlap of the regions."
+                                                     " A multiplicity of 2 means the centers of the regions are"
+                                                     " shifted by 1/2 of the region size (they overlap by 50 percent),"
+                                                     " a multiplicity of 4 means they are shifted by 1/4 of "
+                                                     " their size (they overlap by 75 percent), and so on.",
+                        required=False, default=2.0, type=float)
+
+    parser.add_argument("-v", "--verbosity", help="Info or debug", type=str, required=False, default='info',
+                        choices=['info', 'debug'])
+
+    parser.add_argument("--stream_to", help="If provided, the products for each CCD are moved to a data package "
+                                            "in this directory as soon as they are ready, instead of being kept "
+                                            "in the current directory until the end", type=str, required=False,
+                        default=None)
+
+    parser.add_argument("--debug_files", help="Write the intermediate lists of candidates (after the hot pixel "
+                                              "check and after the cross match with variable sources) as text "
+                                              "files in the output package", action="store_true")
+
+    parser.add_argument("--batch", help="Overlap the obsids: filter and separate the CCDs of the next obsid in a "
+                                        "helper process while xtdac runs on the current one. The files of each "
+                                        "obsid are written in the work directory <obsid>_work", action="store_true")
+
+    # Get the logger
+    logger = logging_system.get_logger(os.path.basename(sys.argv[0]))
+
+    # Get the command runner
+    runner = CommandRunner(logger)
+
+    args = parser.parse_args()
+
+    # Use absolute paths, as the work is done within the work directories
+
+    args.datarepository = sanitize_filename(args.datarepository)
+
+    args.region_repo = sanitize_filename(args.region_repo)
+
+    # The catalog and the PSF are loaded once and used for all the candidates
+
+    csc = get_catalog()
+
+    psf = chandra_psf.get_psf()
+
+    if not args.batch or len(args.obsid) == 1:
+
+        for this_obsid in args.obsid:
+
+            ccd_files = prepare_obsid(this_obsid, args, runner)
+
+            search_obsid(this_obsid, ccd_files, args, runner, csc, psf)
+
+    else:
+
+        # Read the region database now, so the helper process (forked afterwards) shares it
+
+        query_region_db.load_region_db(args.region_repo)
+
+        workdirs = {}
+
+        for this_obsid in args.obsid:
+
+            workdirs[this_obsid] = os.path.abspath("%s_work" % this_obsid)
+
+            if not os.path.exists(workdirs[this_obsid]):
+
+                os.makedirs(workdirs[this_obsid])
+
+        pfiles_dir = os.path.abspath("__farm_step2_pfiles")
+
+        pool = multiprocessing.Pool(1, initializer=_init_preparation_worker, initargs=(pfiles_dir,))
+
+        try:
+
+            # Only one obsid is prepared in advance, so at most two obsids are on disk at the same time
+
+            pending = pool.apply_async(_prepare_in_worker, (args.obsid[0], args, workdirs[args.obsid[0]]))
+
+            for i, this_obsid in enumerate(args.obsid):
+
+                ccd_files = pending.get()
+
+                if i + 1 < len(args.obsid):
+
+                    next_obsid = args.obsid[i + 1]
+
+                    logger.info("Preparing obsid %s in the background" % next_obsid)
+
+                    pending = pool.apply_async(_prepare_in_worker, (next_obsid, args, workdirs[next_obsid]))
+
+                search_obsid(this_obsid, ccd_files, args, runner, csc, psf, workdirs[this_obsid])
+
+                # The products are in the output package by now, so the work directory of this obsid can go (if the
+                # obsid fails, it is left behind for inspection)
+
+                shutil.rmtree(workdirs[this_obsid])
+
+        finally:
+
+            pool.terminate()
+            pool.join()
+
+            shutil.rmtree(pfiles_dir, ignore_errors=True)
@@ -8,16 +8,27 @@ import subprocess
 import sys
 import traceback
 
+from chandra_suli import event_slicer
+from chandra_suli import scratch_manager
+from chandra_suli.cli import run_command
 from chandra_suli.data_package import DataPackage
 from chandra_suli.sanitize_filename import sanitize_filename
 from chandra_suli.work_within_directory import work_within_directory
 
 
+# Tags of the input data package needed by farm_step2 (and by filter_event_file). Only these files are staged in
+
+_stage_in_tags = ['evt3', 'exp3', 'fov3', 'tsv']
+
+
 def clean_up(this_workdir):
     # First move out of the workdir
     os.chdir(os.path.expanduser('~'))
 
-    # Now remove the directory
+    # The cache of slices is in the workdir (see below), so it is removed with it. Stop using it
+    os.environ.pop(event_slicer.cache_dir_variable, None)
+
+    # Now remove the directory (with the cache of slices)
     try:
 
         shutil.rmtree(this_workdir)
@@ -59,7 +70,12 @@ if __name__ == "__main__":
 
     # Arguments for farm_step2
 
-    parser.add_argument("-o", "--obsid", help="Observation ID Number", type=int, required=True, nargs="+")
+    obsid_group = parser.add_mutually_exclusive_group(required=True)
+
+    obsid_group.add_argument("-o", "--obsid", help="Observation ID Number", type=int, nargs="+")
+
+    obsid_group.add_argument("--joblist", help="File with one line of obsids for each element of a job array. The "
+                                               "line is selected using the array index of this job", type=str)
 
     parser.add_argument('-a', "--adj_factor",
                         help="If region files need to be adjusted, what factor to increase axes of ellipses by",
@@ -97,6 +113,15 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbosity", help="Info or debug", type=str, required=False, default='info',
                         choices=['info', 'debug'])
 
+    parser.add_argument("--decompress_inputs", help="Decompress the gzip-compressed input files while staging them in",
+                        dest='decompress_inputs', action='store_true')
+    parser.set_defaults(decompress_inputs=False)
+
+    parser.add_argument("--scratch_dir", help="Directory where to create the work directory. By default, use /dev/shm "
+                                              "if there is enough free memory for this obsid, otherwise use the "
+                                              "local disk ($TMPDIR or /tmp)",
+                        type=str, required=False, default=None)
+
     args = parser.parse_args()
 
     # Check that the output dir already exists
@@ -116,31 +141,82 @@ if __name__ == "__main__":
     if not os.path.exists(regdir):
         raise IOError("Input region repository %s does not exist" % regdir)
 
+    if args.joblist is not None:
+
+        # This is an element of a job array (Torque sets PBS_ARRAYID, PBS Pro sets PBS_ARRAY_INDEX)
+
+        array_index = os.environ.get("PBS_ARRAYID", os.environ.get("PBS_ARRAY_INDEX"))
+
+        if array_index is None:
+            raise RuntimeError("--joblist can only be used within a job array")
+
+        with open(sanitize_filename(args.joblist)) as f:
+
+            lines = f.readlines()
+
+        obsids = map(int, lines[int(array_index)].split())
+
+    else:
+
+        obsids = args.obsid
+
     # First step of a farm job: Stage-in
 
     # Create a work directory in the local disk on the node
 
     # This is your unique job ID (a number like 546127)
-    unique_id = os.environ.get("PBS_JOBID").split(".")[0]
+    # (for job arrays it is like 546127[3], and square brackets would confuse the FTOOLS).
+    # Outside of the batch system (local executor) use the process ID instead
 
-    # os.path.join joins two path in a system-independent way
-    workdir = os.path.join('/dev/shm', unique_id)
+    if os.environ.get("PBS_JOBID") is not None:
 
-    # Now create the workdir
-    print("About to create %s..." % (workdir))
+        unique_id = os.environ.get("PBS_JOBID").split(".")[0].replace("[", "_").replace("]", "")
 
-    try:
-        os.makedirs(workdir)
-    except:
-        print("Could not create workdir %s !!!!" % (workdir))
-        raise
     else:
-        # This will be executed if no exception is raised
-        print("Successfully created %s" % (workdir))
+
+        unique_id = "local_%s" % os.getpid()
 
     cmd_line = "didn't even reach the command line execution"
 
-    for this_obsid in args.obsid:
+    # Obsids whose processing failed. The other obsids of the job are processed anyway, but the job exits with an
+    # error code so the executor knows about the failure
+
+    failed_obsids = []
+
+    for this_obsid in obsids:
+
+        # Choose where to put the workdir, according to the expected footprint of this obsid
+
+        if args.scratch_dir is not None:
+
+            scratch_dir = sanitize_filename(args.scratch_dir)
+
+        else:
+
+            footprint = scratch_manager.estimate_footprint(DataPackage(os.path.join(indir, str(this_obsid))))
+
+            scratch_dir = scratch_manager.choose_scratch_dir(footprint,
+                                                             ['/dev/shm', os.environ.get("TMPDIR", "/tmp")])
+
+        # os.path.join joins two path in a system-independent way
+        workdir = os.path.join(scratch_dir, unique_id)
+
+        # Now create the workdir (it is removed at the end of each obsid)
+        print("About to create %s..." % (workdir))
+
+        try:
+            os.makedirs(workdir)
+        except:
+            print("Could not create workdir %s !!!!" % (workdir))
+            raise
+        else:
+            # This will be executed if no exception is raised
+            print("Successfully created %s" % (workdir))
+
+        # The slices of the event files extracted for the external tools are cached in the workdir, so the cache
+        # is removed by clean_up with everything else (and its size is tracked by the UsageMonitor)
+
+        os.environ[event_slicer.cache_dir_variable] = os.path.join(workdir, "slice_cache")
 
         # now you have to go there
         with work_within_directory(workdir):
@@ -154,25 +230,42 @@ if __name__ == "__main__":
                 for par_file in par_files:
                     shutil.copy(par_file, workdir)
 
-                # Execute job
+                # Stage-in only the input files needed by farm_step2 (checking their checksums)
+
+                input_dir = os.path.join(workdir, 'input_data')
+
+                os.makedirs(input_dir)
+
+                input_package = DataPackage(os.path.join(indir, str(this_obsid)))
+
+                input_package.stage(input_dir, _stage_in_tags, decompress=args.decompress_inputs)
+
+                # Execute job. The products are streamed to the output directory as soon as they are ready
 
                 cmd_line = "farm_step2.py -d %s --obsid %s --region_repo %s --adj_factor %s " \
                            "--emin %s --emax %s --ncpus %s --typeIerror %s --sigmaThreshold %s " \
-                           "--multiplicity %s --verbosity %s" % (indir, this_obsid, args.regdir, args.adj_factor,
-                                                                 args.emin, args.emax, args.ncpus,
-                                                                 args.typeIerror, args.sigmaThreshold,
-                                                                 args.multiplicity,
-                                                                 args.verbosity)
+                           "--multiplicity %s --verbosity %s --stream_to %s" % (input_dir, this_obsid, args.regdir,
+                                                                                args.adj_factor,
+                                                                                args.emin, args.emax, args.ncpus,
+                                                                                args.typeIerror, args.sigmaThreshold,
+                                                                                args.multiplicity,
+                                                                                args.verbosity, outdir)
 
                 # Do whathever
                 print("\n\nAbout to execute command:")
                 print(cmd_line)
                 print('\n')
 
-                subprocess.check_call(cmd_line, shell=True)
+                # farm_step2 runs in this process (see cli.run_command)
+
+                with scratch_manager.UsageMonitor(workdir):
+
+                    run_command(cmd_line)
 
             except:
 
+                failed_obsids.append(this_obsid)
+
                 traceback.print_exc()
 
                 print(sys.exc_info())
@@ -188,13 +281,9 @@ if __name__ == "__main__":
 
             else:
 
-                # Stage-out
-
-                print("\n\nStage out\n\n")
-
-                output_package = DataPackage(this_obsid)
+                # Stage-out already happened while farm_step2 was running (--stream_to)
 
-                output_package.copy_to(outdir)
+                print("\n\nProducts have been streamed to %s\n\n" % os.path.join(outdir, str(this_obsid)))
 
             finally:
 
@@ -203,3 +292,9 @@ if __name__ == "__main__":
                 # if this job fails
 
                 clean_up(workdir)
+
+    if len(failed_obsids) > 0:
+
+        print("Processing failed for obsid(s): %s" % " ".join(map(str, failed_obsids)))
+
+        sys.exit(1)
@@ -28,7 +28,9 @@ from chandra_suli import query_region_db
 from chandra_suli import sanitize_filename
 from chandra_suli import setup_ftools
 from chandra_suli.data_package import DataPackage
+from chandra_suli.event_reader import default_chunk_size
 from chandra_suli.run_command import CommandRunner
+from chandra_suli.time_randomization import randomize_and_sort
 
 
 def is_variable(tsv_file, name_of_the_source):
@@ -115,6 +117,14 @@ if __name__ == "__main__":
 
     parser.set_defaults(randomize_time=True)
 
+    parser.add_argument("--seed", help="Seed for the randomization of the arrival times (default: a random seed). "
+                                       "The seed is written in the header of the output file (RANDSEED)",
+                        type=int, required=False, default=None)
+
+    parser.add_argument("--chunk_size", help="Number of rows of the event file read at once when randomizing the "
+                                             "arrival times (default: %s)" % default_chunk_size, type=int,
+                        required=False, default=default_chunk_size)
+
     # assumption = all level 3 region files and event file are already downloaded into same directory
 
     # Get logger for this command
@@ -150,8 +160,11 @@ if __name__ == "__main__":
 
     # Get the pointing from the event file
 
-    evtfile = data_package.get('evt3').filename
-    fovfile = data_package.get('fov3').filename
+    # These files are only read, so use them directly from the package
+
+    evtfile = data_package.get_path('evt3')
+    fovfile = data_package.get_path('fov3')
+    tsvfile = data_package.get_path('tsv')
 
     with pyfits.open(evtfile) as f:
 
@@ -223,7 +236,7 @@ if __name__ == "__main__":
 
             try:
 
-                if is_variable(data_package.get('tsv').filename, source_name) == True:
+                if is_variable(tsvfile, source_name) == True:
                     # open the file with "mode='update'"
 
                     with pyfits.open(temp_file, mode='update') as reg:
@@ -315,23 +328,16 @@ if __name__ == "__main__":
     print("Filtering event file...")
 
     ###########################
-    # Filter by energy
+    # Filter by energy and regions
     ###########################
 
-    temp_filter = '__temp__%s' % obsid
-
-    cmd_line = 'dmcopy %s[energy=%d:%d] %s opt=all clobber=yes' % (evtfile, args.emin, args.emax, temp_filter)
-
-    runner.run(cmd_line)
-
-    ###########################
-    # Filter by regions
-    ###########################
+    # Both filters are applied by the same dmcopy, so no intermediate energy-filtered copy of the event file is
+    # written
 
     outfile = '%s_filtered_evt3.fits' % obsid
 
-    cmd_line = 'dmcopy \"%s[exclude sky=region(%s)]\" ' \
-               '%s opt=all clobber=yes' % (temp_filter, all_regions_file, outfile)
+    cmd_line = 'dmcopy \"%s[energy=%d:%d][exclude sky=region(%s)]\" ' \
+               '%s opt=all clobber=yes' % (evtfile, args.emin, args.emax, all_regions_file, outfile)
 
     runner.run(cmd_line)
 
@@ -406,28 +412,20 @@ if __name__ == "__main__":
     # Randomize time             #
     ##############################
 
-    with pyfits.open(outfile, mode='update') as f:
-
-        time = f['EVENTS'].data.time
-
-        frame_time = f['EVENTS'].header['TIMEDEL']
+    # Randomize the arrival times within the frames and sort the events by time in a single pass, which writes the
+    # final file once. The seed is recorded in the header (RANDSEED), so the result can be reproduced
 
-        logger.info("Found a frame time of %s. Randomizing arrival times within time frame..." % (frame_time))
+    temp_out = '__randomized_%s' % outfile
 
-        deltas = np.random.uniform(-frame_time/2.0, frame_time/2.0, time.shape[0])
+    randomize_and_sort(outfile, temp_out, seed=args.seed, chunk_size=args.chunk_size)
 
-        time += deltas
+    os.remove(outfile)
 
-        f["EVENTS"].data.time[:] = time
-
-    # Now sort the file
-    cmd_line = "fsort %s[EVENTS] TIME heap" % outfile
-
-    runner.run(cmd_line)
+    os.rename(temp_out, outfile)
 
     # Store output in the output package
     output_package.store("filtered_evt3", outfile, "Event file (Level 3) with all point sources in the CSC, "
-                                                   "as well as out-of-time streaks (if any), removed")
+                                                   "as well as out-of-time streaks (if any), removed", move=True)
 
     # remove files
     files_to_remove = glob.glob("__*")
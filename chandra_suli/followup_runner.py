@@ -0,0 +1,205 @@
+"""
+Run the follow-up of the candidates of a master list (vtpdetect, celldetect...) in parallel on a pool of processes.
+Each worker has its own scratch directory and its own parameter files, so the CIAO tools running at the same time do
+not collide. Finished candidates are written to a checkpoint file, so an interrupted run can be resumed
+"""
+
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from chandra_suli.logging_system import get_logger
+from chandra_suli.run_command import CommandRunner
+
+logger = get_logger("followup_runner")
+
+# The command runner of the worker process (set by _init_worker)
+_worker_runner = None
+
+
+def candidate_key(row):
+    """
+    Returns the key identifying a candidate of the master list
+
+    :param row: a row of the master list
+    :return: string like "<obsid>_<ccd>_<candidate>"
+    """
+
+    return "%s_%s_%s" % (row['Obsid'], row['CCD'], row['Candidate'])
+
+
+def _to_python(value):
+
+    # Convert numpy scalars to python types, so they can be written in the checkpoint file
+
+    if hasattr(value, 'item'):
+
+        value = value.item()
+
+    if isinstance(value, bytes) and bytes is not str:
+
+        value = value.decode()
+
+    return value
+
+
+def _init_worker(scratch_root):
+
+    global _worker_runner
+
+    scratch_dir = os.path.join(scratch_root, "worker_%s" % os.getpid())
+
+    os.makedirs(scratch_dir)
+
+    # Use a private copy of the parameter files. PFILES is "user dir;system dir", and the CIAO tools write their
+    # parameters in the user dir
+
+    for par_file in glob.glob(os.path.join(os.path.expanduser('~/pfiles'), '*.par')):
+
+        shutil.copy(par_file, scratch_dir)
+
+    system_pfiles = os.environ.get("PFILES", "").split(";")[-1]
+
+    os.environ["PFILES"] = "%s;%s" % (scratch_dir, system_pfiles)
+
+    # Temporary files of the tools go in the scratch directory as well
+
+    os.chdir(scratch_dir)
+
+    _worker_runner = CommandRunner(get_logger("followup_worker_%s" % os.getpid()))
+
+
+def _run_one(payload):
+
+    index, function, row, args = payload
+
+    return index, function(row, *args, runner=_worker_runner)
+
+
+def _load_checkpoint(checkpoint_file):
+
+    done = {}
+
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+
+        with open(checkpoint_file) as f:
+
+            for line in f:
+
+                # Skip truncated lines (the run might have been killed while writing)
+
+                try:
+
+                    entry = json.loads(line)
+
+                except ValueError:
+
+                    continue
+
+                done[entry['key']] = entry['result']
+
+        logger.info("Resuming: %s candidates already processed according to %s" % (len(done), checkpoint_file))
+
+    return done
+
+
+def run_followup(function, rows, args=(), ncpus=1, checkpoint_file=None, scratch_dir=None):
+    """
+    Run function(row, *args, runner=runner) for each row of the master list, on a pool of ncpus processes
+
+    :param function: the function processing one candidate. It must return a list of output rows, and be defined at
+    module level (so it can be sent to the workers)
+    :param rows: the rows of the master list
+    :param args: other arguments for the function (must be picklable)
+    :param ncpus: number of processes
+    :param checkpoint_file: file where finished candidates are recorded. Candidates already in the file are not
+    processed again. If None, no checkpoint is used
+    :param scratch_dir: directory where the scratch directories of the workers are created (default: system
+    temporary directory)
+    :return: list of the output rows, in the order of the input rows
+    """
+
+    global _worker_runner
+
+    done = _load_checkpoint(checkpoint_file)
+
+    keys = [candidate_key(row) for row in rows]
+
+    results = [done.get(key) for key in keys]
+
+    payloads = [(i, function, rows[i], tuple(args)) for i in range(len(rows)) if results[i] is None]
+
+    logger.info("Processing %s candidates with %s processes" % (len(payloads), ncpus))
+
+    checkpoint = open(checkpoint_file, "a") if checkpoint_file is not None else None
+
+    scratch_root = tempfile.mkdtemp(prefix="followup_", dir=scratch_dir)
+
+    pool = None
+
+    try:
+
+        if ncpus > 1:
+
+            pool = multiprocessing.Pool(ncpus, initializer=_init_worker, initargs=(scratch_root,))
+
+            iterator = pool.imap_unordered(_run_one, payloads)
+
+        else:
+
+            # Run in this process. The current directory and the parameter files are left untouched
+
+            _worker_runner = CommandRunner(get_logger("followup_runner"))
+
+            iterator = (_run_one(payload) for payload in payloads)
+
+        for index, result in iterator:
+
+            result = [[_to_python(value) for value in output_row] for output_row in result]
+
+            results[index] = result
+
+            if checkpoint is not None:
+
+                checkpoint.write("%s\n" % json.dumps({'key': keys[index], 'result': result}))
+
+                checkpoint.flush()
+
+    except:
+
+        # Do not wait for the other candidates
+
+        if pool is not None:
+
+            pool.terminate()
+
+        raise
+
+    else:
+
+        if pool is not None:
+
+            pool.close()
+
+    finally:
+
+        if pool is not None:
+
+            pool.join()
+
+        if checkpoint is not None:
+
+            checkpoint.close()
+
+        shutil.rmtree(scratch_root, ignore_errors=True)
+
+    output = []
+
+    for result in results:
+
+        output.extend(result)
+
+    return output
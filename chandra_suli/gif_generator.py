@@ -1,27 +1,132 @@
 #!/usr/bin/env python
 
 """
-Generate lightcurves for each candidate given a list of candidates
+Generate gifs to visualize each candidate given a list of candidates.
+
+The X, Y and TIME columns are read in blocks of rows (see event_reader.py), the events are assigned to the time
+intervals with np.searchsorted and all the images are binned in one pass over the file. The images are smoothed with a
+separable Gaussian filter and the frames are encoded directly with Pillow, so no display, GUI backend or
+ImageMagick is needed
 """
 
 import argparse
 import os
 import sys
 import numpy as np
-import astropy.io.fits as pyfits
-import matplotlib.pyplot as plt
-import seaborn as sbs
-from matplotlib.colors import LogNorm
-from astropy.convolution import convolve, Gaussian2DKernel
-from matplotlib.animation import ArtistAnimation, FFMpegWriter
 
+from chandra_suli.event_reader import EventFileReader, default_chunk_size
 from chandra_suli.find_files import find_files
 from chandra_suli import logging_system
-from chandra_suli.run_command import CommandRunner
+from chandra_suli.candidate_table import read_candidates
+from chandra_suli.lazy_import import lazy_import
 from chandra_suli.sanitize_filename import sanitize_filename
 
-import matplotlib
-matplotlib.use("tkagg")
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+
+
+def gaussian_smooth(images, stddev=0.7, size=9):
+    """
+    Smooth a stack of images with a normalized Gaussian kernel, applied as two 1d convolutions. Outside of the
+    images the values are taken as zero (same result as astropy's convolve with a Gaussian2DKernel)
+
+    :param images: array with shape (n_images, nx, ny)
+    :param stddev: standard deviation of the Gaussian (pixels)
+    :param size: size of the kernel (pixels, odd)
+    :return: the smoothed images
+    """
+
+    half = size // 2
+
+    kernel = np.exp(-np.arange(-half, half + 1) ** 2 / (2.0 * stddev ** 2))
+    kernel /= kernel.sum()
+
+    smoothed = images.astype(float)
+
+    for axis in (1, 2):
+
+        padded_shape = list(smoothed.shape)
+        padded_shape[axis] += 2 * half
+
+        padded = np.zeros(padded_shape)
+
+        inner = [slice(None)] * 3
+        inner[axis] = slice(half, half + smoothed.shape[axis])
+
+        padded[tuple(inner)] = smoothed
+
+        result = np.zeros(smoothed.shape)
+
+        for i, weight in enumerate(kernel):
+
+            window = [slice(None)] * 3
+            window[axis] = slice(i, i + smoothed.shape[axis])
+
+            result += weight * padded[tuple(window)]
+
+        smoothed = result
+
+    return smoothed
+
+
+def hot_colormap(image):
+    """
+    Map an image to RGB with the "hot" color map (black-red-yellow-white), scaling linearly between its minimum
+    and its maximum
+
+    :param image: 2d array
+    :return: array of uint8 with shape image.shape + (3,)
+    """
+
+    vmin, vmax = image.min(), image.max()
+
+    scaled = (image - vmin) / (vmax - vmin) if vmax > vmin else np.zeros(image.shape)
+
+    rgb = np.empty(image.shape + (3,))
+
+    rgb[..., 0] = np.clip(scaled / 0.365079, 0, 1)
+    rgb[..., 1] = np.clip((scaled - 0.365079) / (0.746032 - 0.365079), 0, 1)
+    rgb[..., 2] = np.clip((scaled - 0.746032) / (1 - 0.746032), 0, 1)
+
+    return (rgb * 255).astype(np.uint8)
+
+
+def render_frame(image, title, labels, scale=2):
+    """
+    Render one frame of the gif
+
+    :param image: smoothed image (2d array, first index along the vertical axis with the origin at the bottom)
+    :param title: title written above the image
+    :param labels: lines of text written below the image
+    :param scale: magnification of the image
+    :return: a PIL image
+    """
+
+    rgb = hot_colormap(image[::-1])
+
+    picture = Image.fromarray(rgb, "RGB").resize((rgb.shape[1] * scale, rgb.shape[0] * scale), Image.NEAREST)
+
+    line_height = 14
+
+    top = line_height * (len(title.split("\n")) + 1)
+    bottom = line_height * (len(labels) + 1)
+
+    frame = Image.new("RGB", (picture.size[0], picture.size[1] + top + bottom), (255, 255, 255))
+
+    frame.paste(picture, (0, top))
+
+    draw = ImageDraw.Draw(frame)
+
+    for i, line in enumerate(title.split("\n")):
+
+        draw.text((5, 5 + i * line_height), line, fill=(0, 0, 0))
+
+    for i, line in enumerate(labels):
+
+        draw.text((5, top + picture.size[1] + 5 + i * line_height), line, fill=(0, 0, 0))
+
+    return frame
+
 
 if __name__=="__main__":
 
@@ -32,20 +137,24 @@ if __name__=="__main__":
     parser.add_argument("--data_path", help="Path to directory containing data of all obsids", required=True,
                         type=str)
 
+    parser.add_argument("--chunk_size", help="Number of rows of the event files read at once (default: %s)"
+                                             % default_chunk_size, required=False, default=default_chunk_size,
+                        type=int)
+
     parser.add_argument("--verbose-debug", action='store_true')
 
     # Get the logger
     logger = logging_system.get_logger(os.path.basename(sys.argv[0]))
 
-    # Get the command runner
-    runner = CommandRunner(logger)
-
     args = parser.parse_args()
 
     data_path = sanitize_filename(args.data_path)
     masterfile = sanitize_filename(args.masterfile)
 
-    transient_data = np.array(np.recfromtxt(masterfile, names=True), ndmin=1)
+    transient_data = read_candidates(masterfile)
+
+    # Ranges of X and Y for each event file
+    xy_ranges = {}
 
     for transient in transient_data:
 
@@ -59,15 +168,20 @@ if __name__=="__main__":
 
         event_file = find_files(os.path.join(data_path, str(obsid)), "ccd_%s_%s_filtered_nohot.fits" % (ccd, obsid))[0]
 
+        # The event file is read in blocks of rows, so the whole table is never in memory
+        reader = EventFileReader(event_file, chunk_size=args.chunk_size)
+
         # get start and stop time of observation
-        with pyfits.open(event_file, memmap=False) as event_ext:
+        tmin = reader.header['TSTART']
+        tmax = reader.header['TSTOP']
 
-            tmin = event_ext['EVENTS'].header['TSTART']
-            tmax = event_ext['EVENTS'].header['TSTOP']
+        # Get minimum and maximum X and Y, so we use always the same binning for the images (computed only once for
+        # all the candidates in the same file)
+        if event_file not in xy_ranges:
 
-            # Get minimum and maximum X and Y, so we use always the same binning for the images
-            xmin, xmax = event_ext['EVENTS'].data.field("X").min(), event_ext['EVENTS'].data.field("X").max()
-            ymin, ymax = event_ext['EVENTS'].data.field("Y").min(), event_ext['EVENTS'].data.field("Y").max()
+            xy_ranges[event_file] = reader.min_max(['x', 'y'])
+
+        (xmin, xmax), (ymin, ymax) = xy_ranges[event_file]['x'], xy_ranges[event_file]['y']
 
         print "Duration: %s" %duration
         print "Tmin: %s" % tmin
@@ -97,83 +211,60 @@ if __name__=="__main__":
 
         evt_name, evt_file_ext = os.path.splitext(os.path.basename(event_file))
 
-        # Create individual time interval files
-        images = []
-
-        for i in range(len(intervals)-1):
-
-            outfile = "%s_TI_%s_cand_%s%s" %(evt_name, i+1, candidate, evt_file_ext)
-
-            cmd_line = 'ftcopy \"%s[(TIME >= %s) && (TIME <= %s)]\" %s clobber=yes ' \
-                       % (event_file, intervals[i], intervals[i+1], outfile)
-
-            runner.run(cmd_line)
-
-            images.append(outfile)
-
-        #create a list of frames that will be animated into a gif
-        frames = []
+        n_intervals = len(intervals) - 1
 
         # Prepare bins
         xbins = np.linspace(xmin, xmax, 300)
         ybins = np.linspace(ymin, ymax, 300)
 
-        fig = plt.figure()
+        bins = [np.arange(n_intervals + 1) - 0.5, xbins, ybins]
 
-        sub = fig.add_subplot(111)
-        sub.set_title("ObsID %s, CCD %s \nTstart = %s, Tstop = %s" % (obsid, ccd, tstart, tstop))
+        hh = np.zeros((n_intervals, xbins.shape[0] - 1, ybins.shape[0] - 1))
 
-        for i, image in enumerate(images):
+        # Bin all the intervals in one pass over the file, one block of rows at a time (the counts of the blocks
+        # add up to the same images). Only the events between the first and the last boundary are used, and each
+        # one is assigned to its interval (events exactly on the last boundary belong to the last interval)
 
-            #get x and y coordinates of image from fits file
-            data = pyfits.getdata(image)
-            x = data.field("x")
-            y = data.field("y")
+        for _, chunk in reader.iter_chunks(['time', 'x', 'y']):
 
-            #create 2D histogram data from it
-            sbs.set(rc={'axes.facecolor': 'black', 'axes.grid': False})
+            selected = (chunk['time'] >= intervals[0]) & (chunk['time'] <= intervals[-1])
 
-            hh, X, Y = np.histogram2d(x, y, bins=[xbins, ybins])
+            if not np.any(selected):
 
-            #smooth data
-            gauss_kernel = Gaussian2DKernel(stddev=0.7, x_size=9, y_size=9)
-            smoothed_data_gauss = convolve(hh, gauss_kernel, normalize_kernel=True)
+                continue
 
-            if x.shape[0] > 0:
+            interval_idx = np.searchsorted(intervals, chunk['time'][selected], side='right') - 1
 
-                img = sub.imshow(smoothed_data_gauss, cmap='hot', animated=True, origin='lower')
+            interval_idx = np.clip(interval_idx, 0, n_intervals - 1)
 
-            else:
+            chunk_hh, _ = np.histogramdd(np.vstack([interval_idx, chunk['x'][selected], chunk['y'][selected]]).T,
+                                         bins=bins)
 
-                # No events in this image. Generate an empty image
-                img = sub.imshow(smoothed_data_gauss, cmap='hot', animated=True, origin='lower')
+            hh += chunk_hh
 
-            text = sub.annotate("%i / %i" % (i+1, len(images)), xy=(xbins.shape[0]/2.0, -20),
-                                xycoords='data', annotation_clip=False)
+        #smooth data
+        smoothed_images = gaussian_smooth(hh, stddev=0.7, size=9)
 
-            # Compute interval duration
-            dt = intervals[i+1] - intervals[i]
+        n_events = hh.sum(axis=(1, 2))
+
+        title = "ObsID %s, CCD %s \nTstart = %s, Tstop = %s" % (obsid, ccd, tstart, tstop)
 
-            text2 = sub.annotate("%i events" % (x.shape[0]), xy=(-120, ybins.shape[0]/2.0),
-                                xycoords='data', annotation_clip=False)
+        #create a list of frames that will be animated into a gif
+        frames = []
 
-            text3 = sub.annotate("Duration: %.2f s" % (dt), xy=(-120, ybins.shape[0]/2.0 + 30),
-                                 xycoords='data', annotation_clip=False)
+        for i in range(n_intervals):
 
-            sub.set_yticklabels([])
-            sub.set_xticklabels([])
+            # Compute interval duration
+            dt = intervals[i+1] - intervals[i]
 
-            #add this image to list of frames
-            frames.append([img, text, text2, text3])
+            labels = ["%i / %i" % (i+1, n_intervals),
+                      "%i events" % (n_events[i]),
+                      "Duration: %.2f s" % (dt)]
 
-            # Remove the image
-            os.remove(image)
+            frames.append(render_frame(smoothed_images[i], title, labels))
 
         #animate and save gif
         print "Creating gif ObsID %s, CCD %s, Candidate %s...\n" %(obsid, ccd, candidate)
-        anim = ArtistAnimation(fig, frames, interval=2000)
-        anim.save("%s_cand_%s.gif" %(evt_name, candidate), writer='imagemagick')
-
-        plt.close()
-
 
+        frames[0].save("%s_cand_%s.gif" %(evt_name, candidate), save_all=True, append_images=frames[1:],
+                       duration=2000, loop=0)
@@ -0,0 +1,225 @@
+"""
+Estimate the cost of processing an obsid from the header of its event file, and pack many obsids into a few farm jobs
+"""
+
+import math
+import os
+
+import astropy.io.fits as pyfits
+
+from chandra_suli.data_package import DataPackage
+from chandra_suli.logging_system import get_logger
+
+logger = get_logger("job_packing")
+
+
+def read_event_file_summary(evtfile):
+    """
+    Read the number of events, the number of CCDs and the size of the event table from the header of the event file,
+    without reading the data
+
+    :param evtfile: path to the event file (evt3)
+    :return: (n_events, n_ccds, table_bytes)
+    """
+
+    header = pyfits.getheader(evtfile, 'EVENTS')
+
+    n_events = int(header['NAXIS2'])
+
+    table_bytes = int(header['NAXIS1']) * n_events
+
+    # DETNAM is something like ACIS-235678, i.e., the list of the active CCDs
+
+    detnam = header.get("DETNAM", "")
+
+    if detnam.find("-") >= 0:
+
+        n_ccds = len(detnam.split("-")[-1])
+
+    else:
+
+        # Unknown, assume the worst case
+
+        n_ccds = 10
+
+    return n_events, n_ccds, table_bytes
+
+
+class ObsidCost(object):
+    def __init__(self, obsid, n_events, n_ccds, walltime, memory):
+
+        self.obsid = obsid
+        self.n_events = n_events
+        self.n_ccds = n_ccds
+
+        # Estimated wall time (s) and memory (GB)
+        self.walltime = walltime
+        self.memory = memory
+
+    def __repr__(self):
+
+        return "obsid %s: %s events, %s CCDs, %.0f s, %.1f GB" % (self.obsid, self.n_events, self.n_ccds,
+                                                                   self.walltime, self.memory)
+
+
+class CostModel(object):
+    """
+    A simple linear model for the wall time and the memory needed by farm_step2 to process one obsid. The default
+    coefficients are conservative and can be tuned using the logs of previous runs
+    """
+
+    def __init__(self, overhead=300.0, time_per_ccd=600.0, time_per_mevent=1800.0,
+                 base_memory=2.0, memory_factor=8.0):
+
+        # Time (s) needed for the staging and the filtering, independent of the size of the obsid
+        self._overhead = float(overhead)
+
+        # Time (s) needed to run xtdac and the candidate checks on one CCD
+        self._time_per_ccd = float(time_per_ccd)
+
+        # Time (s) needed per million events
+        self._time_per_mevent = float(time_per_mevent)
+
+        # Memory (GB) needed independently of the size of the obsid
+        self._base_memory = float(base_memory)
+
+        # How many copies of the event table are in memory (or in /dev/shm) at the same time
+        self._memory_factor = float(memory_factor)
+
+    def estimate(self, obsid, evtfile):
+        """
+        Estimate wall time and memory needed to process the obsid
+
+        :param obsid: observation ID
+        :param evtfile: the event file for the obsid
+        :return: an ObsidCost instance
+        """
+
+        n_events, n_ccds, table_bytes = read_event_file_summary(evtfile)
+
+        walltime = self._overhead + self._time_per_ccd * n_ccds + self._time_per_mevent * n_events / 1e6
+
+        memory = self._base_memory + self._memory_factor * table_bytes / 1024.0 ** 3
+
+        return ObsidCost(obsid, n_events, n_ccds, walltime, memory)
+
+    def estimate_from_repository(self, data_repository, obsid):
+        """
+        Estimate the cost for an obsid using the evt3 file in its data package
+
+        :param data_repository: path to the directory containing the data packages for all obsids
+        :param obsid: observation ID
+        :return: an ObsidCost instance
+        """
+
+        data_package = DataPackage(os.path.join(data_repository, str(obsid)))
+
+        return self.estimate(obsid, data_package.get_path('evt3'))
+
+
+class PackedJob(object):
+    def __init__(self):
+
+        self._costs = []
+
+    @property
+    def obsids(self):
+
+        return [cost.obsid for cost in self._costs]
+
+    @property
+    def walltime(self):
+        """
+        The obsids in a job are processed one after the other, so the wall time is the sum of the wall times
+        """
+
+        return sum([cost.walltime for cost in self._costs])
+
+    @property
+    def memory(self):
+        """
+        The obsids in a job are processed one after the other, so the memory is the maximum of the memories
+        """
+
+        return max([cost.memory for cost in self._costs])
+
+    def add(self, cost):
+
+        self._costs.append(cost)
+
+    def __len__(self):
+
+        return len(self._costs)
+
+
+def pack_obsids(costs, target_walltime):
+    """
+    Pack the obsids in jobs so that each job takes approximately target_walltime (first-fit decreasing). Obsids
+    which alone take more than target_walltime get a job for themselves
+
+    :param costs: list of ObsidCost instances
+    :param target_walltime: target wall time for each job (s)
+    :return: list of PackedJob instances
+    """
+
+    jobs = []
+
+    for cost in sorted(costs, key=lambda x: x.walltime, reverse=True):
+
+        for job in jobs:
+
+            if job.walltime + cost.walltime <= target_walltime:
+
+                job.add(cost)
+
+                break
+
+        else:
+
+            new_job = PackedJob()
+
+            new_job.add(cost)
+
+            jobs.append(new_job)
+
+    logger.info("Packed %s obsids in %s jobs" % (len(costs), len(jobs)))
+
+    return jobs
+
+
+def request_walltime(walltime, safety_factor=2.0, min_walltime=3600.0):
+    """
+    Wall time to request to the scheduler for a job with the given estimated wall time. The cost model is only a
+    rough estimate, and a job which runs longer than requested is killed, so the request has a safety margin
+
+    :param walltime: estimated wall time (s)
+    :param safety_factor: the estimate is multiplied by this factor
+    :param min_walltime: minimum wall time to request (s)
+    :return: wall time to request (s)
+    """
+
+    return max(walltime * safety_factor, min_walltime)
+
+
+def format_walltime(seconds):
+    """
+    Format a number of seconds in the HH:MM:SS format used by qsub
+
+    :param seconds:
+    :return: string
+    """
+
+    seconds = int(math.ceil(seconds))
+
+    return "%02i:%02i:%02i" % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def format_memory(gigabytes):
+    """
+    Format a memory request for qsub, rounding up to the next GB
+
+    :param gigabytes:
+    :return: string
+    """
+
+    return "%igb" % int(math.ceil(gigabytes))
@@ -0,0 +1,75 @@
+"""
+Deferred import of heavy dependencies (sklearn, astropy.coordinates, matplotlib, seaborn, CIAO modules...).
+
+    cluster = lazy_import("sklearn.cluster")
+
+returns immediately a placeholder, and the real module is imported the first time one of its attributes is used
+(for example cluster.DBSCAN). Scripts which do not need the module in the code path being executed (or which
+are only asked for --help) do not pay its import time.
+"""
+
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name):
+        """
+        A placeholder for a module, which is imported on first attribute access
+
+        :param name: full name of the module (like "astropy.coordinates")
+        """
+
+        super(LazyModule, self).__init__(name)
+
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+
+        module = self.__dict__['_lazy_module']
+
+        if module is None:
+
+            module = importlib.import_module(self.__name__)
+
+            self.__dict__['_lazy_module'] = module
+
+        return module
+
+    @property
+    def is_loaded(self):
+        """
+        True if the module has been imported already (by this placeholder or by anybody else)
+        """
+
+        return self.__dict__['_lazy_module'] is not None or self.__name__ in sys.modules
+
+    def __getattr__(self, attribute):
+
+        # Called only for the attributes not found in the placeholder, i.e., all the attributes of the module
+
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+
+        return dir(self._load())
+
+    def __repr__(self):
+
+        return "<lazy module '%s' (%s)>" % (self.__name__, "loaded" if self.is_loaded else "not loaded")
+
+
+def lazy_import(name):
+    """
+    Returns the module if it has been imported already, otherwise a placeholder which imports it on first use
+
+    :param name: full name of the module
+    :return: the module, or a LazyModule
+    """
+
+    if name in sys.modules:
+
+        return sys.modules[name]
+
+    return LazyModule(name)
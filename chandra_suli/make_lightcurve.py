@@ -1,22 +1,140 @@
 #!/usr/bin/env python
 
 """
-Generate lightcurves for each candidate given a list of candidates
+Generate lightcurves for each candidate given a list of candidates.
+
+Candidates are processed in groups sharing the same event file (same obsid and CCD), so the event file is opened
+(memory-mapped) only once per group. The rates are computed with np.histogram, and the plots are rendered by a pool
+of processes with the Agg backend, each one reusing the same figure for all its plots
 """
 
 import argparse
+import multiprocessing
 import os
 import sys
 import numpy as np
 import astropy.io.fits as pyfits
-import matplotlib.pyplot as plt
-import seaborn as sbs
 
 from chandra_suli import find_files
 from chandra_suli import logging_system
+from chandra_suli.candidate_table import read_candidates
+from chandra_suli.event_slicer import get_slicer
+from chandra_suli.lazy_import import lazy_import
 from chandra_suli.run_command import CommandRunner
 from chandra_suli.sanitize_filename import sanitize_filename
 
+# matplotlib and seaborn are imported only by the processes rendering the plots (see LightCurvePlotter)
+matplotlib = lazy_import("matplotlib")
+plt = lazy_import("matplotlib.pyplot")
+sbs = lazy_import("seaborn")
+
+
+def compute_lightcurve(time, tstart, tstop):
+    """
+    Compute the light curve around a transient, in bins as long as the transient, from 10 durations before
+    the start to 10 durations after
+
+    :param time: arrival times of the events in the region of the transient
+    :param tstart: start of the transient
+    :param tstop: end of the transient
+    :return: (bin centers relative to tstart, rates, errors on the rates)
+    """
+
+    duration = tstop - tstart
+
+    bins = np.arange(-10 * duration, 10 * duration, duration)
+
+    counts, _ = np.histogram(time - tstart, bins)
+
+    rate = counts / float(duration)
+
+    # Centers of the bins
+
+    tc = (bins[:-1] + bins[1:]) / 2.0
+
+    return tc, rate, np.sqrt(counts) / float(duration)
+
+
+class LightCurvePlotter(object):
+    def __init__(self):
+        """
+        A figure which is reused for all the light curves (only the data of the artists is changed)
+        """
+
+        # The backend must be selected before pyplot is imported (seaborn imports it)
+
+        matplotlib.use("Agg")
+
+        sbs.set(font_scale=2)
+        sbs.set_style('white')
+
+        self._figure = plt.figure(figsize=(15, 15 / 1.33333))
+
+        self._axes = self._figure.add_subplot(111)
+
+        self._points, _, (self._error_bars,) = self._axes.errorbar([0], [0], yerr=[0], fmt='.')
+
+        self._start_line = self._axes.axvline(0, linestyle=':')
+        self._stop_line = self._axes.axvline(1, linestyle=':')
+
+        self._axes.set_xlabel("Time since trigger (s)")
+        self._axes.set_ylabel("Count rate (cts/s)")
+
+        self._title = self._axes.set_title("")
+
+    def plot(self, tc, rate, error, duration, title, plot_file):
+        """
+        Save the plot of a light curve
+
+        :param tc: bin centers
+        :param rate: rates
+        :param error: errors on the rates
+        :param duration: duration of the transient
+        :param title: title of the plot
+        :param plot_file: output file
+        :return: None
+        """
+
+        self._points.set_data(tc, rate)
+
+        segments = np.zeros((tc.shape[0], 2, 2))
+
+        segments[:, :, 0] = tc[:, np.newaxis]
+        segments[:, 0, 1] = rate - error
+        segments[:, 1, 1] = rate + error
+
+        self._error_bars.set_segments(segments)
+
+        self._stop_line.set_xdata([duration, duration])
+
+        self._title.set_text(title)
+
+        # Same limits that autoscaling would give for the bins and the error bars
+
+        self._axes.set_xlim(tc[0] - duration, tc[-1] + duration)
+        self._axes.set_ylim(min(0, np.min(rate - error)), max(np.max(rate + error), 1.0 / duration) * 1.05)
+
+        self._figure.savefig(plot_file)
+
+
+# The plotter of the worker process (set by _init_plotter)
+_plotter = None
+
+
+def _init_plotter():
+
+    global _plotter
+
+    _plotter = LightCurvePlotter()
+
+
+def _render(job):
+
+    _plotter.plot(*job)
+
+    return job[-1]
+
+
 if __name__=="__main__":
 
     parser = argparse.ArgumentParser(description='Generate light curves for transients listed in a'
@@ -26,6 +144,8 @@ if __name__=="__main__":
                         required=True, type=str)
     parser.add_argument("--data_path", help="Path to directory containing data of all obsids", required = True,
                         type=str)
+    parser.add_argument("-c", "--ncpus", help="Number of processes rendering the plots (default=1)",
+                        type=int, default=1, required=False)
 
 
     # Get the logger
@@ -41,81 +161,98 @@ if __name__=="__main__":
     data_path = sanitize_filename(args.data_path)
     masterfile = sanitize_filename(args.masterfile)
 
-    transient_data = np.array(np.recfromtxt(masterfile, names=True), ndmin=1)
+    transient_data = read_candidates(masterfile)
+
+    # Group the candidates by obsid and CCD, so each event file is opened only once
+
+    groups = {}
 
     for transient in transient_data:
 
-        obsid = transient['Obsid']
-        ccd = transient['CCD']
-        candidate = transient['Candidate']
-        tstart = transient['Tstart']
-        tstop = transient['Tstop']
+        groups.setdefault((transient['Obsid'], transient['CCD']), []).append(transient)
 
-        # use region file from xtdac and cut region
+    # Plots to render
 
-        regions = find_files.find_files(os.path.join(data_path, str(obsid)), "ccd_%s_%s_filtered_candidate_%s.reg" %(ccd, obsid, candidate))
-        event_file = find_files.find_files(os.path.join(data_path, str(obsid)), "ccd_%s_%s_filtered.fits" %(ccd, obsid))[0]
+    jobs = []
 
-        print event_file
+    for (obsid, ccd) in sorted(groups.keys()):
 
-        TI_file = os.path.join(os.path.join(data_path, str(obsid)), 'ccd_%s_%s_filtered_TI_%s.fits' %(ccd,obsid,candidate))
+        obsid_dir = os.path.join(data_path, str(obsid))
 
-        cmd_line = 'ftcopy \"%s[(TIME >= %s) && (TIME <= %s)]\" %s clobber=yes ' \
-                   % (event_file, tstart, tstop, TI_file)
+        event_file = find_files.find_files(obsid_dir, "ccd_%s_%s_filtered.fits" %(ccd, obsid))[0]
 
-        runner.run(cmd_line)
+        logger.info("Processing %s candidates in %s" % (len(groups[(obsid, ccd)]), event_file))
 
-        if len(regions) != 1:
+        slicer = get_slicer(event_file)
 
-            raise IOError("More than one region file found")
+        for transient in groups[(obsid, ccd)]:
 
-        else:
+            candidate = transient['Candidate']
+            tstart = transient['Tstart']
+            tstop = transient['Tstop']
 
-            region = regions[0]
+            duration = tstop - tstart
 
-        evt_reg = "ccd_%s_%s_filtered_candidate_%s_reg.fits" %(ccd, obsid, candidate)
+            # use region file from xtdac and cut region
 
-        cmd_line = "ftcopy \'%s[EVENTS][regfilter(\"%s\")]\' %s clobber=yes " %(event_file, region, evt_reg)
+            regions = find_files.find_files(obsid_dir, "ccd_%s_%s_filtered_candidate_%s.reg" %(ccd, obsid, candidate))
 
-        runner.run(cmd_line)
+            if len(regions) != 1:
 
-        data = pyfits.getdata(evt_reg)
+                raise IOError("More than one region file found")
 
-        sbs.set(font_scale=2)
-        sbs.set_style('white')
+            else:
+
+                region = regions[0]
+
+            # Apply the region filter only to the time interval covered by the light curve (with some margin)
+
+            time_slice = slicer.get_file(tstart - 11 * duration, tstart + 11 * duration)
+
+            evt_reg = os.path.join(obsid_dir, "ccd_%s_%s_filtered_candidate_%s_reg.fits" %(ccd, obsid, candidate))
+
+            cmd_line = "ftcopy \'%s[EVENTS][regfilter(\"%s\")]\' %s clobber=yes " %(time_slice, region, evt_reg)
+
+            runner.run(cmd_line)
+
+            slicer.release_file(time_slice)
+
+            with pyfits.open(evt_reg, memmap=False) as f:
+
+                time = f['EVENTS'].data.field("TIME")
+
+            tc, rate, error = compute_lightcurve(time, tstart, tstop)
 
-        fig = plt.figure(figsize=(15, 15 / 1.33333))
+            title = "Transient Lightcurve\nObsID = %s, CCD ID = %s, Candidate=%s\n" %(obsid, ccd, candidate)
 
-        duration = tstop - tstart
+            plot_file = os.path.join(obsid_dir, "ccd_%s_%s_candidate_%s_lightcurve.png" %(ccd, obsid, candidate))
 
-        bins = np.arange(-10 * duration, 10 * duration, duration)
+            jobs.append((tc, rate, error, duration, title, plot_file))
 
-        time = data.field("TIME")
+    # Render the plots
 
-        rate, obins, _ = plt.hist(time - tstart, bins, weights=np.ones(time.shape[0]) * 1.0 / duration,
-                                  color='white')
+    logger.info("Rendering %s light curves with %s processes" % (len(jobs), args.ncpus))
 
-        # Centers of the bins
+    if args.ncpus > 1:
 
-        tc = (bins[:-1] + bins[1:]) / 2.0
+        pool = multiprocessing.Pool(args.ncpus, initializer=_init_plotter)
 
-        plt.errorbar(tc, rate, yerr=np.sqrt(rate * duration) / duration, fmt='.')
+        try:
 
-        plt.axvline(0, linestyle=':')
-        plt.axvline(duration, linestyle=':')
+            for plot_file in pool.imap_unordered(_render, jobs, chunksize=16):
 
-        plt.xlabel("Time since trigger (s)")
-        plt.ylabel("Count rate (cts/s)")
-        plt.title("Transient Lightcurve\nObsID = %s, CCD ID = %s, Candidate=%s\n" %(obsid, ccd, candidate))
+                logger.debug("Saved %s" % plot_file)
 
-        plot_file = "ccd_%s_%s_candidate_%s_lightcurve.png" %(ccd, obsid, candidate)
+        finally:
 
-        plt.savefig(plot_file)
+            pool.close()
+            pool.join()
 
-        os.rename(plot_file, os.path.join(data_path, str(obsid), plot_file))
-        os.rename(evt_reg,os.path.join(data_path, str(obsid), evt_reg))
+    else:
 
-        plt.close()
+        _init_plotter()
 
+        for job in jobs:
 
+            _render(job)
 
@@ -0,0 +1,184 @@
+"""
+Master list of candidate transients, stored in a SQLite database with a unique key on (Obsid, CCD, Candidate).
+Adding candidates is an upsert (adding the same candidates twice has no effect), and the ranked text file used by the
+other steps is exported on demand
+"""
+
+import os
+import sqlite3
+
+from chandra_suli.candidate_table import format_value, read_candidates
+from chandra_suli.sanitize_filename import sanitize_filename
+
+_key_columns = ['Obsid', 'CCD', 'Candidate']
+
+
+def _quote(name):
+
+    # Quote a column name, so names like Separation(arcsec) are allowed
+
+    return '"%s"' % name.replace('"', '""')
+
+
+def _to_sql_value(value):
+
+    # Convert numpy scalars to python types that sqlite understands
+
+    if hasattr(value, 'item'):
+
+        value = value.item()
+
+    if isinstance(value, bool):
+
+        # Keep the textual representation used in the text files
+
+        return str(value)
+
+    if isinstance(value, bytes) and bytes is not str:
+
+        return value.decode()
+
+    return value
+
+
+class MasterList(object):
+    def __init__(self, db_file, table='candidates'):
+        """
+        :param db_file: the SQLite database file (created if needed), or ":memory:" for a list kept in memory only
+        :param table: name of the table
+        """
+
+        self._db_file = db_file if db_file == ":memory:" else sanitize_filename(db_file)
+
+        self._table = table
+
+        self._connection = sqlite3.connect(self._db_file)
+
+    @property
+    def filename(self):
+
+        return self._db_file
+
+    @property
+    def columns(self):
+        """
+        Names of the columns of the master list (empty if the list has never been filled)
+        """
+
+        cursor = self._connection.execute("PRAGMA table_info(%s)" % _quote(self._table))
+
+        return [row[1] for row in cursor.fetchall()]
+
+    def _create_table(self, column_names):
+
+        for key in _key_columns:
+
+            if key not in column_names:
+                raise RuntimeError("Column %s is required in the master list" % key)
+
+        with self._connection:
+
+            self._connection.execute("CREATE TABLE IF NOT EXISTS %s (%s)"
+                                     % (_quote(self._table), ", ".join(map(_quote, column_names))))
+
+            self._connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)"
+                                     % (_quote(self._table + "_key"), _quote(self._table),
+                                        ", ".join(map(_quote, _key_columns))))
+
+    def upsert(self, column_names, rows):
+        """
+        Add or replace candidates. A candidate already in the list (same Obsid, CCD and Candidate) is replaced
+
+        :param column_names: list of column names
+        :param rows: iterable of rows (tuples or numpy records) with the values for the columns
+        :return: number of rows processed
+        """
+
+        column_names = list(column_names)
+
+        existing_columns = self.columns
+
+        if len(existing_columns) == 0:
+
+            self._create_table(column_names)
+
+        elif existing_columns != column_names:
+
+            raise RuntimeError("Columns %s do not match the columns of the master list %s"
+                               % (column_names, existing_columns))
+
+        values = [tuple(_to_sql_value(value) for value in row) for row in rows]
+
+        with self._connection:
+
+            self._connection.executemany("INSERT OR REPLACE INTO %s VALUES (%s)"
+                                         % (_quote(self._table), ", ".join(["?"] * len(column_names))),
+                                         values)
+
+        return len(values)
+
+    def import_text(self, text_file):
+        """
+        Add the candidates contained in a master list file (for example in the text format written by export)
+
+        :param text_file:
+        :return: number of rows processed
+        """
+
+        data = read_candidates(sanitize_filename(text_file))
+
+        if len(data) == 0:
+
+            # Nothing to add (the file might not even have the names of the columns)
+
+            return 0
+
+        # Drop the Rank column, which is generated on export
+
+        column_names = list(data.dtype.names)[1:]
+
+        return self.upsert(column_names, [tuple(row)[1:] for row in data])
+
+    def __len__(self):
+
+        if len(self.columns) == 0:
+
+            return 0
+
+        return self._connection.execute("SELECT COUNT(*) FROM %s" % _quote(self._table)).fetchone()[0]
+
+    def export(self, text_file, sort_column=None):
+        """
+        Write the master list as a text file, with the candidates ranked by decreasing value of sort_column
+
+        :param text_file: output file
+        :param sort_column: column used for the ranking (default: the last column)
+        :return: number of rows written
+        """
+
+        column_names = self.columns
+
+        if sort_column is None:
+
+            sort_column = column_names[-1]
+
+        cursor = self._connection.execute("SELECT * FROM %s ORDER BY %s DESC, rowid"
+                                          % (_quote(self._table), _quote(sort_column)))
+
+        n = 0
+
+        with open(text_file, "w") as f:
+
+            f.write("# Rank %s\n" % " ".join(column_names))
+
+            for row in cursor:
+
+                n += 1
+
+                f.write("%s %s\n" % (n, " ".join(map(format_value, row))))
+
+        return n
+
+    def close(self):
+
+        self._connection.close()
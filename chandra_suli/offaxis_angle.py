@@ -2,8 +2,11 @@
 # size of the PSF in the detector
 
 import astropy.io.fits as pyfits
-import astropy.units as u
-from astropy.coordinates import SkyCoord
+
+from chandra_suli.lazy_import import lazy_import
+
+u = lazy_import("astropy.units")
+coordinates = lazy_import("astropy.coordinates")
 
 
 def get_offaxis_angle(ra, dec, event_file):
@@ -19,9 +22,9 @@ def get_offaxis_angle(ra, dec, event_file):
 
     # Compute the corresponding off-axis angle theta
 
-    pointing = SkyCoord(ra=ra_pointing * u.degree, dec=dec_pointing * u.degree, frame=system.lower())
+    pointing = coordinates.SkyCoord(ra=ra_pointing * u.degree, dec=dec_pointing * u.degree, frame=system.lower())
 
-    c1 = SkyCoord(ra=ra * u.degree, dec=dec * u.degree, frame=system.lower())
+    c1 = coordinates.SkyCoord(ra=ra * u.degree, dec=dec * u.degree, frame=system.lower())
 
     this_theta = c1.separation(pointing)
 
@@ -3,23 +3,28 @@
 """
 Pre-filter event file for obvious hot pixels (to gain execution time). A further, deeper search for hot pixel will be
 executed after the Bayesian Block stage
+
+The event file is not modified: the rows of the events in hot pixels are saved in a sidecar file, which is applied
+when the events are separated by CCD (separate_CCD.py --exclude)
 """
 
 import argparse
 import os
 import sys
 
-import astropy.io.fits as pyfits
 import numpy as np
-from sklearn.cluster import DBSCAN
-from sklearn.metrics.pairwise import euclidean_distances
 
 from chandra_suli import logging_system
-from chandra_suli.run_command import CommandRunner
+from chandra_suli.event_index import EventIndex
+from chandra_suli.event_reader import EventFileReader, default_chunk_size
+from chandra_suli.event_store import save_rows
+from chandra_suli.lazy_import import lazy_import
 from chandra_suli.sanitize_filename import sanitize_filename
 
 from xtwp4.BayesianBlocks import bayesian_blocks
 
+pairwise = lazy_import("sklearn.metrics.pairwise")
+
 
 def neighbor_pixel_check(cluster_coords, max_distance=2):
     """
@@ -32,9 +37,9 @@ def neighbor_pixel_check(cluster_coords, max_distance=2):
 
     hot_pix_flag = True
 
-    all_distances = euclidean_distances(cluster_coords, cluster_coords)
+    all_distances = pairwise.euclidean_distances(cluster_coords, cluster_coords)
     if args.debug == "yes":
-        print all_distances
+        logger.debug("Distances between the events in the cluster:\n%s" % all_distances)
 
     for distances in all_distances:
 
@@ -53,6 +58,46 @@ def neighbor_pixel_check(cluster_coords, max_distance=2):
     return hot_pix_flag
 
 
+def read_ccd_columns(reader):
+    """
+    Read the columns needed for the search of hot pixels, divided by CCD, one block of rows at a time (so the whole
+    table is never in memory)
+
+    :param reader: an EventFileReader instance
+    :return: dictionary ccd_id -> (rows, time, chipx, chipy), with the events of each CCD in time order
+    """
+
+    parts = {}
+
+    row_type = np.int32 if reader.n_rows < 2 ** 31 else np.int64
+
+    for first_row, chunk in reader.iter_chunks(['time', 'ccd_id', 'chipx', 'chipy']):
+
+        rows = np.arange(first_row, first_row + chunk.shape[0], dtype=row_type)
+
+        for ccd in np.unique(chunk['ccd_id']):
+
+            idx = chunk['ccd_id'] == ccd
+
+            parts.setdefault(int(ccd), []).append((rows[idx], chunk['time'][idx], chunk['chipx'][idx],
+                                                   chunk['chipy'][idx]))
+
+    ccd_columns = {}
+
+    for ccd in list(parts.keys()):
+
+        rows, time, chipx, chipy = [np.concatenate(arrays) for arrays in zip(*parts.pop(ccd))]
+
+        # The file is sorted by time, so this is usually already in order (a stable sort keeps the order of events
+        # with the same time)
+
+        order = np.argsort(time, kind='mergesort')
+
+        ccd_columns[ccd] = (rows[order], time[order], chipx[order], chipy[order])
+
+    return ccd_columns
+
+
 def unique_rows(my_array):
     """
     Returns the data where all duplicated elements have been removed
@@ -72,121 +117,121 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Check to see if transient candidates are actually hot pixels")
 
-    parser.add_argument("--evtfile", help="Filtered CCD file", required=True, type=str)
-    parser.add_argument("--outfile", help="Output file with events in hot pixels removed", required=True, type=str)
+    parser.add_argument("--evtfile", help="Filtered CCD file (it is only read)", required=True, type=str)
+    parser.add_argument("--outfile", help="Output sidecar file (.npz) with the rows of the events in hot pixels. Use "
+                                          "it with separate_CCD.py --exclude (see event_store.save_rows)",
+                        required=True, type=str)
     parser.add_argument("--max_duration", help="Maximum duration to consider for bright pixels (default: 25)",
                         required=False, default=25, type=float)
     parser.add_argument("--debug", help="Debug mode? (yes or no)", required=False, default='no')
+    parser.add_argument("--chunk_size", help="Number of rows of the event file read at once (default: %s)"
+                                             % default_chunk_size, required=False, default=default_chunk_size,
+                        type=int)
 
     # Get logger for this command
 
     logger = logging_system.get_logger(os.path.basename(sys.argv[0]))
 
-    # Instance the command runner
-
-    runner = CommandRunner(logger)
-
     args = parser.parse_args()
 
     eventfile = sanitize_filename(args.evtfile)
 
-    # Open event file
+    # Open event file. It is only read, in blocks of rows: the events in hot pixels are not modified in place,
+    # their rows are saved in a sidecar file and they are excluded when the events are separated by CCD
 
     tot_hot_pixels = 0
 
-    with pyfits.open(eventfile, mode='update', memmap=False) as fits_file:
+    # Rows of the events in hot pixels (one array for each flagged pixel and interval)
+
+    hot_rows = []
+
+    reader = EventFileReader(eventfile, chunk_size=args.chunk_size)
 
-        # Get unique CCD ids
-        ccds = np.unique(fits_file['EVENTS'].data.ccd_id)
+    # Get frame time
 
-        # Get frame time
+    tstart = reader.header['TSTART']
+    tstop = reader.header['TSTOP']
 
-        tstart = fits_file['EVENTS'].header['TSTART']
-        tstop = fits_file['EVENTS'].header['TSTOP']
+    n_tot = reader.n_rows
 
-        # Get the data extension
+    # Only the columns needed here are read
 
-        data = fits_file['EVENTS'].data
+    ccd_columns = read_ccd_columns(reader)
 
-        for ccd in ccds:
+    for ccd in sorted(ccd_columns.keys()):
 
-            logger.info("Processing CCD %s" % ccd)
+        logger.info("Processing CCD %s" % ccd)
 
-            # Select all events in this CCD
-            ccd_idx = (data.ccd_id == ccd)
+        # All events in this CCD (in time order)
+        ccd_rows, time, chipx, chipy = ccd_columns.pop(ccd)
 
-            chipx = data.chipx[ccd_idx]
-            chipy = data.chipy[ccd_idx]
-            time = data.time[ccd_idx]
+        # Time windows within this CCD are resolved with a binary search
+        ccd_index = EventIndex(time)
 
-            coords = np.vstack([chipx, chipy]).T
+        coords = np.vstack([chipx, chipy]).T
 
-            ucoords = unique_rows(coords)
+        ucoords = unique_rows(coords)
 
-            # For each non-empty pixel do a bayesian block analysis
-            for i, (cx, cy) in enumerate(ucoords):
+        # For each non-empty pixel do a bayesian block analysis
+        for i, (cx, cy) in enumerate(ucoords):
 
-                if (i+1) % 10000 == 0:
+            if (i+1) % 10000 == 0:
 
-                    logger.info("%s out of %s" % (i+1, coords.shape[0]))
+                logger.info("%s out of %s" % (i+1, coords.shape[0]))
 
-                time_stamps = data.time[ccd_idx & (data.chipx == cx) & (data.chipy == cy)]
+            time_stamps = time[(chipx == cx) & (chipy == cy)]
 
-                # Do not try if there are only 5 events in the whole observation in this pixel
+            # Do not try if there are only 5 events in the whole observation in this pixel
 
-                if time_stamps.shape[0] < 5:
+            if time_stamps.shape[0] < 5:
 
-                    continue
+                continue
 
-                blocks = bayesian_blocks(time_stamps, tstart, tstop, 1e-3)
+            blocks = bayesian_blocks(time_stamps, tstart, tstop, 1e-3)
 
-                if len(blocks) > 2:
+            if len(blocks) > 2:
 
-                    for t1,t2 in zip(blocks[:-1], blocks[1:]):
+                for t1,t2 in zip(blocks[:-1], blocks[1:]):
 
-                        duration = t2 - t1
+                    duration = t2 - t1
 
-                        if duration < args.max_duration:
+                    if duration < args.max_duration:
 
-                            # Check if this is a bright pixel
+                        # Check if this is a bright pixel
 
-                            # Select all events within this time interval
-                            time_idx = (time >= t1) & (time <= t2)
+                        # Select all events within this time interval
+                        time_window = ccd_index.time_window(t1, t2)
 
-                            # Select all events in this time interval in the surrounding pixels
+                        # Select all events in this time interval in the surrounding pixels
 
-                            d = np.sqrt((chipx-float(cx))**2 + (chipy-float(cy))**2)
+                        d = np.sqrt((chipx[time_window]-float(cx))**2 + (chipy[time_window]-float(cy))**2)
 
-                            this_idx = d == 0
+                        this_idx = d == 0
 
-                            neighbor_idx = time_idx & (d < 2) & ~this_idx
+                        neighbor_idx = (d < 2) & ~this_idx
 
-                            if np.sum(neighbor_idx) == 0:
+                        if np.sum(neighbor_idx) == 0:
 
-                                # No events in surrounding pixels. This is likely a hot pixel
-                                logger.info(" @ (%s, %s), interval: %1.f - %.1f s "
-                                            "(%.1f s, %i evts)" % (cx, cy, t1, t2, duration, np.sum(this_idx)))
+                            # No events in surrounding pixels. This is likely a hot pixel
+                            logger.info(" @ (%s, %s), interval: %1.f - %.1f s "
+                                        "(%.1f s, %i evts)" % (cx, cy, t1, t2, duration, time_stamps.shape[0]))
 
-                                # Flag the events
-                                events_idx = ccd_idx & (data.chipx == cx) & (data.chipy == cy) & \
-                                             (data.time >= t1) & (data.time <= t2)
+                            # Flag the events
+                            hot_rows.append(ccd_rows[time_window][this_idx])
 
-                                data.pha[events_idx] = -1
+                            tot_hot_pixels += 1
 
-                                tot_hot_pixels += 1
+        # Free the columns of this CCD before processing the next one
 
+        del ccd_rows, chipx, chipy, time, coords, ucoords
 
-    # # Count how many events we are filtering out
-    n_filtered = np.sum(data.pha == -1)
-    #
-    n_tot = int(data.shape[0])
+    hot_rows = np.unique(np.concatenate(hot_rows)) if len(hot_rows) > 0 else np.zeros(0, np.int64)
+
+    # Count how many events we are filtering out
+    n_filtered = hot_rows.shape[0]
 
     logger.info("Found %s non-unique hot pixels" % tot_hot_pixels)
     logger.info(
         "Filtering out %s events out of %s (%.2f percent)" % (n_filtered, n_tot, float(n_filtered) / n_tot * 100.0))
 
-    outfile = sanitize_filename(args.outfile)
-
-    cmd_line = "ftcopy %s[EVENTS][pha!=-1] %s  copyall=true clobber=yes" % (eventfile, outfile)
-
-    runner.run(cmd_line)
+    save_rows(sanitize_filename(args.outfile), hot_rows, n_tot)
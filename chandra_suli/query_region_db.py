@@ -4,6 +4,31 @@ import numpy as np
 
 from chandra_suli.angular_distance import angular_distance
 
+# Databases already read by this process, keyed by (path, size, modification time)
+_databases = {}
+
+
+def load_region_db(region_dir):
+    """
+    Returns the content of the region database, reading it only the first time it is requested by this process
+    (processes forked afterwards share the copy in memory)
+
+    :param region_dir: Path of the directory containing the database file and the region files
+    :return: structured array with the content of region_database.txt
+    """
+
+    database_file = os.path.abspath(os.path.join(region_dir, 'region_database.txt'))
+
+    stat = os.stat(database_file)
+
+    key = (database_file, stat.st_size, stat.st_mtime)
+
+    if key not in _databases:
+
+        _databases[key] = np.recfromtxt(database_file, names=True)
+
+    return _databases[key]
+
 
 def query_region_db(ra_center, dec_center, radius, region_dir):
     """
@@ -16,9 +41,7 @@ def query_region_db(ra_center, dec_center, radius, region_dir):
     :return: list of region files
     """
 
-    database_file = os.path.join(region_dir, 'region_database.txt')
-
-    data = np.recfromtxt(database_file, names=True)
+    data = load_region_db(region_dir)
 
     # Compute the angular distance between all regions and the center of the cone
 
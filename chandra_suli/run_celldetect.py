@@ -9,14 +9,77 @@ import os
 import sys
 
 import astropy.io.fits as pyfits
-import numpy as np
 
 from chandra_suli import find_files
 from chandra_suli import logging_system
 from chandra_suli import work_within_directory
+from chandra_suli.candidate_table import make_table, read_candidates, write_candidates
+from chandra_suli.event_slicer import get_slicer
+from chandra_suli.followup_runner import run_followup
 from chandra_suli.run_command import CommandRunner
 from chandra_suli.sanitize_filename import sanitize_filename
 
+
+def run_celldetect(candidate_row, data_dir, outdir, runner):
+    """
+    Run celldetect on the events of one candidate of the master list (within its region and its time interval)
+
+    :param candidate_row: the row of the master list for the candidate
+    :param data_dir: path to directory containing data of all obsids
+    :param outdir: directory where output files will go
+    :param runner: a CommandRunner instance
+    :return: a list containing the row of the master list if celldetect found a source, an empty list otherwise
+    """
+
+    obsid = candidate_row['Obsid']
+    ccd = candidate_row['CCD']
+    candidate = candidate_row['Candidate']
+    tstart = candidate_row['Tstart']
+    tstop = candidate_row['Tstop']
+    obsid_dir = os.path.join(data_dir, str(obsid))
+
+    evtfile = find_files.find_files(obsid_dir, 'ccd_%s_%s_filtered.fits' % (ccd, obsid))[0]
+    regfile = find_files.find_files(obsid_dir, 'ccd_%s_%s_filtered_candidate_%s.reg' % (ccd, obsid, candidate))[0]
+
+    regfile_name = os.path.splitext(os.path.basename(regfile))[0]
+    newreg = "%s_reg.fits" % regfile_name
+    newreg_path = os.path.join(outdir, newreg)
+
+    # Apply the region filter to the slice with the time interval (from the cache of slices), which is much
+    # smaller than the event file
+
+    slicer = get_slicer(evtfile)
+
+    time_slice = slicer.get_file(tstart, tstop)
+
+    cmd_line = 'ftcopy \"%s[regfilter(\'%s\')]\" %s clobber=yes ' % (time_slice, regfile, newreg_path)
+
+    runner.run(cmd_line)
+
+    slicer.release_file(time_slice)
+
+    celldetect_file = '%s_celldetect.fits' % regfile_name
+    celldetect_path = os.path.join(outdir, celldetect_file)
+
+    cmd_line = 'celldetect %s %s clobber=yes' % (newreg_path, celldetect_path)
+    runner.run(cmd_line)
+
+    with pyfits.open(celldetect_path, memmap=False) as f:
+
+        regions = f['SRCLIST'].data
+
+    if len(regions) != 0:
+
+        return [list(candidate_row)]
+
+    else:
+
+        os.remove(celldetect_path)
+        os.remove(newreg_path)
+
+        return []
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Check to see if transient candidates are actually hot pixels")
@@ -29,6 +92,8 @@ if __name__ == "__main__":
     parser.add_argument("--data_dir", help="Path to directory containing data of all obsids", required=True,
                         type=str)
     parser.add_argument("--outdir", help="Directory where output files will go", required=True, type=str)
+    parser.add_argument("-c", "--ncpus", help="Number of candidates to process in parallel (default=1)",
+                        type=int, default=1, required=False)
 
     # Get logger for this command
 
@@ -45,8 +110,7 @@ if __name__ == "__main__":
     outdir = sanitize_filename(args.outdir)
 
     # Get data from master list
-    master_data = np.array(np.recfromtxt(masterfile, names=True), ndmin=1)
-    celldetect_data = []
+    master_data = read_candidates(masterfile)
 
     if args.ranks[0] == 0:
 
@@ -56,66 +120,27 @@ if __name__ == "__main__":
 
         ranks = args.ranks
 
-    for rank in ranks:
-
-        # index of object in question will be one less than the rank (first source is index 0, etc)
-        idx = rank - 1
-
-        obsid = master_data['Obsid'][idx]
-        ccd = master_data['CCD'][idx]
-        candidate = master_data['Candidate'][idx]
-        tstart = master_data['Tstart'][idx]
-        tstop = master_data['Tstop'][idx]
-        obsid_dir = os.path.join(data_dir, str(obsid))
-
-        evtfile = find_files.find_files(obsid_dir, 'ccd_%s_%s_filtered.fits' % (ccd, obsid))[0]
-        regfile = find_files.find_files(obsid_dir, 'ccd_%s_%s_filtered_candidate_%s.reg' % (ccd, obsid, candidate))[0]
-
-        regfile_name = os.path.splitext(os.path.basename(regfile))[0]
-        newreg = "%s_reg.fits" % regfile_name
-        newreg_path = os.path.join(outdir, newreg)
+    # index of object in question will be one less than the rank (first source is index 0, etc)
 
-        cmd_line = 'ftcopy \"%s[regfilter(\'%s\') && (TIME >= %s) && (TIME <= %s)]\" %s clobber=yes ' \
-                   % (evtfile, regfile, tstart, tstop, newreg_path)
+    rows = [master_data[rank - 1] for rank in ranks]
 
-        runner.run(cmd_line)
+    # Finished candidates are recorded in the checkpoint file, so an interrupted run can be resumed
 
-        celldetect_file = '%s_celldetect.fits' % regfile_name
-        celldetect_path = os.path.join(outdir, celldetect_file)
+    checkpoint_file = os.path.join(outdir, "%s.checkpoint" % os.path.basename(args.outfile))
 
-        cmd_line = 'celldetect %s %s clobber=yes' % (newreg_path, celldetect_path)
-        runner.run(cmd_line)
+    celldetect_data = run_followup(run_celldetect, rows, args=(data_dir, outdir), ncpus=args.ncpus,
+                                   checkpoint_file=checkpoint_file)
 
-        with pyfits.open(celldetect_path, memmap=False) as f:
+    # Write the output list with the candidates renumbered (the format is given by the extension of the file)
 
-            regions = f['SRCLIST'].data
+    column_names = list(master_data.dtype.names)
 
-        if len(regions) != 0:
-
-            celldetect_data.append(master_data[idx])
-
-        else:
-
-            os.remove(celldetect_path)
-            os.remove(newreg_path)
+    out_rows = [[n + 1] + list(row[1:len(column_names)]) for n, row in enumerate(celldetect_data)]
 
     with work_within_directory.work_within_directory(outdir):
 
-        with open(args.outfile, "w") as f:
-
-            existing_column_names = " ".join(master_data.dtype.names)
-
-            f.write("# %s\n" % existing_column_names)
-
-            for n, i in enumerate(range(len(celldetect_data))):
-
-                temp_list = []
-
-                temp_list.append(str(n + 1))
-
-                for j in range(1, len(master_data.dtype.names)):
-                    temp_list.append(str(celldetect_data[i][j]))
+        write_candidates(args.outfile, make_table(column_names, out_rows))
 
-                line = " ".join(temp_list)
+    # Done, the checkpoint is not needed anymore
 
-                f.write("%s\n" % line)
+    os.remove(checkpoint_file)
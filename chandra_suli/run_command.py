@@ -1,11 +1,22 @@
 import subprocess
 
+from chandra_suli.cli import split_command_line, run_step
+
 
 class CommandRunner(object):
-    def __init__(self, logger):
+    def __init__(self, logger, in_process=True):
+        """
+        Executes command lines, logging them
+
+        :param logger: the logger
+        :param in_process: if True (default), the command lines running one of our steps (like
+        "filter_event_file.py --evtfile ...") are executed in this process (see cli.run_step) instead of in a shell
+        """
 
         self._logger = logger
 
+        self._in_process = bool(in_process)
+
     def run(self, cmd_line, debug=False):
 
         if debug:
@@ -16,4 +27,12 @@ class CommandRunner(object):
 
             self._logger.info(cmd_line)
 
-        subprocess.check_call(cmd_line, shell=True)
+        step = split_command_line(cmd_line) if self._in_process else None
+
+        if step is None:
+
+            subprocess.check_call(cmd_line, shell=True)
+
+        else:
+
+            run_step(*step)
@@ -10,164 +10,236 @@ import sys
 
 import astropy.io.fits as pyfits
 import numpy as np
-from astropy.coordinates import SkyCoord
 
 from chandra_suli import find_files
 from chandra_suli import logging_system
+from chandra_suli.candidate_table import make_table, read_candidates, write_candidates
+from chandra_suli.data_package import DataPackage
+from chandra_suli.event_slicer import get_slicer
+from chandra_suli.exposure_map_cache import ExposureMapCache
+from chandra_suli.followup_runner import run_followup
+from chandra_suli.lazy_import import lazy_import
 from chandra_suli.run_command import CommandRunner
 from chandra_suli.sanitize_filename import sanitize_filename
-from chandra_suli.unique_list import unique_list
+from chandra_suli.unique_list import count_unique, unique_list
 
-if __name__ == "__main__":
+coordinates = lazy_import("astropy.coordinates")
 
-    parser = argparse.ArgumentParser(description="Run vtpdetect to find sources in regions given by xtdac")
+def match_sources(ra, dec, srclist):
+    """
+    Find the vtpdetect sources which are related to the candidate, i.e., whose distance from the candidate is
+    smaller than twice the major axis of their region. The separations from all sources are computed at once
 
-    parser.add_argument("--masterfile", help="Path to file containing list of transients in this set",
-                        required=True, type=str)
-    parser.add_argument("--outfile", help="Name of output file which will contain modified list of transients")
-    parser.add_argument("--data_dir", help="Path to directory containing data of all obsids", required=True,
-                        type=str)
-    parser.add_argument("--outdir", help="Directory where output files will go", required=True, type=str)
-    parser.add_argument("-s", "--resampleFactor",
-                        help="Oversample the input image by this factor before processing",
-                        type=int, default=5, required=False)
+    :param ra: R.A. of the candidate (deg)
+    :param dec: Dec. of the candidate (deg)
+    :param srclist: the SRCLIST table produced by vtpdetect
+    :return: array of the FSP (false source probability) of the matching sources, in the order of the table
+    """
 
-    # Get logger for this command
+    if len(srclist) == 0:
 
-    logger = logging_system.get_logger(os.path.basename(sys.argv[0]))
+        return np.array([])
 
-    # Instance the command runner
+    radius = np.asarray(srclist['R'])
 
-    runner = CommandRunner(logger)
+    if radius.ndim > 1:
 
-    args = parser.parse_args()
+        # R contains the two axes of the ellipse
 
-    masterfile = sanitize_filename(args.masterfile)
-    data_dir = sanitize_filename(args.data_dir)
-    outdir = sanitize_filename(args.outdir)
-    outfile = os.path.join(outdir, sanitize_filename(args.outfile))
+        radius = radius.max(axis=1)
 
-    # Get data from master list
-    master_data = np.array(np.recfromtxt(masterfile, names=True), ndmin=1)
-    vtpdetect_data = []
-
-    for i in range(len(master_data)):
-
-        obsid = master_data['Obsid'][i]
-        ra = master_data['RA'][i]
-        dec = master_data['Dec'][i]
-        ccd = master_data['CCD'][i]
-        candidate = master_data['Candidate'][i]
-        tstart = master_data['Tstart'][i]
-        tstop = master_data['Tstop'][i]
-        obsid_dir = os.path.join(data_dir, str(obsid))
+    sources = coordinates.SkyCoord(srclist['RA'], srclist['DEC'], unit="deg")
+
+    sep = sources.separation(coordinates.SkyCoord(ra, dec, unit="deg")).arcsec
+
+    return np.asarray(srclist['FSP'])[sep <= 2 * radius]
+
+
+def get_expomap_cache(obsid_dir, outdir, runner):
+    """
+    Returns the cache of filtered exposure maps for an obsid. This is the data package of the obsid, if it is
+    writable, otherwise a package in the output directory
+
+    :param obsid_dir: directory of the obsid
+    :param outdir: directory where output files will go
+    :param runner: a CommandRunner instance
+    :return: an ExposureMapCache instance
+    """
+
+    try:
+
+        package = DataPackage(obsid_dir)
+
+    except (IOError, AssertionError):
+
+        package = None
+
+    if package is None or package.read_only:
+
+        package = DataPackage(os.path.join(outdir, "%s_expomap_cache" % os.path.basename(obsid_dir)), create=True)
+
+    return ExposureMapCache(package, runner)
+
+
+def get_input_files(obsid_dir, obsid, ccd):
+    """
+    Returns the files needed to run vtpdetect on a CCD of an obsid
+
+    :param obsid_dir: directory of the obsid
+    :param obsid: the obsid
+    :param ccd: CCD number
+    :return: (regions of all sources, filtered event file for the CCD, exposure map)
+    """
 
-        all_regions_file = find_files.find_files(obsid_dir, '%s_all_regions.fits' % (obsid))[0]
-        evtfile = find_files.find_files(obsid_dir, 'ccd_%s_%s_filtered.fits' % (ccd, obsid))[0]
-        expfile = find_files.find_files(obsid_dir, '*%s*exp3*' % obsid)[0]
+    all_regions_file = find_files.find_files(obsid_dir, '%s_all_regions.fits' % (obsid))[0]
+    evtfile = find_files.find_files(obsid_dir, 'ccd_%s_%s_filtered.fits' % (ccd, obsid))[0]
+    expfile = find_files.find_files(obsid_dir, '*%s*exp3*' % obsid)[0]
 
-        expfile_new = os.path.join(outdir, "%s_cheesemask.fits" % obsid)
+    return all_regions_file, evtfile, expfile
 
-        if not os.path.exists(expfile_new):
 
-            with pyfits.open(evtfile, memmap=False) as f:
+def run_vtpdetect(candidate_row, data_dir, outdir, resample_factor, runner, expomap_cache=None):
+    """
+    Run vtpdetect on the time interval of one candidate of the master list
 
-                if len(f) < 4:
-                    cmd_line = "fappend %s[1] %s" % (all_regions_file, evtfile)
-                    runner.run(cmd_line)
+    :param candidate_row: the row of the master list for the candidate
+    :param data_dir: path to directory containing data of all obsids
+    :param outdir: directory where output files will go
+    :param resample_factor: oversample the exposure map by this factor
+    :param runner: a CommandRunner instance
+    :param expomap_cache: the ExposureMapCache for the obsid (if None, it is obtained with get_expomap_cache)
+    :return: list of rows (the row of the master list, plus the FSP of the vtpdetect source) for each matching source
+    """
 
-            # run this to create filtered exposure map to match filtered event file to use during vtpdetect
+    obsid = candidate_row['Obsid']
+    ra = candidate_row['RA']
+    dec = candidate_row['Dec']
+    ccd = candidate_row['CCD']
+    candidate = candidate_row['Candidate']
+    tstart = candidate_row['Tstart']
+    tstop = candidate_row['Tstop']
+    obsid_dir = os.path.join(data_dir, str(obsid))
 
-            cmd_line = "xtcheesemask.py -i %s -r %s -o %s -s %s --no-reverse" \
-                       % (expfile, evtfile, expfile_new, args.resampleFactor)
+    all_regions_file, evtfile, expfile = get_input_files(obsid_dir, obsid, ccd)
 
-            runner.run(cmd_line)
+    # get the filtered exposure map matching the filtered event file to use during vtpdetect (computed only
+    # the first time it is needed for this configuration)
 
-        # create new event file with just time interval found by xtdac
+    if expomap_cache is None:
 
-        evtfile_new = os.path.join(outdir, 'ccd_%s_%s_filtered_TI_%s.fits' % (ccd, obsid, candidate))
+        expomap_cache = get_expomap_cache(obsid_dir, outdir, runner)
 
-        cmd_line = 'ftcopy \"%s[(TIME >= %s) && (TIME <= %s)]\" %s clobber=yes ' \
-                   % (evtfile, tstart, tstop, evtfile_new)
+    expfile_new = expomap_cache.get(expfile, all_regions_file, evtfile, ccd, resample_factor=resample_factor)
 
-        runner.run(cmd_line)
+    # select the time interval found by xtdac
 
-        # run vtpdetect
+    slicer = get_slicer(evtfile)
 
-        with pyfits.open(evtfile_new) as q:
+    events = slicer.get_data(tstart, tstop)
 
-            chipx = q['EVENTS'].data.chipx
-            chipy = q['EVENTS'].data.chipy
+    coords = np.vstack([events.field("chipx"), events.field("chipy")]).T
 
-        coords = []
+    # We only need to know whether there are at least 10 unique coordinates
 
-        for n in range(len(chipx)):
-            temp = []
-            temp.append(chipx[n])
-            temp.append(chipy[n])
+    if count_unique(coords, stop_at=10) < 10:
 
-            coords.append(temp)
+        print("\nWARNING: vtpdetect was not run because there were less than 10 unique coordinates\n")
 
-        if len(unique_list(coords)) < 10:
+        return [list(candidate_row) + [1e-99]]
 
-            print "\nWARNING: vtpdetect was not run because there were less than 10 unique coordinates\n"
+    # run vtpdetect on an event file with just the time interval (from the cache of slices)
 
-            temp_list = []
+    evtfile_new = slicer.get_file(tstart, tstop)
 
-            temp_list.extend(master_data[i])
-            temp_list.append(1e-99)
+    vtpdetect_file = os.path.join(outdir,
+                                  'ccd_%s_%s_filtered_candidate_%s_vtpdetect.fits' % (ccd, obsid, candidate))
 
-            vtpdetect_data.append(temp_list)
+    cmd_line = 'vtpdetect %s expfile=%s outfile=%s ellsigma=1 limit=1e-5 coarse=3 maxiter=10 scale=1 clobber=yes' \
+               % (evtfile_new, expfile_new, vtpdetect_file)
 
-        else:
+    runner.run(cmd_line)
 
-            vtpdetect_file = os.path.join(outdir,
-                                          'ccd_%s_%s_filtered_candidate_%s_vtpdetect.fits' % (ccd, obsid, candidate))
+    # The slice stays in the cache (for the other candidates in the same interval): it is removed by
+    # event_slicer.evict_cache when the cache is full and no process is using it
 
-            cmd_line = 'vtpdetect %s expfile=%s outfile=%s ellsigma=1 limit=1e-5 coarse=3 maxiter=10 scale=1 clobber=yes' \
-                       % (evtfile_new, expfile_new, vtpdetect_file)
+    slicer.release_file(evtfile_new)
 
-            runner.run(cmd_line)
+    # Check contents of file
 
-            # Check contents of file
+    with pyfits.open(vtpdetect_file, memmap=False) as h:
 
-            with pyfits.open(vtpdetect_file, memmap=False) as h:
+        regions = h['SRCLIST'].data
 
-                regions = h['SRCLIST'].data
+    # further analysis if not empty
 
-                # further analysis if not empty
+    if len(regions) == 0:
 
-                if len(regions) != 0:
+        os.remove(vtpdetect_file)
 
-                    # check that the source in question is related to that given by xtdac by checking to see if it's
-                    # within a circle having a radius of the major axis of the region
+        return []
 
-                    for j in xrange(len(regions)):
+    # check that the source in question is related to that given by xtdac by checking to see if it's
+    # within a circle having a radius of the major axis of the region
 
-                        radius = max(regions['R'][j])
+    return [list(candidate_row) + [float(fsp)] for fsp in match_sources(ra, dec, regions)]
 
-                        ra_reg = regions['RA'][j]
-                        dec_reg = regions['DEC'][j]
 
-                        p1 = SkyCoord(ra, dec, unit="deg")
-                        p2 = SkyCoord(ra_reg, dec_reg, unit="deg")
+if __name__ == "__main__":
 
-                        sep = p2.separation(p1).arcsec
+    parser = argparse.ArgumentParser(description="Run vtpdetect to find sources in regions given by xtdac")
 
-                        temp_list = []
+    parser.add_argument("--masterfile", help="Path to file containing list of transients in this set",
+                        required=True, type=str)
+    parser.add_argument("--outfile", help="Name of output file which will contain modified list of transients")
+    parser.add_argument("--data_dir", help="Path to directory containing data of all obsids", required=True,
+                        type=str)
+    parser.add_argument("--outdir", help="Directory where output files will go", required=True, type=str)
+    parser.add_argument("-s", "--resampleFactor",
+                        help="Oversample the input image by this factor before processing",
+                        type=int, default=5, required=False)
+    parser.add_argument("-c", "--ncpus", help="Number of candidates to process in parallel (default=1)",
+                        type=int, default=1, required=False)
 
-                        if sep <= 2 * radius:
-                            fsp = regions['FSP'][j]
+    # Get logger for this command
 
-                            temp_list.extend(master_data[i])
-                            temp_list.append(float(fsp))
+    logger = logging_system.get_logger(os.path.basename(sys.argv[0]))
 
-                            vtpdetect_data.append(temp_list)
+    # Instance the command runner
 
-                else:
+    runner = CommandRunner(logger)
 
-                    os.remove(vtpdetect_file)
-                    os.remove(evtfile_new)
+    args = parser.parse_args()
+
+    masterfile = sanitize_filename(args.masterfile)
+    data_dir = sanitize_filename(args.data_dir)
+    outdir = sanitize_filename(args.outdir)
+    outfile = os.path.join(outdir, sanitize_filename(args.outfile))
+
+    # Get data from master list
+    master_data = read_candidates(masterfile)
+
+    # Fill the caches of filtered exposure maps here, once for each obsid and CCD, so the workers only read them
+    # (and do not write the index of the same data package at the same time)
+
+    for obsid in np.unique(master_data['Obsid']):
+
+        obsid_dir = os.path.join(data_dir, str(obsid))
+
+        expomap_cache = get_expomap_cache(obsid_dir, outdir, runner)
+
+        for ccd in np.unique(master_data['CCD'][master_data['Obsid'] == obsid]):
+
+            all_regions_file, evtfile, expfile = get_input_files(obsid_dir, obsid, ccd)
+
+            expomap_cache.get(expfile, all_regions_file, evtfile, ccd, resample_factor=args.resampleFactor)
+
+    # Now run vtpdetect on each candidate. Finished candidates are recorded in the checkpoint file, so an
+    # interrupted run can be resumed
+
+    checkpoint_file = "%s.checkpoint" % outfile
+
+    vtpdetect_data = run_followup(run_vtpdetect, list(master_data), args=(data_dir, outdir, args.resampleFactor),
+                                  ncpus=args.ncpus, checkpoint_file=checkpoint_file)
 
     vtpdetect_data_unique = unique_list(vtpdetect_data, range(1, len(master_data.dtype.names)))
 
@@ -175,12 +247,12 @@ if __name__ == "__main__":
 
     if os.path.exists(args.outfile):
 
-        old_data = np.array(np.recfromtxt(args.outfile, names=True), ndmin=1)
+        old_data = read_candidates(args.outfile)
 
         current_data = []
 
-        for list in old_data:
-            current_data.append(list.tolist())
+        for row in old_data:
+            current_data.append(row.tolist())
 
         for i in range(len(vtpdetect_sorted)):
             current_data.append(vtpdetect_sorted[i])
@@ -189,21 +261,14 @@ if __name__ == "__main__":
 
         current_data = vtpdetect_sorted
 
-    with open(args.outfile, "w") as k:
-
-        existing_column_names = " ".join(master_data.dtype.names)
-
-        k.write("# %s Significance\n" % existing_column_names)
-
-        for i in range(len(current_data)):
+    # Write the output list with the candidates renumbered (the format is given by the extension of the file)
 
-            temp_list = []
+    column_names = list(master_data.dtype.names) + ['Significance']
 
-            temp_list.append(str(i + 1))
+    out_rows = [[i + 1] + list(row[1:len(column_names)]) for i, row in enumerate(current_data)]
 
-            for j in range(1, len(master_data.dtype.names) + 1):
-                temp_list.append(str(current_data[i][j]))
+    write_candidates(args.outfile, make_table(column_names, out_rows))
 
-            line = " ".join(temp_list)
+    # Done, the checkpoint is not needed anymore
 
-            k.write("%s\n" % line)
+    os.remove(checkpoint_file)
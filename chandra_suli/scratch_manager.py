@@ -0,0 +1,300 @@
+"""
+Choose where to put the work directory of a job (/dev/shm or local disk) according to the expected footprint of
+the obsid, track the disk usage during the run and remove intermediate files which are not needed anymore
+"""
+
+import fnmatch
+import os
+import shutil
+import struct
+import threading
+
+from chandra_suli.logging_system import get_logger
+
+logger = get_logger("scratch_manager")
+
+# Intermediate files produced by the different steps, which can be removed as soon as the step which uses
+# them has finished (the event store of an obsid is a directory, see event_store.py)
+
+intermediate_patterns = ['__temp__*', 'temp_reg_*', '___2_events.fits', '__expomap_temp.fits', '__*_reg_revised.fits',
+                         '*_events.store']
+
+
+def uncompressed_size(filename):
+    """
+    Returns the size of the file once decompressed. For gzip files this is read from the trailer of the file
+    (which stores the size modulo 2^32), so it is only a lower limit for files larger than 4 GB
+
+    :param filename:
+    :return: size in bytes
+    """
+
+    if not filename.endswith(".gz"):
+
+        return os.path.getsize(filename)
+
+    with open(filename, 'rb') as f:
+
+        f.seek(-4, os.SEEK_END)
+
+        size = struct.unpack('<I', f.read(4))[0]
+
+    return max(size, os.path.getsize(filename))
+
+
+def estimate_footprint(data_package, evt_copies=7.0, exp_copies=4.0):
+    """
+    Estimate how much space is needed in the work directory to process an obsid. The event file is copied several
+    times (staged file, energy-filtered file, region-filtered file, file without hot pixels, per-CCD files), plus
+    the event store used to separate the CCDs (about half of the size of the event file, see event_store.py), while
+    the exposure map is copied once and then filtered once per CCD
+
+    :param data_package: the DataPackage instance for the input data of the obsid
+    :param evt_copies: how many copies of the event file are in the work directory at the same time
+    :param exp_copies: how many copies of the exposure map are in the work directory at the same time
+    :return: footprint in bytes
+    """
+
+    evt_size = uncompressed_size(data_package.get_path('evt3'))
+    exp_size = uncompressed_size(data_package.get_path('exp3'))
+
+    return int(evt_copies * evt_size + exp_copies * exp_size)
+
+
+def _get_mount(directory):
+
+    # Returns (mount point, file system type) for the file system containing the directory
+
+    directory = os.path.realpath(directory)
+
+    best = ('/', None)
+
+    try:
+
+        with open('/proc/mounts') as f:
+
+            lines = f.readlines()
+
+    except IOError:
+
+        return best
+
+    for line in lines:
+
+        tokens = line.split()
+
+        if len(tokens) < 3:
+            continue
+
+        mount_point, fs_type = tokens[1], tokens[2]
+
+        if (directory == mount_point or directory.startswith(mount_point.rstrip('/') + '/')) \
+                and len(mount_point) >= len(best[0]):
+
+            best = (mount_point, fs_type)
+
+    return best
+
+
+def _get_available_memory():
+
+    # Returns the memory available for new allocations (bytes), as reported by the kernel
+
+    try:
+
+        with open('/proc/meminfo') as f:
+
+            for line in f:
+
+                if line.startswith("MemAvailable:"):
+
+                    return int(line.split()[1]) * 1024
+
+    except IOError:
+
+        pass
+
+    return None
+
+
+def available_space(directory):
+    """
+    Returns the space available in the directory. For a tmpfs (like /dev/shm) the files live in RAM, so the
+    space is limited also by the memory available on the node
+
+    :param directory:
+    :return: space in bytes
+    """
+
+    stats = os.statvfs(directory)
+
+    space = stats.f_bavail * stats.f_frsize
+
+    if _get_mount(directory)[1] == 'tmpfs':
+
+        memory = _get_available_memory()
+
+        if memory is not None:
+
+            space = min(space, memory)
+
+    return space
+
+
+def choose_scratch_dir(footprint, candidates, safety_factor=1.5):
+    """
+    Returns the first of the candidate directories with enough space for the footprint
+
+    :param footprint: expected footprint (bytes)
+    :param candidates: list of directories, in order of preference (for example ['/dev/shm', '/tmp'])
+    :param safety_factor: require this much more space than the footprint
+    :return: path of the chosen directory
+    """
+
+    needed = footprint * safety_factor
+
+    for candidate in candidates:
+
+        if not os.path.isdir(candidate):
+
+            continue
+
+        space = available_space(candidate)
+
+        if space >= needed:
+
+            logger.info("Using %s as scratch (needed: %.2f GB, available: %.2f GB)"
+                        % (candidate, needed / 1024.0 ** 3, space / 1024.0 ** 3))
+
+            return candidate
+
+        else:
+
+            logger.warning("Not enough space in %s (needed: %.2f GB, available: %.2f GB)"
+                        % (candidate, needed / 1024.0 ** 3, space / 1024.0 ** 3))
+
+    raise IOError("None of the scratch directories %s has enough space (%.2f GB) for this job"
+                  % (",".join(candidates), needed / 1024.0 ** 3))
+
+
+def directory_usage(directory):
+    """
+    Returns the total size of the files in the directory (and its subdirectories)
+
+    :param directory:
+    :return: size in bytes
+    """
+
+    total = 0
+
+    for root, dirnames, filenames in os.walk(directory):
+
+        for filename in filenames:
+
+            try:
+
+                total += os.path.getsize(os.path.join(root, filename))
+
+            except OSError:
+
+                # The file has been removed in the meantime
+
+                pass
+
+    return total
+
+
+def evict(directory='.', patterns=None):
+    """
+    Remove the intermediate files in the directory (not in its subdirectories). Directories matching the patterns
+    are removed with all their content
+
+    :param directory:
+    :param patterns: list of unix-style wildcards (default: intermediate_patterns)
+    :return: number of bytes freed
+    """
+
+    if patterns is None:
+
+        patterns = intermediate_patterns
+
+    freed = 0
+
+    for filename in os.listdir(directory):
+
+        path = os.path.join(directory, filename)
+
+        is_directory = os.path.isdir(path)
+
+        if not (is_directory or os.path.isfile(path)):
+
+            continue
+
+        for pattern in patterns:
+
+            if fnmatch.fnmatch(filename, pattern):
+
+                if is_directory:
+
+                    freed += directory_usage(path)
+
+                    shutil.rmtree(path)
+
+                else:
+
+                    freed += os.path.getsize(path)
+
+                    os.remove(path)
+
+                logger.debug("Evicted %s" % path)
+
+                break
+
+    return freed
+
+
+class UsageMonitor(object):
+    def __init__(self, directory, interval=10.0):
+        """
+        Track the usage of the directory in a background thread, keeping the peak value
+
+        :param directory:
+        :param interval: time between two measurements (s)
+        """
+
+        self._directory = directory
+        self._interval = float(interval)
+
+        self._peak = 0
+
+        self._stop_event = threading.Event()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    @property
+    def peak(self):
+
+        return self._peak
+
+    def _run(self):
+
+        while not self._stop_event.is_set():
+
+            self._peak = max(self._peak, directory_usage(self._directory))
+
+            self._stop_event.wait(self._interval)
+
+    def __enter__(self):
+
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        self._stop_event.set()
+
+        self._thread.join()
+
+        logger.info("Peak usage of %s: %.2f GB" % (self._directory, self._peak / 1024.0 ** 3))
@@ -3,18 +3,22 @@
 """"
 Take event file and create multiple new event files separated by CCD
 
-command from CIAO: dmcopy filtered_event.fits[EVENTS][ccd_id=N] out.fits clobber=yes
+The event file is loaded once in an event store (see event_store.py), where each CCD is recorded as a selection of
+rows. The event files for the CCDs (needed by xtdac) are then written in one pass over the event file, with all its
+columns. This replaces ten runs of:
 
-Make sure CIAO is running before running this script
+dmcopy filtered_event.fits[EVENTS][ccd_id=N] out.fits clobber=yes
+
+each one reading the whole event file
 """
 
 import argparse
+import collections
 import os
-import subprocess
 
-import astropy.io.fits as pyfits
-from chandra_suli.run_command import CommandRunner
+from chandra_suli.event_store import EventStore
 from chandra_suli.logging_system import get_logger
+from chandra_suli.sanitize_filename import sanitize_filename
 
 if __name__ == "__main__":
 
@@ -22,27 +26,58 @@ if __name__ == "__main__":
 
     parser.add_argument('--evtfile', help="Event file name", type=str, required=True)
 
+    parser.add_argument('--store', help="Directory of the event store for this event file (default: the name of the "
+                                        "event file with extension .store, in the current directory)",
+                        type=str, required=False, default=None)
+
+    parser.add_argument('--exclude', help="Sidecar file with the rows to exclude, like the events in hot pixels "
+                                          "found by prefilter_hot_pixels.py", type=str, required=False, default=None)
+
+    parser.add_argument('--name', help="The CCD files are called ccd_[ccd id]_[name] (default: the name of the event "
+                                       "file)", type=str, required=False, default=None)
+
     args = parser.parse_args()
 
     logger = get_logger("separate_CCD.py")
-    runner = CommandRunner(logger)
+
+    evtfile = sanitize_filename(args.evtfile)
+
+    if args.store is not None:
+
+        store_dir = args.store
+
+    else:
+
+        store_dir = "%s.store" % os.path.splitext(os.path.basename(evtfile))[0]
 
     print "Separating by CCD..."
 
-    for ccd_id in range(10):
+    store = EventStore.create(store_dir, evtfile)
+
+    if args.exclude is not None:
+
+        # The excluded rows are applied here, so the event file itself is never rewritten without them
+
+        parent = 'not_excluded'
+
+        store.exclude(parent, sanitize_filename(args.exclude), description="Events not in %s" % args.exclude)
+
+    else:
+
+        parent = None
+
+    ccd_selections = store.split_by_ccd(parent)
 
-        ccd_file = "ccd_%s_%s" % (ccd_id, os.path.basename(args.evtfile))
+    name = args.name if args.name is not None else os.path.basename(args.evtfile)
 
-        cmd_line = "dmcopy %s[EVENTS][ccd_id=%s] %s clobber=yes" % (args.evtfile, ccd_id, ccd_file)
+    # CCDs without events do not get a file
 
-        runner.run(cmd_line)
+    ccd_files = collections.OrderedDict()
 
-        # check if certain CCD files are empty and then delete them if so
+    for ccd_id, selection in ccd_selections.items():
 
-        f = pyfits.open("%s" % (ccd_file))
-        ccd_data = f[1].data
+        ccd_files["ccd_%s_%s" % (ccd_id, name)] = selection
 
-        if len(ccd_data) == 0:
-            os.remove(ccd_file)
+        logger.info("CCD %s: %s events" % (ccd_id, store.get_selection(selection).shape[0]))
 
-        f.close()
+    store.write_fits_files(ccd_files)
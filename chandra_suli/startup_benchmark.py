@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+Measure the start-up time of the scripts of the pipeline, i.e., the time needed to import them (which is spent
+before anything else, also when only --help is requested). Each script is imported as a module of chandra_suli in a
+new interpreter, so its __main__ block is not executed.
+
+If the interpreter supports it (Python >= 3.7), it is run with "python -X importtime" and the report lists the total
+time spent importing modules and the packages which take most of it. Otherwise only the wall-clock time is reported.
+"""
+
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+
+
+def find_entry_points(directory):
+    """
+    Returns the scripts in the directory (the modules with a __main__ block)
+
+    :param directory: directory containing the modules
+    :return: sorted list of paths
+    """
+
+    scripts = []
+
+    for module in sorted(glob.glob(os.path.join(directory, "*.py"))):
+
+        with open(module) as f:
+
+            source = f.read()
+
+        if "__name__ ==" in source or "__name__==" in source:
+
+            scripts.append(module)
+
+    return scripts
+
+
+def parse_importtime(stderr):
+    """
+    Parse the output of -X importtime
+
+    :param stderr: standard error of the process
+    :return: list of tuples (module, self time in us, cumulative time in us, depth), in the order of the output
+    """
+
+    imports = []
+
+    for line in stderr.splitlines():
+
+        if not line.startswith("import time:") or "[us]" in line:
+
+            continue
+
+        self_time, cumulative_time, module = line[len("import time:"):].split("|")
+
+        # The nesting level is given by the indentation of the module name (two spaces per level)
+
+        depth = (len(module) - len(module.lstrip())) // 2
+
+        imports.append((module.strip(), int(self_time), int(cumulative_time), depth))
+
+    return imports
+
+
+def summarize_imports(imports, n_top=5):
+    """
+    Summarize the output of -X importtime
+
+    :param imports: output of parse_importtime
+    :param n_top: number of packages to report
+    :return: (total import time in s, list of (package, time in s) sorted by decreasing time)
+    """
+
+    total = 0
+
+    by_package = {}
+
+    for module, self_time, cumulative_time, depth in imports:
+
+        total += self_time
+
+        package = module.split(".")[0]
+
+        by_package[package] = by_package.get(package, 0) + self_time
+
+    top = sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:n_top]
+
+    return total / 1e6, [(package, package_time / 1e6) for package, package_time in top]
+
+
+def measure(script, python=sys.executable):
+    """
+    Import the script in a new interpreter and measure its start-up time
+
+    :param script: path to the script
+    :param python: interpreter to use
+    :return: (wall-clock time in s, return code, list of imports, or None if -X importtime is not supported)
+    """
+
+    statement = "import chandra_suli.%s" % os.path.splitext(os.path.basename(script))[0]
+
+    for cmd_line in ([python, "-X", "importtime", "-c", statement], [python, "-c", statement]):
+
+        start = time.time()
+
+        process = subprocess.Popen(cmd_line, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+        _, stderr = process.communicate()
+
+        wall_time = time.time() - start
+
+        imports = parse_importtime(stderr)
+
+        if len(imports) > 0:
+
+            return wall_time, process.returncode, imports
+
+    return wall_time, process.returncode, None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure the start-up time of the scripts of the pipeline")
+
+    parser.add_argument("--python", help="Interpreter to use (default: the current one)", default=sys.executable,
+                        type=str, required=False)
+    parser.add_argument("--n_top", help="Number of packages to list for each script (default: 5)", default=5,
+                        type=int, required=False)
+    parser.add_argument("scripts", help="Scripts to measure (default: all the scripts in chandra_suli)", nargs="*")
+
+    args = parser.parse_args()
+
+    scripts = args.scripts if len(args.scripts) > 0 else find_entry_points(os.path.dirname(os.path.abspath(__file__)))
+
+    total_wall_time = 0
+
+    for script in scripts:
+
+        wall_time, return_code, imports = measure(script, args.python)
+
+        total_wall_time += wall_time
+
+        status = "" if return_code == 0 else " (exit code %s)" % return_code
+
+        if imports is None:
+
+            print("%-30s %6.3f s%s" % (os.path.basename(script), wall_time, status))
+
+            continue
+
+        import_time, top = summarize_imports(imports, args.n_top)
+
+        print("%-30s %6.3f s, imports %6.3f s%s: %s" % (os.path.basename(script), wall_time, import_time, status,
+                                                         ", ".join(["%s %.3f" % item for item in top])))
+
+    print("Total: %.3f s for %s scripts" % (total_wall_time, len(scripts)))
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 
 """
-Submit one or more obsid for processing on the Stanford computer farm
+Submit one or more obsid for processing on the Stanford computer farm (or run them on this machine)
 """
 
 import argparse
 import os
 import subprocess
 
+from chandra_suli import job_packing
+from chandra_suli.executors import FarmJob, LocalExecutor, PBSExecutor
 from chandra_suli.sanitize_filename import sanitize_filename
 from chandra_suli.which import which
 from chandra_suli.work_within_directory import work_within_directory
@@ -62,11 +64,59 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbosity", help="Info or debug", type=str, required=False, default='info',
                         choices=['info', 'debug'])
 
+    # Arguments for the packing of many obsids in few jobs
+
+    parser.add_argument("--pack", help="Group obsids in jobs according to their estimated cost (from the header of the "
+                                       "evt3 file), instead of submitting one job per obsid",
+                        dest='pack', action='store_true')
+    parser.set_defaults(pack=False)
+
+    parser.add_argument("--target_walltime", help="Target wall time for each job when packing (hours, default: 4)",
+                        type=float, default=4.0, required=False)
+
+    parser.add_argument("--walltime_factor", help="When packing, the wall time requested for each job is the "
+                                                  "estimated one times this factor (default: 2)",
+                        type=float, default=2.0, required=False)
+
+    parser.add_argument("--min_walltime", help="When packing, minimum wall time requested for each job (hours, "
+                                               "default: 1)", type=float, default=1.0, required=False)
+
+    parser.add_argument("--min_vmem", help="Minimum memory to request for a job on the farm (GB, default: 20). vmem "
+                                           "limits the virtual address space, which is much larger than the memory "
+                                           "actually used", type=float, default=20.0, required=False)
+
+    parser.add_argument("--max_vmem", help="Maximum memory to request for a job (GB, default: 64)",
+                        type=float, default=64.0, required=False)
+
+    parser.add_argument("--job_array", help="When packing, submit one PBS job array instead of individual jobs",
+                        dest='job_array', action='store_true')
+    parser.set_defaults(job_array=False)
+
+    # Arguments for the execution backend
+
+    parser.add_argument("--backend", help="Where to run the jobs: on the PBS farm, or on this machine with a pool "
+                                          "of processes (default: pbs)",
+                        type=str, required=False, default='pbs', choices=['pbs', 'local'])
+
+    parser.add_argument("--max_cpus", help="Local backend: number of CPUs which can be used at the same time by all "
+                                           "jobs (default: all)", type=int, default=None, required=False)
+
+    parser.add_argument("--max_memory", help="Local backend: memory (GB) which can be used at the same time by all "
+                                             "jobs (default: all the physical memory)",
+                        type=float, default=None, required=False)
+
+    parser.add_argument("--scratch_dir", help="Local backend: directory for the work directories of the jobs "
+                                              "(default: /dev/shm or local disk, depending on the free memory)",
+                        type=str, default=None, required=False)
+
     parser.add_argument('--test', dest='test_run', action='store_true')
     parser.set_defaults(test_run=False)
 
     args = parser.parse_args()
 
+    if args.job_array and args.backend != 'pbs':
+        parser.error("--job_array can only be used with the pbs backend")
+
     # Check that the output dir already exists
 
     outdir = sanitize_filename(args.outdir)
@@ -104,25 +154,99 @@ if __name__ == "__main__":
         # Find executable
         exe_path = which('farm_wrapper.py')
 
+        if args.backend == 'pbs':
+
+            executor = PBSExecutor(exe_path, log_path, ppn=4, test_run=args.test_run)
+
+        else:
+
+            executor = LocalExecutor(exe_path, log_path, max_cpus=args.max_cpus, max_memory=args.max_memory,
+                                     scratch_dir=args.scratch_dir, test_run=args.test_run)
+
+
+        def get_memory(memory):
+
+            # On the farm vmem limits the virtual memory, and CIAO, xtdac and numpy reserve much more address space
+            # than the size of the event table, so never request less than --min_vmem
+
+            if args.backend == 'pbs':
+
+                memory = max(memory, args.min_vmem)
+
+            return min(memory, args.max_vmem)
+
 
-        def get_cmd_line(this_obsid):
+        def get_options(obsid_option):
 
-            options = '--indir %s --regdir %s --outdir %s -o %s -a %s -e1 %s -e2 %s ' \
-                      '-p %s -s %s -m %s -c %s' % (args.indir, args.regdir, out_path, this_obsid, args.adj_factor,
+            options = '--indir %s --regdir %s --outdir %s %s -a %s -e1 %s -e2 %s ' \
+                      '-p %s -s %s -m %s -c %s' % (args.indir, args.regdir, out_path, obsid_option, args.adj_factor,
                                                    args.emin, args.emax, args.typeIerror, args.sigmaThreshold,
                                                    args.multiplicity, args.ncpus)
 
-            cmd_line = "qsub -l vmem=20gb -l nodes=1:ppn=4 -o %s/%s.out -e %s/%s.err -V " \
-                       "-F '%s' %s " % (log_path, this_obsid, log_path, this_obsid, options, exe_path)
+            return options
+
+
+        # The resources requested for each job come from the estimated cost of its obsids. The estimate of the wall
+        # time is rough, so it is used (with a margin) only when packing. Otherwise, as always, no wall time is
+        # requested
+
+        cost_model = job_packing.CostModel()
+
+        costs = [cost_model.estimate_from_repository(indir, obsid) for obsid in args.obsid]
+
+        for cost in costs:
+
+            print(cost)
+
+        if not args.pack:
+
+            for cost in costs:
+
+                executor.submit(FarmJob(str(cost.obsid), get_options("-o %s" % cost.obsid), cpus=args.ncpus,
+                                        memory=get_memory(cost.memory)))
+
+        else:
+
+            jobs = job_packing.pack_obsids(costs, args.target_walltime * 3600.0)
+
+            def get_walltime(walltime):
+
+                return job_packing.request_walltime(walltime, args.walltime_factor, args.min_walltime * 3600.0)
+
+            if args.job_array:
+
+                # Write the list of obsids for each element of the array, one line per element
+
+                joblist_file = os.path.abspath(os.path.join('logs', 'joblist_%s_%s.txt' % (args.obsid[0],
+                                                                                          len(args.obsid))))
+
+                with open(joblist_file, "w+") as f:
+
+                    for job in jobs:
+
+                        f.write("%s\n" % " ".join(map(str, job.obsids)))
+
+                # All the jobs in the array share the same resource request, so use the largest one
+
+                memory = get_memory(max([job.memory for job in jobs]))
+                walltime = get_walltime(max([job.walltime for job in jobs]))
+
+                executor.submit(FarmJob("joblist", get_options("--joblist %s" % joblist_file), cpus=args.ncpus,
+                                        memory=memory, walltime=walltime, array_size=len(jobs)))
+
+            else:
 
-            return cmd_line
+                for job in jobs:
 
+                    obsids = job.obsids
 
-        for obsid in args.obsid:
+                    executor.submit(FarmJob("%s_%s" % (obsids[0], len(obsids)),
+                                            get_options("-o %s" % " ".join(map(str, obsids))),
+                                            cpus=args.ncpus, memory=get_memory(job.memory),
+                                            walltime=get_walltime(job.walltime)))
 
-            this_cmd_line = get_cmd_line(obsid)
+        failed = executor.wait()
 
-            print(this_cmd_line)
+        if len(failed) > 0:
 
-            if not args.test_run:
-                subprocess.check_call(this_cmd_line, shell=True)
+            raise RuntimeError("The following jobs failed: %s. Check the logs in %s" % (", ".join(failed), log_path))
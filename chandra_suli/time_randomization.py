@@ -0,0 +1,169 @@
+"""
+Randomize the arrival times of the events within their time frame and sort the events by time, in one pass.
+
+Each TIME is shifted by a uniform random amount in [-TIMEDEL / 2, TIMEDEL / 2], drawn from a seeded generator, so
+the result is reproducible: the seed is written in the header of the EVENTS extension (keyword RANDSEED). The new
+file is written once, already sorted (this replaces updating the file in place and then running fsort on it).
+
+The input file is read in blocks of rows. When it is sorted by time (as the event files from the archive are), an
+event can move by at most half a frame, so the events of each block can be written as soon as no later event can
+come before them: only a fraction of a frame of events is kept in memory besides the current block. If the input is
+not sorted, the whole table is sorted in memory instead. Both ways give the same file.
+"""
+
+import numpy as np
+
+from chandra_suli.event_reader import EventFileReader, EventFileWriter, default_chunk_size
+from chandra_suli.logging_system import get_logger
+from chandra_suli.sanitize_filename import sanitize_filename
+
+logger = get_logger("time_randomization")
+
+def new_seed():
+    """
+    Returns a random seed for randomize_and_sort
+
+    :return: an integer in [0, 2^31)
+    """
+
+    return int(np.random.RandomState().randint(0, 2 ** 31 - 1))
+
+
+def _stable_order(time):
+
+    # Mergesort is stable: events with the same time keep their order
+
+    return np.argsort(time, kind='mergesort')
+
+
+class _NotSorted(ValueError):
+
+    pass
+
+
+def _sorted_blocks(reader, deltas_generator, frame_time):
+
+    # Generator of the randomized rows in time order, assuming the input is sorted by time. Raises _NotSorted if it
+    # is not
+
+    carry = None
+
+    last_time = None
+
+    for _, raw in reader.iter_raw_chunks():
+
+        original_time = raw['time'].astype(np.float64)
+
+        if original_time.shape[0] == 0:
+
+            continue
+
+        if np.any(original_time[1:] < original_time[:-1]) or (last_time is not None and
+                                                              original_time[0] < last_time):
+
+            raise _NotSorted("The event file is not sorted by time")
+
+        last_time = original_time[-1]
+
+        raw['time'] = original_time + deltas_generator(raw.shape[0])
+
+        rows = raw if carry is None else np.concatenate([carry, raw])
+
+        rows = rows[_stable_order(rows['time'].astype(np.float64))]
+
+        # All the following events will have a time >= last_time - frame_time / 2
+
+        threshold = last_time - frame_time / 2.0
+
+        n_ready = np.searchsorted(rows['time'].astype(np.float64), threshold, side='left')
+
+        yield rows[:n_ready]
+
+        carry = rows[n_ready:]
+
+    if carry is not None:
+
+        yield carry
+
+
+def _sorted_in_memory(reader, deltas_generator, frame_time):
+
+    rows = np.concatenate([raw for _, raw in reader.iter_raw_chunks()] or [np.zeros(0, reader.row_dtype)])
+
+    rows['time'] = rows['time'].astype(np.float64) + deltas_generator(rows.shape[0])
+
+    yield rows[_stable_order(rows['time'].astype(np.float64))]
+
+
+def randomize_and_sort(event_file, outfile, seed=None, frame_time=None, chunk_size=default_chunk_size):
+    """
+    Randomize the arrival times within the time frames and sort the events by time, writing a new event file
+
+    :param event_file: the input event file (not modified)
+    :param outfile: the output event file (overwritten if it exists)
+    :param seed: seed for the random generator (default: a new random seed, see new_seed)
+    :param frame_time: duration of a frame (default: the TIMEDEL keyword)
+    :param chunk_size: number of rows read at once
+    :return: the seed used
+    """
+
+    event_file = sanitize_filename(event_file)
+    outfile = sanitize_filename(outfile)
+
+    if seed is None:
+
+        seed = new_seed()
+
+    reader = EventFileReader(event_file, chunk_size=chunk_size)
+
+    header = reader.header.copy()
+
+    assert header.get('PCOUNT', 0) == 0, "Event files with a heap are not supported"
+
+    if frame_time is None:
+
+        frame_time = header['TIMEDEL']
+
+    frame_time = float(frame_time)
+
+    header['RANDSEED'] = (int(seed), "Seed of the randomization of TIME within frames")
+    header['RANDTIME'] = (frame_time, "[s] TIME randomized within +/- RANDTIME/2")
+
+    logger.info("Found a frame time of %s. Randomizing arrival times within time frame (seed: %s)..."
+                % (frame_time, seed))
+
+    for sorter in (_sorted_blocks, _sorted_in_memory):
+
+        # The random numbers are drawn in the order of the rows of the input file, so both ways give the same
+        # result for the same seed
+
+        random_state = np.random.RandomState(seed)
+
+        def deltas_generator(n):
+
+            return random_state.uniform(-frame_time / 2.0, frame_time / 2.0, n)
+
+        try:
+
+            _write(reader, header, sorter(reader, deltas_generator, frame_time), outfile)
+
+        except _NotSorted as error:
+
+            logger.warning("%s. Sorting it in memory." % error)
+
+            continue
+
+        break
+
+    return seed
+
+
+def _write(reader, header, blocks, outfile):
+
+    # Write the new file: the HDUs before and after the EVENTS extension are copied as they are
+
+    with EventFileWriter(reader, outfile, reader.n_rows, header) as writer:
+
+        for rows in blocks:
+
+            writer.write(rows)
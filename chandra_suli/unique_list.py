@@ -2,9 +2,67 @@
 Check for unique lists within an array
 """
 
+import numpy as np
+
+
+def _get_elements(array, elements_to_check):
+
+    if elements_to_check == 0:
+
+        return list(range(len(array[0])))
+
+    else:
+
+        return list(elements_to_check)
+
+
+def _as_homogeneous_array(array, elements):
+
+    # Returns a contiguous 2d numpy array with only the elements to check, if the input is a homogeneous numerical
+    # array (or list of lists), otherwise None
+
+    if isinstance(array, np.ndarray):
+
+        data = array
+
+    else:
+
+        try:
+
+            data = np.asarray(array)
+
+        except ValueError:
+
+            # Rows of different lengths
+
+            return None
+
+    if data.ndim != 2 or data.dtype.kind not in 'biuf':
+
+        return None
+
+    data = data[:, elements]
+
+    if data.dtype.kind == 'f':
+
+        # Adding zero turns -0.0 into 0.0, which otherwise would have a different byte representation
+
+        data = data + 0.0
+
+    return np.ascontiguousarray(data)
+
+
+def _row_view(data):
+
+    # View each row of a 2d array as one opaque element, so rows can be compared with np.unique
+
+    return data.view(np.dtype((np.void, data.dtype.itemsize * data.shape[1]))).ravel()
+
 
 def unique_list(array, elements_to_check=0):
     """
+    Remove duplicated rows. When a row appears more than once, only its last occurrence is kept, and the order of the
+    rows is preserved
 
     :param array: Array of lists to be checked
     :param elements_to_check: range of numbers corresponding to indices of list
@@ -13,53 +71,86 @@ def unique_list(array, elements_to_check=0):
 
     n_rows = len(array)
 
-    unique_array = []
+    if n_rows == 0:
 
-    if elements_to_check == 0:
+        return []
+
+    elements = _get_elements(array, elements_to_check)
+
+    data = _as_homogeneous_array(array, elements)
+
+    if data is not None:
+
+        # Fast path: np.unique on the reversed rows gives the index of the last occurrence of each row
+
+        _, reversed_idx = np.unique(_row_view(data)[::-1], return_index=True)
 
-        elements = range(len(array[0]))
+        keep = np.sort(n_rows - 1 - reversed_idx)
 
     else:
 
-        elements = elements_to_check
+        # Generic path: hash the elements to check, going backward so the first time we see a row is its
+        # last occurrence
 
+        seen = set()
 
-    # for each row
+        keep = []
+
+        for i in range(n_rows - 1, -1, -1):
+
+            key = tuple([array[i][k] for k in elements])
+
+            if key not in seen:
+
+                seen.add(key)
+
+                keep.append(i)
+
+        keep.reverse()
+
+    return [array[i] for i in keep]
+
+
+def count_unique(coords, stop_at=None, block_size=4096):
+    """
+    Count the unique rows in a 2d array (for example an array of (chipx, chipy) coordinates)
+
+    :param coords: 2d array (or list of lists)
+    :param stop_at: if provided, stop counting as soon as this number of unique rows has been found (and return it)
+    :param block_size: number of rows processed at once when stop_at is provided
+    :return: number of unique rows (at most stop_at)
+    """
 
-    for i in range(n_rows):
+    n_rows = len(coords)
 
-        row_a = array[i]
+    if n_rows == 0:
 
-        equal_row = False
+        return 0
 
-        # for all subsequent rows
+    elements = _get_elements(coords, 0)
 
-        for j in range(i + 1, n_rows):
+    data = _as_homogeneous_array(coords, elements)
 
-            row_b = array[j]
+    if data is None:
 
-            # check if each element in rows are equal, breaking after finding even one unequal element
+        # Not a numerical array, use the generic implementation
 
-            for k in elements:
+        return min(len(unique_list(coords)), stop_at if stop_at is not None else n_rows)
 
-                equal_element = True
+    rows = _row_view(data)
 
-                if row_a[k] != row_b[k]:
-                    equal_element = False
-                    break
+    if stop_at is None:
 
-            if equal_element == True:
-                equal_row = True
-                break
+        return np.unique(rows).shape[0]
 
-        if equal_row == True:
+    seen = set()
 
-            pass
+    for start in range(0, n_rows, block_size):
 
-        # append all unique rows to new array
+        seen.update(np.unique(rows[start:start + block_size]).tolist())
 
-        else:
+        if len(seen) >= stop_at:
 
-            unique_array.append(row_a)
+            return stop_at
 
-    return unique_array
+    return len(seen)
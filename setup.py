@@ -23,6 +23,8 @@ setup(
 
     install_requires=[],
 
-    include_package_data=True
+    include_package_data=True,
+
+    entry_points={'console_scripts': ['chandra-suli = chandra_suli.cli:main']}
 
 )
@@ -0,0 +1,70 @@
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+# Keywords of a Chandra event file used by the code under test
+_frame_time = 3.2
+_tstart = 1000.0
+
+
+def write_event_file(filename, n_events=2000, ccds=(0, 1, 2, 3), sort=True, seed=0):
+    """
+    Write a small synthetic event file, with the columns and the keywords of a Chandra evt3 file used by the
+    pipeline, and a GTI extension
+
+    :return: the EVENTS table (as a numpy structured array)
+    """
+
+    random_state = np.random.RandomState(seed)
+
+    # Times on a frame grid, with several events in the same frame (so there are ties)
+
+    time = _tstart + random_state.randint(0, n_events // 4, n_events) * _frame_time + 0.1
+
+    if sort:
+
+        time = np.sort(time)
+
+    columns = [pyfits.Column(name='time', format='1D', unit='s', array=time),
+               pyfits.Column(name='ccd_id', format='1I', array=random_state.choice(ccds, n_events)),
+               pyfits.Column(name='node_id', format='1I', array=random_state.randint(0, 4, n_events)),
+               pyfits.Column(name='expno', format='1J', array=random_state.randint(0, 1000, n_events)),
+               pyfits.Column(name='chipx', format='1I', array=random_state.randint(1, 1025, n_events)),
+               pyfits.Column(name='chipy', format='1I', array=random_state.randint(1, 1025, n_events)),
+               pyfits.Column(name='x', format='1E', array=random_state.uniform(3000, 5000, n_events)),
+               pyfits.Column(name='y', format='1E', array=random_state.uniform(3000, 5000, n_events)),
+               pyfits.Column(name='energy', format='1E', unit='eV', array=random_state.uniform(300, 7000, n_events)),
+               pyfits.Column(name='pha', format='1J', array=random_state.randint(0, 4096, n_events)),
+               pyfits.Column(name='pi', format='1J', array=random_state.randint(1, 1024, n_events)),
+               pyfits.Column(name='status', format='32X', array=np.zeros((n_events, 32), dtype=bool))]
+
+    events = pyfits.BinTableHDU.from_columns(columns, name='EVENTS')
+
+    events.header['TSTART'] = _tstart
+    events.header['TSTOP'] = float(time.max()) + _frame_time
+    events.header['TIMEDEL'] = _frame_time
+    events.header['DETNAM'] = "ACIS-%s" % "".join(map(str, ccds))
+
+    gti = pyfits.BinTableHDU.from_columns([pyfits.Column(name='START', format='1D', array=[_tstart]),
+                                           pyfits.Column(name='STOP', format='1D',
+                                                         array=[events.header['TSTOP']])],
+                                          name='GTI')
+
+    pyfits.HDUList([pyfits.PrimaryHDU(), events, gti]).writeto(filename)
+
+    with pyfits.open(filename, memmap=False) as hdulist:
+
+        return np.array(hdulist['EVENTS'].data)
+
+
+@pytest.fixture
+def event_file(tmpdir):
+    """
+    Path of a synthetic event file (sorted by time, 4 CCDs)
+    """
+
+    filename = str(tmpdir.join("evt3.fits"))
+
+    write_event_file(filename)
+
+    return filename
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from chandra_suli.candidate_table import add_columns, make_table, read_candidates, sanitize_column_name, \
+    write_candidates
+
+_formats = ["txt", "npy", "fits"]
+
+
+def _candidates():
+
+    names = ['Candidate', 'Obsid', 'CCD', 'RA', 'Dec', 'Tstart', 'Tstop', 'Probability', 'Hot_Pixel_Flag',
+             'Separation(arcsec)']
+
+    rows = [(1, 1234, 3, 123.456789123, -45.123456789, 450000000.123456789, 450000012.3456789, 1e-5, True, 0.25),
+            (2, 1234, 3, 0.1, 89.9, 450000100.0, 450000200.5, 0.5, False, 12.0),
+            (3, 1234, 7, 359.99999, -0.000001, 450001000.7, 450001003.9, 2.5e-12, False, 0.0)]
+
+    return make_table(names, rows)
+
+
+def _assert_same_table(data, expected):
+
+    assert data.dtype.names == expected.dtype.names
+
+    assert data.shape == expected.shape
+
+    for name in expected.dtype.names:
+
+        assert data[name].dtype.kind == expected[name].dtype.kind, name
+
+        assert list(data[name]) == list(expected[name]), name
+
+
+@pytest.mark.parametrize("extension", _formats)
+def test_round_trip(tmpdir, extension):
+
+    data = _candidates()
+
+    filename = str(tmpdir.join("candidates.%s" % extension))
+
+    write_candidates(filename, data)
+
+    _assert_same_table(read_candidates(filename), data)
+
+
+@pytest.mark.parametrize("extension", _formats)
+def test_one_row(tmpdir, extension):
+
+    data = _candidates()[:1]
+
+    filename = str(tmpdir.join("candidates.%s" % extension))
+
+    write_candidates(filename, data)
+
+    result = read_candidates(filename)
+
+    assert result.shape == (1,)
+
+    _assert_same_table(result, data)
+
+
+@pytest.mark.parametrize("extension", _formats)
+def test_no_rows(tmpdir, extension):
+
+    data = make_table(['Candidate', 'Obsid', 'Tstart'], [])
+
+    filename = str(tmpdir.join("candidates.%s" % extension))
+
+    write_candidates(filename, data)
+
+    result = read_candidates(filename)
+
+    assert result.shape == (0,)
+
+    assert result.dtype.names == ('Candidate', 'Obsid', 'Tstart')
+
+
+def test_text_comments(tmpdir):
+
+    data = _candidates()
+
+    filename = str(tmpdir.join("candidates.txt"))
+
+    write_candidates(filename, data, comments=["command line:", "farm_step2.py --obsid 1234"])
+
+    lines = tmpdir.join("candidates.txt").read().splitlines()
+
+    assert lines[0] == "# %s" % " ".join(data.dtype.names)
+
+    assert lines[-2:] == ["# command line:", "# farm_step2.py --obsid 1234"]
+
+    _assert_same_table(read_candidates(filename), data)
+
+
+def test_column_names_are_sanitized():
+
+    assert sanitize_column_name("Separation(arcsec)") == "Separationarcsec"
+
+    assert sanitize_column_name(" PSF size ") == "PSF_size"
+
+    assert _candidates().dtype.names[-1] == "Separationarcsec"
+
+
+def test_add_columns():
+
+    data = _candidates()
+
+    new = add_columns(data, ['N_events', 'Duration'], [[5, 6, 7], np.array([1.5, 2.5, 3.5])])
+
+    assert new.dtype.names == data.dtype.names + ('N_events', 'Duration')
+
+    assert list(new['N_events']) == [5, 6, 7]
+
+    assert list(new['RA']) == list(data['RA'])
+
+    empty = add_columns(data[:0], ['N_events'], [np.zeros(0, int)])
+
+    assert empty.shape == (0,)
+    assert empty.dtype.names[-1] == 'N_events'
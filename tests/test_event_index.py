@@ -0,0 +1,168 @@
+import os
+
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+from chandra_suli.event_index import EventIndex, sidecar_file
+from chandra_suli.event_reader import EventFileReader
+
+
+def _brute_force(time, tstart, tstop):
+
+    return np.flatnonzero((time >= tstart) & (time <= tstop))
+
+
+def _as_rows(window, n_rows):
+
+    return np.arange(n_rows)[window]
+
+
+def _windows(time, random_state, n=50):
+
+    # Random windows, windows starting and ending exactly on event times, empty and inverted windows, and windows
+    # beyond the ends of the table
+
+    windows = [sorted(random_state.uniform(time.min() - 10, time.max() + 10, 2)) for _ in range(n)]
+
+    windows += [(time[i], time[j]) for i, j in sorted(random_state.randint(0, time.shape[0], (n, 2)).tolist())]
+
+    windows += [(time[5], time[5]), (time[10], time[5]), (-np.inf, np.inf), (time.max() + 1, time.max() + 2),
+                (time.min() - 2, time.min() - 1)]
+
+    return windows
+
+
+@pytest.mark.parametrize("frame_time", [None, 3.2, 0.01])
+def test_time_window_sorted(frame_time):
+
+    random_state = np.random.RandomState(0)
+
+    time = np.sort(1000.0 + random_state.randint(0, 500, 2000) * 3.2 + 0.1)
+
+    index = EventIndex(time, frame_start=1000.0, frame_time=frame_time)
+
+    assert index.time_sorted
+
+    for tstart, tstop in _windows(time, random_state):
+
+        window = index.time_window(tstart, tstop)
+
+        assert isinstance(window, slice)
+
+        expected = _brute_force(time, tstart, tstop)
+
+        assert np.array_equal(_as_rows(window, time.shape[0]), expected)
+
+        assert index.count(tstart, tstop) == expected.shape[0]
+
+
+def test_time_window_unsorted():
+
+    random_state = np.random.RandomState(1)
+
+    time = 1000.0 + random_state.randint(0, 500, 2000) * 3.2 + 0.1
+
+    index = EventIndex(time, frame_start=1000.0, frame_time=3.2)
+
+    assert not index.time_sorted
+
+    for tstart, tstop in _windows(np.sort(time), random_state):
+
+        assert np.array_equal(index.time_window(tstart, tstop), _brute_force(time, tstart, tstop))
+
+
+@pytest.mark.parametrize("sort", [True, False])
+def test_ccd_time_window(sort):
+
+    random_state = np.random.RandomState(2)
+
+    time = 1000.0 + random_state.randint(0, 500, 3000) * 3.2 + 0.1
+
+    if sort:
+
+        time = np.sort(time)
+
+    ccd_id = random_state.choice([0, 2, 3, 7], 3000)
+
+    index = EventIndex(time, ccd_id, 1000.0, 3.2)
+
+    assert list(index.ccds) == [0, 2, 3, 7]
+
+    for ccd in [0, 2, 3, 7, 5]:
+
+        rows = index.ccd_rows(ccd)
+
+        assert sorted(rows) == list(np.flatnonzero(ccd_id == ccd))
+
+        assert np.all(np.diff(time[rows]) >= 0)
+
+        for tstart, tstop in _windows(np.sort(time), random_state, 10):
+
+            window = index.ccd_time_window(ccd, tstart, tstop)
+
+            expected = np.flatnonzero((ccd_id == ccd) & (time >= tstart) & (time <= tstop))
+
+            assert sorted(window) == list(expected)
+
+            # In time order
+
+            assert np.all(np.diff(time[window]) >= 0)
+
+
+def test_frame_window():
+
+    time = np.array([0.5, 0.7, 1.2, 3.1, 3.9, 4.0])
+
+    index = EventIndex(time, frame_start=0.0, frame_time=1.0)
+
+    assert index.n_frames == 5
+
+    assert [list(_as_rows(index.frame_window(frame), 6)) for frame in range(5)] == [[0, 1], [2], [], [3, 4], [5]]
+
+
+def test_from_hdu_and_from_reader_agree(event_file):
+
+    with pyfits.open(event_file, memmap=False) as hdulist:
+
+        time = np.array(hdulist['EVENTS'].data.field('TIME'))
+
+        from_hdu = EventIndex.from_hdu(hdulist['EVENTS'])
+
+    from_reader = EventIndex.from_reader(EventFileReader(event_file, chunk_size=77))
+
+    for tstart, tstop in _windows(time, np.random.RandomState(3)):
+
+        assert from_hdu.count(tstart, tstop) == from_reader.count(tstart, tstop)
+
+        for ccd in range(4):
+
+            assert np.array_equal(from_hdu.ccd_time_window(ccd, tstart, tstop),
+                                  from_reader.ccd_time_window(ccd, tstart, tstop))
+
+
+def test_sidecar_file(tmpdir, event_file):
+
+    reader = EventFileReader(event_file)
+
+    sidecar_dir = str(tmpdir.mkdir("cache"))
+
+    index = EventIndex.from_reader(reader, sidecar_dir)
+
+    # The sidecar file is not next to the event file
+
+    assert sorted(os.listdir(os.path.dirname(event_file))) == sorted([os.path.basename(event_file), "cache"])
+
+    assert os.listdir(sidecar_dir) == [os.path.basename(sidecar_file(event_file, sidecar_dir))]
+
+    # The second time the index is read from the sidecar file
+
+    reloaded = EventIndex.from_reader(reader, sidecar_dir)
+
+    time = reader.read_column('time')
+
+    for tstart, tstop in _windows(time, np.random.RandomState(4), 10):
+
+        assert index.count(tstart, tstop) == reloaded.count(tstart, tstop)
+
+        assert np.array_equal(index.ccd_time_window(1, tstart, tstop), reloaded.ccd_time_window(1, tstart, tstop))
@@ -0,0 +1,126 @@
+import os
+
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+from chandra_suli import event_slicer
+from chandra_suli.event_slicer import EventSlicer, evict_cache
+
+
+def _read_events(filename):
+
+    with pyfits.open(filename, memmap=False) as hdulist:
+
+        return np.array(hdulist['EVENTS'].data), [hdu.name for hdu in hdulist]
+
+
+@pytest.fixture
+def slicer(tmpdir, event_file):
+
+    with EventSlicer(event_file, cache_dir=str(tmpdir.join("cache"))) as slicer:
+
+        yield slicer
+
+
+@pytest.mark.parametrize("tstart,tstop", [(1100.0, 1300.0), (1000.0, 1000.05), (0.0, 1e6), (1403.3, 1403.3)])
+def test_get_file(slicer, event_file, tstart, tstop):
+
+    events, hdu_names = _read_events(event_file)
+
+    cache_file = slicer.get_file(tstart, tstop)
+
+    # Same as ftcopy "event_file[(TIME >= tstart) && (TIME <= tstop)]"
+
+    slice_events, slice_hdu_names = _read_events(cache_file)
+
+    assert slice_hdu_names == hdu_names
+
+    assert np.array_equal(slice_events, events[(events['time'] >= tstart) & (events['time'] <= tstop)])
+
+    assert slicer.count(tstart, tstop) == slice_events.shape[0]
+
+
+def test_cache_and_locks(slicer):
+
+    cache_file = slicer.get_file(1100.0, 1300.0)
+
+    lock_file = event_slicer._lock_file(cache_file)
+
+    assert os.path.exists(lock_file)
+
+    # The second time the slice comes from the cache
+
+    os.utime(cache_file, (0, 0))
+
+    assert slicer.get_file(1100.0, 1300.0) == cache_file
+
+    assert os.stat(cache_file).st_mtime > 0
+
+    # A slice in use is never evicted
+
+    assert evict_cache(os.path.dirname(cache_file), max_size=0) == 0
+
+    assert os.path.exists(cache_file)
+
+    slicer.release_file(cache_file)
+
+    assert not os.path.exists(lock_file)
+
+    assert evict_cache(os.path.dirname(cache_file), max_size=0) > 0
+
+    assert not os.path.exists(cache_file)
+
+
+def test_stale_locks_are_ignored(slicer):
+
+    cache_file = slicer.get_file(1100.0, 1300.0)
+
+    slicer.release_file(cache_file)
+
+    # Lock file left behind by a process which does not exist anymore
+
+    stale_lock = event_slicer._lock_file(cache_file, pid=2 ** 22 + 1)
+
+    open(stale_lock, 'a').close()
+
+    assert evict_cache(os.path.dirname(cache_file), max_size=0) > 0
+
+    assert not os.path.exists(stale_lock)
+
+
+def test_close_releases_the_slices(tmpdir, event_file):
+
+    with EventSlicer(event_file, cache_dir=str(tmpdir.join("cache"))) as slicer:
+
+        cache_files = [slicer.get_file(1100.0, 1200.0), slicer.get_file(1200.0, 1300.0)]
+
+    assert not any([os.path.exists(event_slicer._lock_file(cache_file)) for cache_file in cache_files])
+
+
+def test_index_sidecar_in_the_cache(tmpdir, event_file):
+
+    with EventSlicer(event_file, cache_dir=str(tmpdir.join("cache"))):
+
+        pass
+
+    # Nothing is written next to the event file (it can be in a data package)
+
+    assert sorted(os.listdir(os.path.dirname(event_file))) == sorted([os.path.basename(event_file), "cache"])
+
+    assert [name for name in os.listdir(str(tmpdir.join("cache"))) if name.endswith(".index.npz")] != []
+
+
+def test_get_slicer_and_release(tmpdir, monkeypatch, event_file):
+
+    monkeypatch.setenv(event_slicer.cache_dir_variable, str(tmpdir.join("cache")))
+
+    slicer = event_slicer.get_slicer(event_file)
+
+    assert event_slicer.get_slicer(event_file) is slicer
+
+    event_slicer.release(event_file)
+
+    assert event_slicer.get_slicer(event_file) is not slicer
+
+    event_slicer.release(event_file)
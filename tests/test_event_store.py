@@ -0,0 +1,158 @@
+import os
+
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+from chandra_suli.event_store import EventStore, default_columns, load_rows, save_rows
+
+from conftest import write_event_file
+
+
+def _read_events(filename):
+
+    with pyfits.open(filename, memmap=False) as hdulist:
+
+        return np.array(hdulist['EVENTS'].data), hdulist['EVENTS'].header.copy(), [hdu.name for hdu in hdulist]
+
+
+@pytest.fixture
+def store(tmpdir, event_file):
+
+    return EventStore.create(str(tmpdir.join("evt3.store")), event_file, chunk_size=333)
+
+
+def test_columns_round_trip(store, event_file):
+
+    events, header, _ = _read_events(event_file)
+
+    assert store.n_rows == events.shape[0]
+
+    assert store.columns == list(default_columns.keys())
+
+    for name, dtype in default_columns.items():
+
+        values = store.column(name)
+
+        assert values.dtype == dtype
+
+        assert np.array_equal(values, events[name].astype(dtype))
+
+    assert store.header['TIMEDEL'] == header['TIMEDEL']
+
+    # The store can be reopened
+
+    assert EventStore(store.directory).n_rows == events.shape[0]
+
+
+def test_selections(store, event_file):
+
+    events, _, _ = _read_events(event_file)
+
+    energy_rows = store.select('soft', events['energy'] < 2000.0, description="Soft events")
+
+    assert np.array_equal(energy_rows, np.flatnonzero(events['energy'] < 2000.0))
+
+    assert store.selections == {'soft': "Soft events"}
+
+    # A selection of a selection
+
+    soft = store.get_selection('soft')
+
+    rows = store.select('soft_ccd1', events['ccd_id'][soft] == 1, parent='soft')
+
+    assert np.array_equal(rows, np.flatnonzero((events['energy'] < 2000.0) & (events['ccd_id'] == 1)))
+
+    assert np.array_equal(store.column('time', 'soft_ccd1'), events['time'][rows])
+
+
+def test_exclude_sidecar(tmpdir, store):
+
+    sidecar = str(tmpdir.join("hot_pixels.npz"))
+
+    save_rows(sidecar, [7, 3, 3, 100], store.n_rows)
+
+    assert list(load_rows(sidecar, store.n_rows)) == [3, 7, 100]
+
+    with pytest.raises(ValueError):
+
+        load_rows(sidecar, store.n_rows + 1)
+
+    rows = store.exclude('not_excluded', sidecar)
+
+    assert rows.shape[0] == store.n_rows - 3
+
+    assert not np.any(np.isin([3, 7, 100], rows))
+
+
+def test_split_by_ccd(store, event_file):
+
+    events, _, _ = _read_events(event_file)
+
+    store.add_selection('first_half', np.arange(store.n_rows // 2))
+
+    names = store.split_by_ccd('first_half')
+
+    assert list(names.keys()) == sorted(np.unique(events['ccd_id'][:store.n_rows // 2]))
+
+    for ccd, name in names.items():
+
+        expected = np.flatnonzero(events['ccd_id'] == ccd)
+
+        assert np.array_equal(store.get_selection(name), expected[expected < store.n_rows // 2])
+
+
+def test_write_fits_keeps_all_columns(tmpdir, store, event_file):
+
+    events, header, hdu_names = _read_events(event_file)
+
+    names = store.split_by_ccd()
+
+    outputs = dict([(str(tmpdir.join("ccd_%s.fits" % ccd)), name) for ccd, name in names.items()])
+
+    store.write_fits_files(outputs, chunk_size=101)
+
+    for ccd in names:
+
+        ccd_events, ccd_header, ccd_hdu_names = _read_events(str(tmpdir.join("ccd_%s.fits" % ccd)))
+
+        assert ccd_hdu_names == hdu_names
+
+        assert ccd_events.dtype.names == events.dtype.names
+
+        assert ccd_header['NAXIS2'] == ccd_events.shape[0]
+
+        assert ccd_header['TIMEDEL'] == header['TIMEDEL']
+
+        assert np.array_equal(ccd_events, events[events['ccd_id'] == ccd])
+
+    # One file at a time, all the events
+
+    store.write_fits(str(tmpdir.join("all.fits")))
+
+    assert np.array_equal(_read_events(str(tmpdir.join("all.fits")))[0], events)
+
+
+def test_write_fits_without_the_original_file(tmpdir):
+
+    event_file = str(tmpdir.join("evt3.fits"))
+
+    events = write_event_file(event_file, n_events=500)
+
+    store = EventStore.create(str(tmpdir.join("evt3.store")), event_file)
+
+    os.remove(event_file)
+
+    assert store.source_file() is None
+
+    store.write_fits(str(tmpdir.join("ccd_2.fits")), events['ccd_id'] == 2)
+
+    ccd_events, _, _ = _read_events(str(tmpdir.join("ccd_2.fits")))
+
+    # Only the columns in the store
+
+    assert [name.lower() for name in ccd_events.dtype.names] == list(default_columns.keys())
+
+    for name in default_columns:
+
+        assert np.array_equal(ccd_events[name], events[name][events['ccd_id'] == 2])
@@ -0,0 +1,132 @@
+import os
+import stat
+
+import pytest
+
+from chandra_suli.executors import FarmJob, LocalExecutor, PBSExecutor
+
+
+def _make_script(tmpdir):
+
+    # A fake farm_wrapper.py: exits with the code given as first option. It also records whether another job was
+    # running at the same time
+
+    script = tmpdir.join("fake_wrapper.sh")
+
+    script.write("#!/bin/sh\n"
+                 "if [ -e %(dir)s/running ]; then touch %(dir)s/overlap; fi\n"
+                 "touch %(dir)s/running\n"
+                 "sleep 0.2\n"
+                 "rm -f %(dir)s/running\n"
+                 "echo done $1\n"
+                 "exit $1\n" % {'dir': str(tmpdir)})
+
+    os.chmod(str(script), os.stat(str(script)).st_mode | stat.S_IEXEC)
+
+    return str(script)
+
+
+def _make_executor(tmpdir, **kwargs):
+
+    log_path = tmpdir.mkdir("logs")
+
+    return LocalExecutor(_make_script(tmpdir), str(log_path), poll_interval=0.01, **kwargs), log_path
+
+
+def test_local_executor_reports_failures(tmpdir):
+
+    executor, log_path = _make_executor(tmpdir, max_cpus=4, max_memory=100.0)
+
+    executor.submit(FarmJob("good", "0", memory=1.0))
+    executor.submit(FarmJob("bad", "3", memory=1.0))
+
+    assert executor.wait() == ["bad"]
+
+    assert log_path.join("good.out").read().strip() == "done 0"
+    assert log_path.join("bad.out").read().strip() == "done 3"
+
+
+def test_local_executor_respects_memory_budget(tmpdir):
+
+    executor, _ = _make_executor(tmpdir, max_cpus=4, max_memory=10.0)
+
+    for i in range(3):
+
+        executor.submit(FarmJob("job%s" % i, "0", memory=6.0))
+
+    assert executor.wait() == []
+
+    assert not tmpdir.join("overlap").exists()
+
+
+def test_local_executor_respects_cpu_budget(tmpdir):
+
+    executor, _ = _make_executor(tmpdir, max_cpus=2, max_memory=100.0)
+
+    for i in range(3):
+
+        executor.submit(FarmJob("job%s" % i, "0", memory=1.0, cpus=2))
+
+    assert executor.wait() == []
+
+    assert not tmpdir.join("overlap").exists()
+
+
+def test_local_executor_runs_oversized_job_alone(tmpdir):
+
+    executor, _ = _make_executor(tmpdir, max_cpus=1, max_memory=1.0)
+
+    executor.submit(FarmJob("big", "0", memory=50.0, cpus=8))
+
+    assert executor.wait() == []
+
+
+def test_local_executor_rejects_arrays(tmpdir):
+
+    executor, _ = _make_executor(tmpdir)
+
+    with pytest.raises(RuntimeError):
+
+        executor.submit(FarmJob("array", "0", memory=1.0, array_size=3))
+
+
+def test_local_executor_test_run(tmpdir, capsys):
+
+    executor, log_path = _make_executor(tmpdir, scratch_dir="/scratch", test_run=True)
+
+    executor.submit(FarmJob("job", "-o 1234", memory=1.0))
+
+    assert executor.wait() == []
+
+    out = capsys.readouterr()[0]
+
+    assert "fake_wrapper.sh -o 1234 --scratch_dir /scratch" in out
+
+    assert log_path.listdir() == []
+
+
+def test_pbs_executor_resources(capsys):
+
+    executor = PBSExecutor("farm_wrapper.py", "/logs", ppn=4, test_run=True)
+
+    executor.submit(FarmJob("1234_2", "-o 1234 5678", memory=2.5, walltime=3661))
+
+    out = capsys.readouterr()[0]
+
+    assert "-l vmem=3gb -l walltime=01:01:01 -l nodes=1:ppn=4" in out
+    assert "-o /logs/1234_2.out -e /logs/1234_2.err" in out
+    assert "-F '-o 1234 5678' farm_wrapper.py" in out
+
+    assert executor.wait() == []
+
+
+def test_pbs_executor_job_array(capsys):
+
+    executor = PBSExecutor("farm_wrapper.py", "/logs", test_run=True)
+
+    executor.submit(FarmJob("joblist", "--joblist jobs.txt", memory=4.0, array_size=5))
+
+    out = capsys.readouterr()[0]
+
+    assert out.startswith("qsub -t 0-4 -l vmem=4gb -l nodes=1:ppn=4")
+    assert "walltime" not in out
@@ -0,0 +1,117 @@
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+from chandra_suli.job_packing import CostModel, ObsidCost, format_memory, format_walltime, pack_obsids, \
+    read_event_file_summary, request_walltime
+
+
+def _cost(obsid, walltime, memory=1.0):
+
+    return ObsidCost(obsid, 1000, 4, walltime, memory)
+
+
+def _write_event_header(filename, n_events, detnam):
+
+    columns = [pyfits.Column(name='TIME', format='D', array=np.arange(n_events, dtype=float)),
+               pyfits.Column(name='CCD_ID', format='I', array=np.zeros(n_events, dtype=np.int16))]
+
+    events = pyfits.BinTableHDU.from_columns(columns, name='EVENTS')
+
+    events.header['DETNAM'] = detnam
+
+    pyfits.HDUList([pyfits.PrimaryHDU(), events]).writeto(filename)
+
+
+def test_pack_first_fit_decreasing():
+
+    costs = [_cost(1, 100), _cost(2, 300), _cost(3, 250), _cost(4, 50), _cost(5, 200)]
+
+    jobs = pack_obsids(costs, 400)
+
+    # Sorted by decreasing wall time: 300, 250, 200, 100, 50. Each goes in the first job with room for it
+
+    assert [job.obsids for job in jobs] == [[2, 1], [3, 4], [5]]
+
+    assert [job.walltime for job in jobs] == [400, 300, 200]
+
+
+def test_pack_every_obsid_once():
+
+    random_state = np.random.RandomState(0)
+
+    costs = [_cost(i, walltime) for i, walltime in enumerate(random_state.uniform(10, 500, 200))]
+
+    jobs = pack_obsids(costs, 1000)
+
+    assert sorted(sum([job.obsids for job in jobs], [])) == list(range(200))
+
+    assert all([job.walltime <= 1000 for job in jobs])
+
+
+def test_pack_large_obsid_alone():
+
+    jobs = pack_obsids([_cost(1, 5000), _cost(2, 10), _cost(3, 20)], 100)
+
+    assert [job.obsids for job in jobs] == [[1], [3, 2]]
+
+
+def test_packed_job_memory_is_maximum():
+
+    jobs = pack_obsids([_cost(1, 10, memory=2.0), _cost(2, 20, memory=5.5), _cost(3, 30, memory=3.0)], 100)
+
+    assert len(jobs) == 1
+
+    assert jobs[0].memory == 5.5
+
+
+@pytest.mark.parametrize("walltime, expected", [(100.0, 3600.0), (3600.0, 7200.0), (10000.0, 20000.0)])
+def test_request_walltime(walltime, expected):
+
+    assert request_walltime(walltime, 2.0, 3600.0) == expected
+
+
+@pytest.mark.parametrize("seconds, expected", [(0, "00:00:00"),
+                                               (59.2, "00:01:00"),
+                                               (3600, "01:00:00"),
+                                               (3661, "01:01:01"),
+                                               (100 * 3600 + 1, "100:00:01")])
+def test_format_walltime(seconds, expected):
+
+    assert format_walltime(seconds) == expected
+
+
+@pytest.mark.parametrize("gigabytes, expected", [(1, "1gb"), (1.01, "2gb"), (20.0, "20gb"), (0.2, "1gb")])
+def test_format_memory(gigabytes, expected):
+
+    assert format_memory(gigabytes) == expected
+
+
+def test_read_event_file_summary(tmpdir):
+
+    filename = str(tmpdir.join("evt3.fits"))
+
+    _write_event_header(filename, 1000, "ACIS-235678")
+
+    n_events, n_ccds, table_bytes = read_event_file_summary(filename)
+
+    assert n_events == 1000
+    assert n_ccds == 6
+    assert table_bytes == 1000 * (8 + 2)
+
+
+def test_cost_model_is_linear(tmpdir):
+
+    filename = str(tmpdir.join("evt3.fits"))
+
+    _write_event_header(filename, 2000000, "ACIS-0123")
+
+    model = CostModel(overhead=10.0, time_per_ccd=100.0, time_per_mevent=1000.0, base_memory=1.0,
+                      memory_factor=2.0)
+
+    cost = model.estimate(1234, filename)
+
+    assert cost.obsid == 1234
+    assert cost.n_ccds == 4
+    assert cost.walltime == pytest.approx(10.0 + 4 * 100.0 + 2 * 1000.0)
+    assert cost.memory == pytest.approx(1.0 + 2.0 * 2000000 * 10 / 1024.0 ** 3)
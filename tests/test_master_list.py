@@ -0,0 +1,148 @@
+import pytest
+
+from chandra_suli.candidate_table import make_table, read_candidates
+from chandra_suli.master_list import MasterList
+
+_names = ['Candidate', 'Obsid', 'CCD', 'Tstart', 'Tstop', 'Hot_Pixel_Flag', 'PSFfrac']
+
+
+def _rows(master_list):
+
+    cursor = master_list._connection.execute("SELECT * FROM candidates ORDER BY Obsid, CCD, Candidate")
+
+    return [tuple(row) for row in cursor]
+
+
+def test_upsert_adds_new_candidates(tmpdir):
+
+    master_list = MasterList(str(tmpdir.join("master.db")))
+
+    assert len(master_list) == 0
+    assert master_list.columns == []
+
+    n = master_list.upsert(_names, make_table(_names, [(1, 1234, 3, 10.5, 20.5, False, 0.5),
+                                                       (2, 1234, 3, 30.5, 40.5, True, 0.1),
+                                                       (1, 5678, 7, 50.5, 60.5, False, 0.9)]))
+
+    assert n == 3
+    assert len(master_list) == 3
+    assert master_list.columns == _names
+
+
+def test_upsert_replaces_same_key(tmpdir):
+
+    master_list = MasterList(str(tmpdir.join("master.db")))
+
+    master_list.upsert(_names, [(1, 1234, 3, 10.5, 20.5, False, 0.5), (2, 1234, 3, 30.5, 40.5, True, 0.1)])
+
+    # Same Obsid, CCD and Candidate as the first row: replaced. Different CCD: added
+
+    master_list.upsert(_names, [(1, 1234, 3, 11.5, 21.5, True, 0.7), (1, 1234, 4, 10.5, 20.5, False, 0.2)])
+
+    assert _rows(master_list) == [(1, 1234, 3, 11.5, 21.5, 'True', 0.7),
+                                  (2, 1234, 3, 30.5, 40.5, 'True', 0.1),
+                                  (1, 1234, 4, 10.5, 20.5, 'False', 0.2)]
+
+
+def test_upsert_is_idempotent(tmpdir):
+
+    master_list = MasterList(str(tmpdir.join("master.db")))
+
+    data = make_table(_names, [(1, 1234, 3, 10.5, 20.5, False, 0.5), (2, 1234, 3, 30.5, 40.5, True, 0.1)])
+
+    master_list.upsert(_names, data)
+
+    before = _rows(master_list)
+
+    master_list.upsert(_names, data)
+
+    assert _rows(master_list) == before
+
+
+def test_upsert_checks_columns(tmpdir):
+
+    master_list = MasterList(str(tmpdir.join("master.db")))
+
+    master_list.upsert(_names, [(1, 1234, 3, 10.5, 20.5, False, 0.5)])
+
+    with pytest.raises(RuntimeError):
+
+        master_list.upsert(_names[:-1], [(1, 1234, 3, 10.5, 20.5, False)])
+
+
+def test_key_columns_are_required(tmpdir):
+
+    master_list = MasterList(str(tmpdir.join("master.db")))
+
+    with pytest.raises(RuntimeError):
+
+        master_list.upsert(['Obsid', 'CCD', 'PSFfrac'], [(1234, 3, 0.5)])
+
+
+def test_persistence(tmpdir):
+
+    db_file = str(tmpdir.join("master.db"))
+
+    master_list = MasterList(db_file)
+
+    master_list.upsert(_names, [(1, 1234, 3, 10.5, 20.5, False, 0.5)])
+
+    master_list.close()
+
+    assert len(MasterList(db_file)) == 1
+
+
+def test_in_memory(tmpdir):
+
+    with tmpdir.as_cwd():
+
+        master_list = MasterList(":memory:")
+
+        master_list.upsert(_names, [(1, 1234, 3, 10.5, 20.5, False, 0.5)])
+
+        assert len(master_list) == 1
+
+        master_list.close()
+
+        assert tmpdir.listdir() == []
+
+
+def test_export_ranks_by_last_column_and_imports_back(tmpdir):
+
+    master_list = MasterList(str(tmpdir.join("master.db")))
+
+    master_list.upsert(_names, [(1, 1234, 3, 10.5, 20.5, False, 0.5),
+                                (2, 1234, 3, 30.5, 40.5, True, 0.1),
+                                (1, 5678, 7, 50.5, 60.5, False, 0.9)])
+
+    text_file = str(tmpdir.join("master.txt"))
+
+    assert master_list.export(text_file) == 3
+
+    data = read_candidates(text_file)
+
+    assert list(data.dtype.names) == ['Rank'] + _names
+    assert list(data['Rank']) == [1, 2, 3]
+    assert list(data['PSFfrac']) == [0.9, 0.5, 0.1]
+
+    # Import in a new list (the Rank column is dropped), then upsert the same file again
+
+    other = MasterList(str(tmpdir.join("other.db")))
+
+    assert other.import_text(text_file) == 3
+    assert other.import_text(text_file) == 3
+
+    assert other.columns == _names
+    assert _rows(other) == _rows(master_list)
+
+
+def test_import_empty_list(tmpdir):
+
+    text_file = tmpdir.join("empty.txt")
+
+    text_file.write("\n# command line:\n# farm_step2.py --obsid 1234\n")
+
+    master_list = MasterList(str(tmpdir.join("master.db")))
+
+    assert master_list.import_text(str(text_file)) == 0
+    assert len(master_list) == 0
@@ -0,0 +1,122 @@
+import numpy as np
+import pytest
+
+from chandra_suli.unique_list import count_unique, unique_list
+
+
+def _quadratic_unique_list(array, elements_to_check=0):
+
+    # The original implementation, which compares each row with all the following ones: a row is kept only if it
+    # does not appear again later
+
+    if elements_to_check == 0:
+
+        elements = range(len(array[0]))
+
+    else:
+
+        elements = elements_to_check
+
+    unique_array = []
+
+    for i in range(len(array)):
+
+        equal_row = False
+
+        for j in range(i + 1, len(array)):
+
+            if all([array[i][k] == array[j][k] for k in elements]):
+
+                equal_row = True
+
+                break
+
+        if not equal_row:
+
+            unique_array.append(array[i])
+
+    return unique_array
+
+
+def _as_lists(rows):
+
+    return [list(row) for row in rows]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_integer_rows(seed):
+
+    array = np.random.RandomState(seed).randint(0, 4, size=(300, 3))
+
+    assert _as_lists(unique_list(array)) == _as_lists(_quadratic_unique_list(array))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_float_rows(seed):
+
+    array = np.random.RandomState(seed).choice([-1.5, 0.0, 2.25, 1e10], size=(200, 2))
+
+    assert _as_lists(unique_list(array)) == _as_lists(_quadratic_unique_list(array))
+
+
+def test_negative_zero():
+
+    array = np.array([[0.0, 1.0], [-0.0, 1.0], [2.0, 3.0]])
+
+    assert _as_lists(unique_list(array)) == _as_lists(_quadratic_unique_list(array))
+
+
+@pytest.mark.parametrize("elements", [[0], [1, 2], (2, 0)])
+def test_subset_of_elements(elements):
+
+    array = np.random.RandomState(1).randint(0, 3, size=(100, 4))
+
+    assert _as_lists(unique_list(array, elements)) == _as_lists(_quadratic_unique_list(array, elements))
+
+
+def test_list_of_mixed_rows():
+
+    # Not a numerical array: the generic path is used
+
+    array = [["a", 1, 2.5], ["b", 1, 2.5], ["a", 1, 2.5], ["c", 2, 0.0], ["b", 1, 2.5, "extra"]]
+
+    assert unique_list(array) == _quadratic_unique_list(array)
+
+    assert unique_list(array, [1, 2]) == _quadratic_unique_list(array, [1, 2])
+
+
+def test_returns_rows_of_input():
+
+    array = [[1, 2], [3, 4], [1, 2]]
+
+    result = unique_list(array)
+
+    assert result == [[3, 4], [1, 2]]
+
+    assert result[1] is array[2]
+
+
+def test_empty():
+
+    assert unique_list([]) == []
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_count_unique(seed):
+
+    coords = np.random.RandomState(seed).randint(0, 5, size=(1000, 2))
+
+    n_unique = len(_quadratic_unique_list(coords))
+
+    assert count_unique(coords) == n_unique
+
+    assert count_unique(coords, stop_at=10) == min(10, n_unique)
+
+    assert count_unique(coords, stop_at=1000, block_size=7) == n_unique
+
+
+def test_count_unique_few_rows():
+
+    assert count_unique([]) == 0
+
+    assert count_unique(np.array([[1, 2], [1, 2], [2, 1]]), stop_at=10) == 2